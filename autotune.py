@@ -0,0 +1,304 @@
+import copy
+import json
+import os
+import time
+from pathlib import Path
+
+import humanize
+import numpy as np
+
+DEFAULT_AUTOTUNE_CACHE_PATH = Path.home() / ".cache" / "pixel-sorter" / "autotune.json"
+
+# Sizes above the device's maximum workgroup size are skipped
+WORKGROUP_SIZES = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# sort() only synchronizes the work-items of a single work-group between iterations,
+# so only sort_in_tiles(), where every work-group owns a whole tile,
+# can do more than one iteration per call without messing up the output image
+TILES_ITERATION_COUNTS = (1, 2, 4, 8)
+
+
+def get_cache_key(device, args, width, height, kernel_radius, pixel_dtype):
+    parts = [
+        device.platform.name,
+        device.name,
+        device.driver_version,
+        f"{width}x{height}",
+        f"kernel radius {kernel_radius}",
+        f"{args.proposals} proposals",
+        # float pixels take twice the memory of uint16 ones, which can change the best settings
+        f"{np.dtype(pixel_dtype).name} pixels",
+        # This is compiled into the program, so it changes the launches that get timed
+        f"neighbor totals tile side {args.neighbor_totals_tile_side}",
+    ]
+
+    if args.proposals == "window":
+        parts.append(
+            f"windows {args.window_side_start} to {args.window_side_end}"
+            f" after {args.window_start_seconds} seconds, halving every {args.window_halving_seconds} seconds"
+        )
+
+    return "|".join(parts)
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        if Path(cache_path).is_file():
+            print(f"Ignoring the autotune cache, since it failed to load: {e}")
+        return {}
+
+
+def save_cache(cache_path, cache):
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Writing to a temporary file first means that processes running at the same time
+    # can never read a half-written cache
+    tmp_cache_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_cache_path, "w") as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_cache_path, cache_path)
+
+
+def get_window_sides(args):
+    """
+    Returns the window sides that a --proposals window run goes through,
+    where None stands for the sort() calls before --window-start-seconds
+    """
+    window_sides = [None] if args.window_start_seconds > 0 else []
+
+    window_side = args.window_side_start
+    while window_side > args.window_side_end:
+        window_sides.append(window_side)
+        window_side //= 2
+    window_sides.append(args.window_side_end)
+
+    return window_sides
+
+
+def get_candidates(args, max_workgroup_size):
+    """
+    Returns the (iterations_in_kernel_per_call, layout, workgroup_size) settings worth trying
+    """
+    workgroup_sizes = [
+        workgroup_size
+        for workgroup_size in WORKGROUP_SIZES
+        if workgroup_size <= max_workgroup_size
+    ]
+
+    # The layout only changes how sort() is launched
+    if args.proposals == "tiles":
+        return [
+            (iterations, "1d", workgroup_size)
+            for iterations in TILES_ITERATION_COUNTS
+            for workgroup_size in workgroup_sizes
+        ]
+
+    # A window run without --window-start-seconds never calls sort()
+    if args.proposals == "window" and None not in get_window_sides(args):
+        layouts = ("1d",)
+    else:
+        layouts = ("1d", "2d")
+
+    return [
+        (1, layout, workgroup_size)
+        for layout in layouts
+        for workgroup_size in workgroup_sizes
+    ]
+
+
+def launch(sorter, rand1, rand2, args, tile_side, call):
+    if args.proposals == "tiles":
+        sorter.sort_in_tiles(rand1, rand2, tile_side)
+    elif args.proposals == "window":
+        # The calls take turns going through the kernels that the run uses,
+        # since a trial is far too short to follow the run's schedule
+        window_sides = get_window_sides(args)
+        sorter.sort(rand1, rand2, window_sides[call % len(window_sides)])
+    else:
+        sorter.sort(rand1, rand2)
+
+
+def run_trial(sorter, args, initial_state, tile_side, expected_checksum):
+    """
+    Sorts the initial state for --autotune-seconds, and returns the accepted swaps per second,
+    or None if the pixels didn't keep their checksum
+    """
+    # The first launch of a kernel with a new local size can build it for that size, which shouldn't be timed
+    sorter.load(args, *initial_state)
+    warmup_calls = len(get_window_sides(args)) if args.proposals == "window" else 1
+    for call in range(warmup_calls):
+        launch(sorter, np.uint32(42424242), np.uint32(69696969), args, tile_side, call)
+    sorter.finish()
+
+    # Every trial starts from the same pixels, since the accept rate drops as they get sorted
+    sorter.load(args, *initial_state)
+
+    rand1 = np.uint32(42424242)
+    rand2 = np.uint32(69696969)
+
+    call = 0
+
+    start_time = time.perf_counter()
+    while time.perf_counter() < start_time + args.autotune_seconds:
+        rand1 = np.uint32(rand1 + 1)
+        launch(sorter, rand1, rand2, args, tile_side, call)
+        call += 1
+    sorter.finish()
+    seconds = time.perf_counter() - start_time
+
+    accepted_swaps, _ = sorter.read_counters()
+
+    if sorter.checksum() != expected_checksum:
+        return None
+
+    return accepted_swaps / seconds
+
+
+def run_trials(
+    args,
+    pixels,
+    neighbor_totals,
+    normal_to_opaque_index_lut,
+    tile_side,
+    expected_checksum,
+    create_trial_sorter,
+    max_workgroup_size,
+):
+    """
+    Returns the settings that accepted the most swaps per second
+    """
+    best_settings = None
+    initial_state = None
+
+    candidates = get_candidates(args, max_workgroup_size)
+
+    for iterations in sorted(set(candidate[0] for candidate in candidates)):
+        trial_args = copy.copy(args)
+        trial_args.iterations_in_kernel_per_call = iterations
+
+        # Every iteration count is compiled into its own program,
+        # while the workgroup size and layout can be changed without building it again
+        sorter = create_trial_sorter(
+            trial_args, neighbor_totals, normal_to_opaque_index_lut
+        )
+
+        try:
+            if initial_state is None:
+                # Read back once, so the following sorters and trials can skip the initial convolution
+                if neighbor_totals is None:
+                    neighbor_totals = np.empty_like(pixels)
+                    sorter.read_state(np.empty_like(pixels), neighbor_totals)
+                normal_to_opaque_index_lut = sorter.normal_to_opaque_index_lut
+                initial_state = (pixels, neighbor_totals, normal_to_opaque_index_lut)
+
+            tried_sizes = set()
+
+            for candidate_iterations, layout, workgroup_size in candidates:
+                if candidate_iterations != iterations:
+                    continue
+
+                sorter.set_workgroup_size(workgroup_size, layout)
+
+                # Workgroup sizes that don't divide the number of pairs can end up with the same sizes
+                sizes = (
+                    sorter.global_size,
+                    sorter.local_size,
+                    sorter.workgroup_size,
+                    sorter.tile_workgroup_size,
+                )
+                if sizes in tried_sizes:
+                    continue
+                tried_sizes.add(sizes)
+
+                accepted_swaps_per_second = run_trial(
+                    sorter, trial_args, initial_state, tile_side, expected_checksum
+                )
+
+                settings = {
+                    "iterations_in_kernel_per_call": iterations,
+                    "layout": layout,
+                    "workgroup_size": workgroup_size,
+                    "accepted_swaps_per_second": accepted_swaps_per_second,
+                }
+
+                if accepted_swaps_per_second is None:
+                    print(
+                        f"Skipping {iterations} iterations per call, a {layout} layout and workgroup size {workgroup_size}, since it messed up the pixels"
+                    )
+                    continue
+
+                print(
+                    f"{iterations} iterations per call, a {layout} layout and workgroup size {workgroup_size}"
+                    f": {humanize.intword(accepted_swaps_per_second, '%.3f')} accepted swaps/s"
+                )
+
+                if (
+                    best_settings is None
+                    or accepted_swaps_per_second
+                    > best_settings["accepted_swaps_per_second"]
+                ):
+                    best_settings = settings
+        finally:
+            sorter.close()
+
+    return best_settings
+
+
+def autotune(
+    args,
+    device,
+    pixels,
+    kernel_radius,
+    pixel_dtype,
+    tile_side,
+    neighbor_totals,
+    normal_to_opaque_index_lut,
+    expected_checksum,
+    create_trial_sorter,
+):
+    """
+    Returns the iterations_in_kernel_per_call, layout and workgroup_size that
+    accepted the most swaps per second on the device, from the cache if they were tuned before.
+
+    create_trial_sorter(trial_args, neighbor_totals, normal_to_opaque_index_lut)
+    has to return an OpenCLSorter of the pixels on the device.
+    """
+    height, width = pixels.shape[:2]
+    cache_key = get_cache_key(device, args, width, height, kernel_radius, pixel_dtype)
+
+    if not args.no_autotune_cache:
+        cached_settings = load_cache(args.autotune_cache_path).get(cache_key)
+        if cached_settings is not None:
+            print(f"Using the autotuned settings in {args.autotune_cache_path}")
+            return cached_settings
+
+    print("Autotuning...")
+    start_time = time.time()
+
+    settings = run_trials(
+        args,
+        pixels,
+        neighbor_totals,
+        normal_to_opaque_index_lut,
+        tile_side,
+        expected_checksum,
+        create_trial_sorter,
+        device.max_work_group_size,
+    )
+
+    if settings is None:
+        raise RuntimeError("Every autotune trial messed up the pixels")
+
+    print(f"Autotuned in {time.time() - start_time:.2f} seconds")
+
+    if not args.no_autotune_cache:
+        # Read again, in case another process tuned something else in the meantime
+        cache = load_cache(args.autotune_cache_path)
+        cache[cache_key] = settings
+        save_cache(args.autotune_cache_path, cache)
+
+    return settings
@@ -0,0 +1,351 @@
+import argparse
+import json
+import queue
+import signal as sig
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pyopencl as cl
+
+import sort
+
+# The fields of a manifest line that are sort.py's positional arguments, rather than options
+POSITIONAL_FIELDS = ("input_npy_path", "output_npy_path")
+
+
+def get_job_argv(job):
+    """
+    Turns a manifest line like {"input_npy_path": "a.npy", "output_npy_path": "b.npy", "kernel_radius": 50}
+    into the command line arguments sort.py would be started with
+    """
+    argv = [str(job[field]) for field in POSITIONAL_FIELDS]
+
+    for field, value in job.items():
+        if field in POSITIONAL_FIELDS:
+            continue
+
+        option = "--" + field.replace("_", "-")
+
+        # Options like "no_program_cache": true are flags without a value
+        if value is True:
+            argv.append(option)
+        elif value is not False and value is not None:
+            argv += [option, str(value)]
+
+    return argv
+
+
+def read_manifest(manifest_path):
+    """
+    Returns the parsed sort.py arguments of every job in the JSON lines manifest
+    """
+    sort_parser = argparse.ArgumentParser(prog="sort.py")
+    sort.add_parser_arguments(sort_parser)
+
+    jobs = []
+
+    with open(manifest_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            job_args = sort_parser.parse_args(get_job_argv(json.loads(line)))
+
+            try:
+                sort.check_args(job_args)
+            except ValueError as e:
+                sort_parser.error(f"Job {len(jobs)}: {e}")
+
+            jobs.append(job_args)
+
+    return jobs
+
+
+def get_sorter_key(args, pixels, kernel_radius, pair_count):
+    """
+    Returns what has to match for a job to reuse another job's OpenCLSorter,
+    which are the things its compiled program and buffer sizes depend on
+    """
+    _, pixel_dtype = sort.get_pixel_format(args, pixels)
+
+    return (
+        pixels.shape,
+        kernel_radius,
+        pair_count,
+        np.dtype(pixel_dtype).name,
+        args.iterations_in_kernel_per_call,
+        args.workgroup_size,
+        args.layout,
+        args.neighbor_totals_tile_side,
+        args.snapshot_buffers,
+        args.launches_in_flight,
+        # Profiling has to be enabled when the command queues are created
+        args.profile is not None,
+    )
+
+
+class SorterPool:
+    """
+    Hands out OpenCLSorters that share the context of a single device,
+    and keeps the ones that finished jobs return around,
+    so a later job with the same image size and settings can reuse their program and buffers
+    """
+
+    def __init__(self, ctx, max_idle_sorters):
+        self.ctx = ctx
+        self.max_idle_sorters = max_idle_sorters
+
+        # (key, sorter) pairs, from least to most recently returned
+        self.idle_sorters = []
+        self.sorter_keys = {}
+        self.lock = threading.Lock()
+
+    def acquire(
+        self,
+        args,
+        pixels,
+        width,
+        height,
+        kernel_radius,
+        pair_count,
+        neighbor_totals,
+        normal_to_opaque_index_lut,
+        profiler=None,
+    ):
+        # These create their own contexts, so they can't be pooled
+        if args.devices > 1:
+            return sort.ShardedSorter(
+                args,
+                pixels,
+                width,
+                height,
+                kernel_radius,
+                neighbor_totals,
+                normal_to_opaque_index_lut,
+                profiler,
+            )
+        if args.backend != "opencl":
+            return sort.create_sorter(
+                args,
+                pixels,
+                width,
+                height,
+                kernel_radius,
+                pair_count,
+                neighbor_totals,
+                normal_to_opaque_index_lut,
+                profiler,
+            )
+
+        key = get_sorter_key(args, pixels, kernel_radius, pair_count)
+
+        sorter = None
+        with self.lock:
+            for index, (idle_key, idle_sorter) in enumerate(self.idle_sorters):
+                if idle_key == key:
+                    sorter = idle_sorter
+                    del self.idle_sorters[index]
+                    break
+
+        if sorter is not None:
+            print("Reusing the program and buffers of an earlier job...")
+            sorter.profiler = profiler
+            sorter.load(args, pixels, neighbor_totals, normal_to_opaque_index_lut)
+        else:
+            sorter = sort.OpenCLSorter(
+                args,
+                pixels,
+                width,
+                height,
+                kernel_radius,
+                pair_count,
+                neighbor_totals,
+                normal_to_opaque_index_lut,
+                self.ctx,
+                profiler=profiler,
+            )
+
+        with self.lock:
+            self.sorter_keys[sorter] = key
+
+        return sorter
+
+    def release(self, sorter):
+        with self.lock:
+            key = self.sorter_keys.pop(sorter, None)
+
+        if key is None:
+            sorter.close()
+            return
+
+        try:
+            sorter.finish()
+            # The job isn't done until its last snapshot is on disk
+            sorter.snapshot_writer.flush()
+            if sorter.preview_writer is not None:
+                sorter.preview_writer.flush()
+        except Exception:
+            sorter.close()
+            raise
+
+        evicted_sorters = []
+        with self.lock:
+            self.idle_sorters.append((key, sorter))
+
+            while len(self.idle_sorters) > self.max_idle_sorters:
+                evicted_sorters.append(self.idle_sorters.pop(0)[1])
+
+        for evicted_sorter in evicted_sorters:
+            evicted_sorter.close()
+
+    def close(self):
+        with self.lock:
+            idle_sorters = self.idle_sorters
+            self.idle_sorters = []
+
+        for _, sorter in idle_sorters:
+            sorter.close()
+
+
+def write_summary(summary_json_path, summary):
+    # Written to a temporary file first, so the summary can be read while jobs are still running
+    tmp_path = summary_json_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f, indent=4)
+    tmp_path.replace(summary_json_path)
+
+
+def run_job(job_index, job_args, device_slots, stopping):
+    """
+    Sorts a single job on the first device with a free slot, and returns its summary
+    """
+    result = {
+        "job": job_index,
+        "input_npy_path": str(job_args.input_npy_path),
+        "output_npy_path": str(job_args.output_npy_path),
+        "kernel_radius": job_args.kernel_radius,
+    }
+
+    if stopping.is_set():
+        result["status"] = "skipped"
+        return result
+
+    pool = device_slots.get()
+    start_time = time.time()
+
+    try:
+        print(f"Starting job {job_index}: {job_args.input_npy_path}")
+        totals = sort.sort_image(job_args, start_time, stopping, pool)
+        result.update(status="done", **totals)
+    except Exception as e:
+        traceback.print_exc()
+        result.update(status="failed", error=repr(e))
+    finally:
+        device_slots.put(pool)
+
+    result["wall_seconds"] = time.time() - start_time
+    print(f"Finished job {job_index} in {result['wall_seconds']:.2f} seconds")
+
+    return result
+
+
+def add_parser_arguments(parser):
+    parser.add_argument(
+        "manifest_path",
+        type=Path,
+        help='JSON lines file with a job per line, whose fields are sort.py arguments with underscores, e.g. {"input_npy_path": "input_npy/heart_rgb2lab.npy", "output_npy_path": "output_npy/heart.npy", "kernel_radius": 50, "max_seconds": 600, "stop_when_accept_rate_below": 0.001}',
+    )
+    parser.add_argument(
+        "summary_json_path",
+        type=Path,
+        help="Path to the JSON file the timing and results of every job get written to",
+    )
+    parser.add_argument(
+        "--device-count",
+        type=int,
+        default=1,
+        help="How many OpenCL devices the jobs get spread over, picked like sort.py's --devices picks them",
+    )
+    parser.add_argument(
+        "--jobs-per-device",
+        type=int,
+        default=1,
+        help="How many jobs can sort on the same device at once",
+    )
+    parser.add_argument(
+        "--idle-sorters-per-device",
+        type=int,
+        default=2,
+        help="How many finished jobs' programs and buffers every device keeps around for later jobs with the same image size and settings",
+    )
+
+
+def main():
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_parser_arguments(parser)
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest_path)
+    print(f"Read {len(jobs)} jobs")
+
+    print("Initializing OpenCL...")
+    pools = [
+        SorterPool(cl.Context([device]), args.idle_sorters_per_device)
+        for device in sort.get_devices(args.device_count)
+    ]
+
+    # Every device has jobs_per_device slots, and a job waits until one of them is free
+    device_slots = queue.Queue()
+    for _ in range(args.jobs_per_device):
+        for pool in pools:
+            device_slots.put(pool)
+
+    stopping = threading.Event()
+
+    def stop_jobs(signum, frame):
+        print(
+            "Stopping the running jobs once their launched sort calls are done, and skipping the rest; press Ctrl+C again to quit immediately..."
+        )
+        sig.signal(sig.SIGINT, sig.default_int_handler)
+        stopping.set()
+
+    sig.signal(sig.SIGINT, stop_jobs)
+
+    summary = {"jobs": []}
+
+    try:
+        with ThreadPoolExecutor(
+            max_workers=len(pools) * args.jobs_per_device
+        ) as executor:
+            futures = [
+                executor.submit(run_job, job_index, job_args, device_slots, stopping)
+                for job_index, job_args in enumerate(jobs)
+            ]
+
+            for future in futures:
+                summary["jobs"].append(future.result())
+                summary["seconds"] = time.time() - start_time
+
+                # Written after every job, so an interrupted batch isn't lost
+                write_summary(args.summary_json_path, summary)
+    finally:
+        for pool in pools:
+            pool.close()
+
+    failed_jobs = sum(result["status"] == "failed" for result in summary["jobs"])
+    print(
+        f"Ran {len(jobs)} jobs in {time.time() - start_time:.2f} seconds, of which {failed_jobs} failed"
+    )
+    print(f"Wrote {args.summary_json_path}")
+
+
+if __name__ == "__main__":
+    main()
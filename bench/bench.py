@@ -0,0 +1,324 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+
+DEFAULT_IMAGES = ["tiny", "small", "palette", "heart", "elephant", "5120x2880_palette"]
+
+# The higher the better for these, while lower is better for everything else
+HIGHER_IS_BETTER = {"attempted_swaps_per_second", "accepted_swaps_per_second"}
+
+COMPARED_METRICS = [
+    "startup_seconds",
+    "attempted_swaps_per_second",
+    "accepted_swaps_per_second",
+    "peak_memory_mib",
+]
+
+
+def get_input_npy_path(cache_path, image):
+    """
+    Runs rgb2lab.py on input/<image>.png, unless that was already done before
+    """
+    input_npy_path = cache_path / f"{image}_rgb2lab.npy"
+
+    if not input_npy_path.is_file():
+        print(f"Converting input/{image}.png...")
+        subprocess.run(
+            [
+                sys.executable,
+                REPO_PATH / "rgb2lab.py",
+                REPO_PATH / "input" / f"{image}.png",
+                input_npy_path,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    return input_npy_path
+
+
+def read_stats(stats_path):
+    with open(stats_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def run_sort(args, input_npy_path, kernel_radius, workgroup_size, iterations):
+    """
+    Runs sort.py headless, and returns the measurements of the run
+    """
+    with tempfile.TemporaryDirectory() as tmp_path:
+        tmp_path = Path(tmp_path)
+        stats_path = tmp_path / "stats.jsonl"
+
+        command = [
+            sys.executable,
+            REPO_PATH / "sort.py",
+            input_npy_path,
+            tmp_path / "output.npy",
+            "--backend",
+            args.backend,
+            "--kernel-radius",
+            str(kernel_radius),
+            "--workgroup-size",
+            str(workgroup_size),
+            "--iterations-in-kernel-per-call",
+            str(iterations),
+            "--seconds-between-saves",
+            str(args.seconds_between_saves),
+            "--max-seconds",
+            str(args.seconds),
+            "--stats-path",
+            stats_path,
+        ]
+
+        env = dict(os.environ)
+        # Default to pocl's CPU device, so the numbers can be reproduced anywhere
+        env.setdefault("PYOPENCL_CTX", args.opencl_ctx)
+
+        start_time = time.time()
+        process = subprocess.Popen(
+            command, env=env, stdout=subprocess.DEVNULL, stdin=subprocess.DEVNULL
+        )
+        # wait4() is the only way to get the peak memory of this one child
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_seconds = time.time() - start_time
+
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise RuntimeError(f"sort.py exited with status {status}: {command}")
+
+        stats = read_stats(stats_path)
+
+    start = stats[0]
+    statuses = stats[1:]
+    last = statuses[-1]
+
+    sorting_seconds = last["seconds"] - start["seconds"]
+
+    # The score is an energy that sorting lowers, so this is the energy-vs-wall-time curve
+    energy_curve = []
+    energy = 0
+    for status in statuses:
+        energy += status["score_difference"]
+        energy_curve.append([status["seconds"], energy])
+
+    return {
+        "startup_seconds": start["seconds"],
+        "wall_seconds": wall_seconds,
+        "sorting_seconds": sorting_seconds,
+        "attempted_swaps": last["attempted_swaps"],
+        "accepted_swaps": last["accepted_swaps"],
+        "attempted_swaps_per_second": last["attempted_swaps"] / sorting_seconds,
+        "accepted_swaps_per_second": last["accepted_swaps"] / sorting_seconds,
+        # ru_maxrss is in KiB on Linux
+        "peak_memory_mib": rusage.ru_maxrss / 1024,
+        "energy_curve": energy_curve,
+    }
+
+
+def get_run_name(image, kernel_radius, workgroup_size, iterations):
+    return f"{image} k{kernel_radius} w{workgroup_size} i{iterations}"
+
+
+def run(args):
+    args.cache_path.mkdir(parents=True, exist_ok=True)
+
+    results = {
+        "settings": {
+            "backend": args.backend,
+            "opencl_ctx": os.environ.get("PYOPENCL_CTX", args.opencl_ctx),
+            "seconds": args.seconds,
+        },
+        "runs": {},
+    }
+
+    for image in args.images:
+        input_npy_path = get_input_npy_path(args.cache_path, image)
+
+        for kernel_radius, workgroup_size, iterations in itertools.product(
+            args.kernel_radii, args.workgroup_sizes, args.iterations
+        ):
+            name = get_run_name(image, kernel_radius, workgroup_size, iterations)
+            print(f"Running {name}...")
+
+            measurements = run_sort(
+                args, input_npy_path, kernel_radius, workgroup_size, iterations
+            )
+            results["runs"][name] = measurements
+
+            print(
+                f"  startup {measurements['startup_seconds']:.2f}s, {measurements['attempted_swaps_per_second']:.0f} attempted swaps/s, {measurements['accepted_swaps_per_second']:.0f} accepted swaps/s, peak memory {measurements['peak_memory_mib']:.0f} MiB"
+            )
+
+            # Written after every run, so an interrupted benchmark isn't lost
+            with open(args.output_json_path, "w") as f:
+                json.dump(results, f, indent=4)
+
+    print(f"Wrote {args.output_json_path}")
+
+
+def get_regression(metric, old_value, new_value):
+    """
+    Returns how much worse new_value is than old_value, as a fraction of old_value
+    """
+    if old_value == 0:
+        return 0
+
+    if metric in HIGHER_IS_BETTER:
+        return (old_value - new_value) / old_value
+
+    return (new_value - old_value) / old_value
+
+
+def compare(args):
+    with open(args.old_json_path) as f:
+        old_runs = json.load(f)["runs"]
+    with open(args.new_json_path) as f:
+        new_runs = json.load(f)["runs"]
+
+    regression_count = 0
+
+    for name in old_runs.keys() & new_runs.keys():
+        for metric in COMPARED_METRICS:
+            old_value = old_runs[name][metric]
+            new_value = new_runs[name][metric]
+
+            regression = get_regression(metric, old_value, new_value)
+
+            if regression > args.threshold:
+                regression_count += 1
+                print(
+                    f"REGRESSION {name} {metric}: {old_value:.2f} -> {new_value:.2f} ({regression:.0%} worse)"
+                )
+            elif args.verbose:
+                print(f"{name} {metric}: {old_value:.2f} -> {new_value:.2f}")
+
+    for name in old_runs.keys() - new_runs.keys():
+        print(f"Missing from {args.new_json_path}: {name}")
+
+    print(f"Found {regression_count} regressions")
+
+    if regression_count > 0:
+        sys.exit(1)
+
+
+def add_parser_arguments(parser):
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser(
+        "run",
+        help="Benchmark sort.py on a matrix of images and settings",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    run_parser.set_defaults(function=run)
+    run_parser.add_argument(
+        "output_json_path",
+        type=Path,
+        help="Path to the JSON file the results get written to",
+    )
+    run_parser.add_argument(
+        "--images",
+        nargs="+",
+        default=DEFAULT_IMAGES,
+        help="Names of the input/*.png images to sort",
+    )
+    run_parser.add_argument(
+        "--kernel-radii",
+        type=int,
+        nargs="+",
+        default=[10, 50],
+        help="The --kernel-radius values to run",
+    )
+    run_parser.add_argument(
+        "--workgroup-sizes",
+        type=int,
+        nargs="+",
+        default=[8, 64],
+        help="The --workgroup-size values to run",
+    )
+    run_parser.add_argument(
+        "--iterations",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="The --iterations-in-kernel-per-call values to run",
+    )
+    run_parser.add_argument(
+        "--seconds",
+        type=float,
+        default=10,
+        help="How long every run lasts, including its startup",
+    )
+    run_parser.add_argument(
+        "--seconds-between-saves",
+        type=float,
+        default=0.5,
+        help="How often every run saves, which is also how fine the energy curves are",
+    )
+    run_parser.add_argument(
+        "--backend",
+        choices=("opencl", "numpy"),
+        default="opencl",
+        help="The --backend passed to sort.py",
+    )
+    run_parser.add_argument(
+        "--opencl-ctx",
+        default="portable",
+        help="The PYOPENCL_CTX used when it isn't set already, where portable picks pocl's CPU device",
+    )
+    run_parser.add_argument(
+        "--cache-path",
+        type=Path,
+        default=REPO_PATH / "input_npy" / "bench",
+        help="Where the rgb2lab.py conversions of the images are kept between benchmarks",
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="Flag regressions between two result files of the run command",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    compare_parser.set_defaults(function=compare)
+    compare_parser.add_argument(
+        "old_json_path",
+        type=Path,
+        help="Path to the baseline results",
+    )
+    compare_parser.add_argument(
+        "new_json_path",
+        type=Path,
+        help="Path to the results that get checked for regressions",
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="How much worse a metric may get before it counts as a regression, e.g. 0.1 is 10%%",
+    )
+    compare_parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Also print the metrics that didn't regress",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_parser_arguments(parser)
+    args = parser.parse_args()
+
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+
+def get_checkpoint_dtype(width, height, opaque_pixel_count):
+    # A single record with every field laid out back-to-back,
+    # so np.load(mmap_mode="r") can hand out each field as a view into the file
+    return np.dtype(
+        [
+            ("kernel_radius", "<i4"),
+            ("rand1", "<u4"),
+            ("rand2", "<u4"),
+            ("python_iteration", "<i8"),
+            ("saved_results", "<i8"),
+            # How far into the --proposals window schedule the run was
+            ("sorting_seconds", "<f8"),
+            ("pixels", "<f4", (height, width, 4)),
+            ("neighbor_totals", "<f4", (height, width, 4)),
+            ("normal_to_opaque_index_lut", "<i4", (opaque_pixel_count,)),
+        ]
+    )
+
+
+def save_checkpoint(
+    checkpoint_path,
+    sorter,
+    kernel_radius,
+    rand1,
+    rand2,
+    python_iteration,
+    saved_results,
+    sorting_seconds,
+):
+    opaque_pixel_count = sorter.normal_to_opaque_index_lut.size
+
+    # Writing to a temporary file first means that getting killed halfway through
+    # can't destroy the previous checkpoint
+    tmp_path = f"{checkpoint_path}.tmp"
+
+    checkpoint = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=get_checkpoint_dtype(sorter.width, sorter.height, opaque_pixel_count),
+        shape=(),
+    )
+
+    checkpoint["kernel_radius"] = kernel_radius
+    checkpoint["rand1"] = rand1
+    checkpoint["rand2"] = rand2
+    checkpoint["python_iteration"] = python_iteration
+    checkpoint["saved_results"] = saved_results
+    checkpoint["sorting_seconds"] = sorting_seconds
+    checkpoint["normal_to_opaque_index_lut"] = sorter.normal_to_opaque_index_lut
+
+    # The state gets copied straight into the memory-mapped file
+    sorter.read_state(checkpoint["pixels"], checkpoint["neighbor_totals"])
+
+    checkpoint.flush()
+    del checkpoint
+
+    os.replace(tmp_path, checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Returns the checkpoint record, whose big fields are only read from disk once they're used
+    """
+    return np.load(checkpoint_path, mmap_mode="r")
@@ -0,0 +1,218 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import skimage
+
+DEFAULT_COLOR_CACHE_PATH = Path.home() / ".cache" / "pixel-sorter" / "colors"
+
+
+def pack_colors(pixels):
+    """
+    Packs the 4 channels of every pixel into a single integer key,
+    so uint8 RGBA pixels become uint32 keys, and uint16 LAB pixels become uint64 keys.
+    Float pixels have to be cast to uint16 first, since there is no uint128.
+    """
+    key_dtype = np.dtype(f"u{pixels.dtype.itemsize * 4}")
+    return np.ascontiguousarray(pixels).view(key_dtype)[..., 0]
+
+
+def unpack_colors(keys, dtype):
+    """
+    Does the opposite of pack_colors(), returning an (n, 4) array
+    """
+    return keys.view(dtype).reshape(-1, 4)
+
+
+# The converted colors are spread over 2^SHARD_BITS shard files by their keys,
+# so a conversion only loads and rewrites the shards that its colors fall in
+SHARD_BITS = 8
+
+
+def get_shards(keys):
+    """
+    Returns the shard of every key, which is taken from the top bits of a multiplicative hash,
+    so keys that only differ in their low channels still get spread over all shards
+    """
+    hashes = keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    # Stable argsorts of 16 bit integers are radix sorts, which are far faster than sorting intps
+    return (hashes >> np.uint64(64 - SHARD_BITS)).astype(np.uint16)
+
+
+def get_shards_path(cache_path, conversion_name):
+    # skimage's conversion formulas are what the cached colors depend on
+    return Path(cache_path) / f"{conversion_name}_skimage_{skimage.__version__}"
+
+
+def load_shard(shard_path, key_dtype):
+    """
+    Returns the sorted keys and their converted colors, which are empty if the shard doesn't exist yet
+    """
+    try:
+        with np.load(shard_path) as shard:
+            keys = shard["keys"]
+            colors = shard["colors"]
+    except (OSError, ValueError, KeyError) as e:
+        if shard_path.is_file():
+            print(
+                f"Ignoring the color cache shard {shard_path.name}, since it failed to load: {e}"
+            )
+        return np.empty(0, dtype=key_dtype), None
+
+    if keys.dtype != key_dtype:
+        return np.empty(0, dtype=key_dtype), None
+
+    return keys, colors
+
+
+def save_shard(shard_path, keys, colors):
+    shard_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Writing to a temporary file first means that processes running at the same time
+    # can never read a half-written shard
+    tmp_shard_path = shard_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_shard_path, "wb") as f:
+        np.savez(f, keys=keys, colors=colors)
+    os.replace(tmp_shard_path, shard_path)
+
+
+def evict_least_recently_used(cache_path, max_bytes):
+    """
+    Deletes the least recently used shards of every conversion until the cache fits in max_bytes
+    """
+    cache_path = Path(cache_path)
+
+    # The unsharded cache files of older versions sit directly in the cache path,
+    # and are never used anymore, so they are the first to go
+    shard_paths = sorted(
+        (*cache_path.glob("*.npz"), *cache_path.glob("*/*.npz")),
+        key=lambda shard_path: (
+            shard_path.parent != cache_path,
+            shard_path.stat().st_mtime,
+        ),
+    )
+
+    total_bytes = sum(shard_path.stat().st_size for shard_path in shard_paths)
+
+    for shard_path in shard_paths:
+        if total_bytes <= max_bytes:
+            break
+
+        total_bytes -= shard_path.stat().st_size
+        shard_path.unlink(missing_ok=True)
+
+
+def convert_cached_colors(
+    unique_keys, dtype, convert, conversion_name, cache_path, max_bytes
+):
+    """
+    Returns the converted colors of the sorted unique keys,
+    where only the shards that the keys fall in are loaded,
+    and only the ones that were missing colors are written back
+    """
+    shards_path = get_shards_path(cache_path, conversion_name)
+
+    # Putting the keys in shard order once makes every shard a contiguous slice.
+    # The unique keys are sorted, so the stable sort keeps them sorted within every shard
+    shards = get_shards(unique_keys)
+    order = np.argsort(shards, kind="stable")
+    keys = unique_keys[order]
+
+    shard_sizes = np.bincount(shards, minlength=2**SHARD_BITS)
+    shard_ends = np.cumsum(shard_sizes)
+    shard_starts = shard_ends - shard_sizes
+
+    colors = None
+    missing = np.ones(len(keys), dtype=bool)
+
+    # The path, the slice of keys, and the cached keys and colors of every used shard
+    loaded_shards = []
+
+    for shard in np.flatnonzero(shard_sizes):
+        shard_path = shards_path / f"{shard:03d}.npz"
+        shard_slice = slice(shard_starts[shard], shard_ends[shard])
+        shard_keys = keys[shard_slice]
+
+        cached_keys, cached_colors = load_shard(shard_path, keys.dtype)
+        loaded_shards.append((shard_path, shard_slice, cached_keys, cached_colors))
+
+        if len(cached_keys) == 0:
+            continue
+
+        indices = np.searchsorted(cached_keys, shard_keys)
+        indices[indices == len(cached_keys)] = 0
+        shard_missing = cached_keys[indices] != shard_keys
+        missing[shard_slice] = shard_missing
+
+        if colors is None:
+            colors = np.empty((len(keys), 4), dtype=cached_colors.dtype)
+        colors[shard_slice][~shard_missing] = cached_colors[indices[~shard_missing]]
+
+        if not shard_missing.any():
+            # The modification time is what the eviction uses to tell how recently it was used
+            os.utime(shard_path)
+
+    if missing.any():
+        missing_colors = convert(unpack_colors(keys[missing], dtype)[np.newaxis, :, :])[
+            0
+        ]
+
+        if colors is None:
+            colors = np.empty((len(keys), 4), dtype=missing_colors.dtype)
+        colors[missing] = missing_colors
+
+        for shard_path, shard_slice, cached_keys, cached_colors in loaded_shards:
+            shard_missing = missing[shard_slice]
+            if not shard_missing.any():
+                continue
+
+            new_keys = keys[shard_slice][shard_missing]
+            new_colors = colors[shard_slice][shard_missing]
+
+            if len(cached_keys) > 0:
+                # The cached keys have to stay sorted for np.searchsorted()
+                merged_keys = np.concatenate((cached_keys, new_keys))
+                shard_order = np.argsort(merged_keys, kind="stable")
+                merged_keys = merged_keys[shard_order]
+                merged_colors = np.concatenate((cached_colors, new_colors))[shard_order]
+            else:
+                merged_keys = new_keys
+                merged_colors = new_colors
+
+            save_shard(shard_path, merged_keys, merged_colors)
+
+        evict_least_recently_used(cache_path, max_bytes)
+
+    unique_colors = np.empty_like(colors)
+    unique_colors[order] = colors
+    return unique_colors
+
+
+def convert_unique_colors(
+    pixels, convert, conversion_name, cache_path=None, max_bytes=256 * 1024 * 1024
+):
+    """
+    Calls convert() only on the unique colors of the (height, width, 4) pixels,
+    and on only the ones that aren't in the on-disk cache yet,
+    and then scatters the converted colors back to every pixel.
+
+    convert() is passed and returns a (1, colors, 4) image.
+    Passing None as the cache_path never reads or writes the cache.
+    """
+    keys = pack_colors(pixels)
+
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    if cache_path is None:
+        unique_colors = convert(
+            unpack_colors(unique_keys, pixels.dtype)[np.newaxis, :, :]
+        )[0]
+    else:
+        unique_colors = convert_cached_colors(
+            unique_keys, pixels.dtype, convert, conversion_name, cache_path, max_bytes
+        )
+
+    # Gathering the packed colors moves a single integer per pixel
+    return unpack_colors(
+        pack_colors(unique_colors)[inverse], unique_colors.dtype
+    ).reshape(pixels.shape)
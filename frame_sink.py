@@ -0,0 +1,189 @@
+import shlex
+import struct
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from lab2rgb import lab_to_rgb
+
+# Every frame stack header takes up exactly this many bytes,
+# so it can be rewritten in place whenever the number of frames changes
+FRAME_STACK_HEADER_BYTES = 128
+
+
+def write_frame_stack_header(f, frame_count, height, width):
+    """
+    Writes an npy version 1.0 header, so np.load() reads the file as a (frame_count, height, width, 4) uint16 array
+    """
+    # Source: https://numpy.org/doc/stable/reference/generated/numpy.lib.format.html
+    magic = np.lib.format.magic(1, 0)
+
+    header = repr(
+        {
+            "descr": "<u2",
+            "fortran_order": False,
+            "shape": (frame_count, height, width, 4),
+        }
+    )
+
+    header_bytes = FRAME_STACK_HEADER_BYTES - len(magic) - 2
+    header = header.ljust(header_bytes - 1) + "\n"
+
+    f.seek(0)
+    f.write(magic + struct.pack("<H", header_bytes) + header.encode("latin1"))
+
+
+class FrameStack:
+    """
+    Writes every snapshot as a uint16 LAB frame into a single memory-mapped npy of shape (frames, height, width, 4),
+    which is preallocated with room for max_frames frames.
+    Once it is closed, it only holds the frames that were written.
+    """
+
+    def __init__(self, path, max_frames, height, width, first_frame=0):
+        self.path = Path(path)
+        self.max_frames = max_frames
+        self.height = height
+        self.width = width
+        self.frame_index = first_frame
+
+        frame_bytes = height * width * 4 * np.uint16().itemsize
+
+        # A resumed run adds its frames after the ones that are already in the stack
+        mode = "r+b" if first_frame > 0 and self.path.is_file() else "w+b"
+
+        with open(self.path, mode) as f:
+            write_frame_stack_header(f, max_frames, height, width)
+            f.truncate(FRAME_STACK_HEADER_BYTES + max_frames * frame_bytes)
+
+        self.frames = np.memmap(
+            self.path,
+            dtype=np.uint16,
+            mode="r+",
+            offset=FRAME_STACK_HEADER_BYTES,
+            shape=(max_frames, height, width, 4),
+        )
+
+        self.last_path = None
+
+    def write(self, path, frame):
+        self.last_path = path
+
+        if self.frame_index >= self.max_frames:
+            if self.frame_index == self.max_frames:
+                print(
+                    f"The frame stack is full, so its last frame keeps getting replaced by the newest one; pass a higher --frame-stack-frames than {self.max_frames} next time"
+                )
+                self.frame_index += 1
+
+            self.frames[-1] = frame
+            return
+
+        self.frames[self.frame_index] = frame
+        self.frame_index += 1
+
+    def close(self):
+        """
+        Shrinks the stack down to the written frames, and saves the last one to the last path it got
+        """
+        frame_count = min(self.frame_index, self.max_frames)
+
+        if self.last_path is not None:
+            np.save(self.last_path, self.frames[frame_count - 1])
+
+        self.frames.flush()
+        del self.frames
+
+        frame_bytes = self.height * self.width * 4 * np.uint16().itemsize
+
+        with open(self.path, "r+b") as f:
+            write_frame_stack_header(f, frame_count, self.height, self.width)
+            f.truncate(FRAME_STACK_HEADER_BYTES + frame_count * frame_bytes)
+
+
+class EncoderPipe:
+    """
+    Converts every snapshot to RGBA, and writes it as a raw frame to the stdin of an encoder like ffmpeg
+    """
+
+    def __init__(self, command, height, width):
+        command = command.format(width=width, height=height)
+        print(f"Starting the encoder: {command}")
+
+        self.encoder = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE)
+
+        self.last_path = None
+        self.last_frame = np.zeros((height, width, 4), dtype=np.uint16)
+
+    def write(self, path, frame):
+        self.last_path = path
+        self.last_frame[...] = frame
+
+        self.encoder.stdin.write(lab_to_rgb(self.last_frame).tobytes())
+
+    def close(self):
+        """
+        Waits for the encoder to finish, and saves the last frame to the last path it got
+        """
+        if self.last_path is not None:
+            np.save(self.last_path, self.last_frame)
+
+        self.encoder.stdin.close()
+
+        if self.encoder.wait() != 0:
+            raise RuntimeError(
+                f"The encoder exited with status {self.encoder.returncode}"
+            )
+
+
+def add_parser_arguments(parser):
+    parser.add_argument(
+        "--frame-sink",
+        choices=("npy", "stack", "encoder"),
+        default="npy",
+        help="Where the snapshots go: npy saves every one to output_npy_path, stack writes them all as uint16 LAB frames into the single memory-mapped --frame-stack-path, and encoder converts them to RGBA and pipes them to the stdin of --encoder-command; the last snapshot always gets saved to output_npy_path",
+    )
+    parser.add_argument(
+        "--frame-stack-path",
+        type=Path,
+        help="The npy file that --frame-sink stack writes to, which defaults to output_npy_path with _frames appended to its name",
+    )
+    parser.add_argument(
+        "--frame-stack-frames",
+        type=int,
+        default=1000,
+        help="How many frames --frame-sink stack preallocates room for, after which its last frame keeps getting replaced by the newest one",
+    )
+    parser.add_argument(
+        "--encoder-command",
+        default="ffmpeg -y -loglevel error -f rawvideo -pix_fmt rgba -s {width}x{height} -framerate 30 -i - -c:v libvpx-vp9 -lossless 1 output/output.webm",
+        help="The command that --frame-sink encoder pipes raw RGBA frames to, where {width} and {height} get replaced by the size of the image",
+    )
+
+
+def create_frame_sink(args, width, height, first_frame):
+    """
+    Returns what --frame-sink writes the snapshots to, or None for the default of an npy per snapshot
+    """
+    if args.frame_sink == "stack":
+        frame_stack_path = args.frame_stack_path
+        if frame_stack_path is None:
+            output_npy_path = args.output_npy_path
+            frame_stack_path = output_npy_path.with_name(
+                f"{output_npy_path.stem}_frames{output_npy_path.suffix}"
+            )
+
+        print(f"Writing the frames to {frame_stack_path}")
+        return FrameStack(
+            frame_stack_path,
+            args.frame_stack_frames,
+            height,
+            width,
+            first_frame,
+        )
+
+    if args.frame_sink == "encoder":
+        return EncoderPipe(args.encoder_command, height, width)
+
+    return None
@@ -5,8 +5,13 @@ import numpy as np
 from PIL import Image
 from skimage import color
 
+import color_cache
 
-def verify(input_lab_npy_path, output_rgb_image_path):
+
+def convert_lab_to_rgb(pixels):
+    """
+    Converts the uint16 LAB pixels that rgb2lab.py outputs back to uint8 RGBA pixels
+    """
     # "The L* values range from 0 to 100; the a* and b* values range from -128 to 127."
     # https://scikit-image.org/docs/stable/api/skimage.color.html#skimage.color.lab2rgb
     signed_to_unsigned = 128
@@ -15,30 +20,46 @@ def verify(input_lab_npy_path, output_rgb_image_path):
     # 82 is the lowest integer value that works
     precision_compensation = 82
 
-    print("Loading input LAB image")
-    pixels = np.load(input_lab_npy_path)
-
-    print(f"Setting LAB values to a temporary value that have an alpha of 0")
+    # Setting LAB values to a temporary value that have an alpha of 0
     t = signed_to_unsigned * precision_compensation
-    pixels[pixels[:, :, 3] == 0] = [t, t, t, 0]
-
-    print("pixels.astype(np.float32)")
     pixels = pixels.astype(np.float32)
+    pixels[pixels[:, :, 3] == 0] = [t, t, t, 0]
 
-    print("/= precision_compensation")
     pixels[:, :, :3] /= precision_compensation
 
-    print("-= signed_to_unsigned")
     pixels[:, :, :3] -= signed_to_unsigned
 
-    print("Running lab2rgb()")
     pixels[:, :, :3] = color.lab2rgb(pixels[:, :, :3])
 
-    print("*= 255")
     pixels[:, :, :3] *= 255
 
-    print("Rounding to uint8")
-    pixels = np.round(pixels).astype(np.uint8)
+    return np.round(pixels).astype(np.uint8)
+
+
+def lab_to_rgb(pixels, cache_path=None):
+    """
+    Does what convert_lab_to_rgb() does, but only converts every unique color once,
+    since sorting never changes which colors there are
+    """
+    if not np.issubdtype(pixels.dtype, np.integer):
+        # The numpy backend of sort.py and --pixel-format float store float32 pixels,
+        # which can be packed as uint16 pixels as long as they are whole uint16 values
+        uint16_pixels = pixels.astype(np.uint16)
+        if not np.array_equal(uint16_pixels, pixels):
+            return convert_lab_to_rgb(pixels)
+        pixels = uint16_pixels
+
+    return color_cache.convert_unique_colors(
+        pixels, convert_lab_to_rgb, "lab2rgb", cache_path
+    )
+
+
+def verify(input_lab_npy_path, output_rgb_image_path, color_cache_path):
+    print("Loading input LAB image")
+    pixels = np.load(input_lab_npy_path)
+
+    print("Running lab_to_rgb()")
+    pixels = lab_to_rgb(pixels, color_cache_path)
 
     print("Saving output RGB image")
     Image.fromarray(pixels).save(output_rgb_image_path)
@@ -57,6 +78,17 @@ def add_parser_arguments(parser):
         type=Path,
         help="Path to the RGB output image",
     )
+    parser.add_argument(
+        "--color-cache-path",
+        type=Path,
+        default=color_cache.DEFAULT_COLOR_CACHE_PATH,
+        help="Where already converted colors are kept, so converting an image with the same colors again is nearly instant",
+    )
+    parser.add_argument(
+        "--no-color-cache",
+        action="store_true",
+        help="Convert every unique color, without reading or writing the color cache",
+    )
 
 
 def main():
@@ -66,7 +98,11 @@ def main():
     add_parser_arguments(parser)
     args = parser.parse_args()
 
-    verify(args.input_lab_npy_path, args.output_rgb_image_path)
+    verify(
+        args.input_lab_npy_path,
+        args.output_rgb_image_path,
+        None if args.no_color_cache else args.color_cache_path,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,410 @@
+import numpy as np
+from scipy import signal
+
+
+def round_up_to_power_of_2(a):
+    # Same as round_up_to_power_of_2() in sort.cl
+    if a & (a - 1):
+        return 1 << a.bit_length()
+
+    return a
+
+
+def lcg(modulus, vals, multiplier_rand, addition_rand):
+    # Mirrors lcg() in sort.cl, which does the multiplication by 2 in u32
+    multiplier = np.uint64(((int(multiplier_rand) * 2 + 1) & 0xFFFFFFFF) % modulus)
+    addition = np.uint64(int(addition_rand) % modulus)
+
+    return ((vals * multiplier) + addition) & np.uint64(modulus - 1)
+
+
+def get_shuffled_indices(opaque_pixel_count, rand1, rand2):
+    """
+    Returns get_shuffled_index() from sort.cl for every i in [0, opaque_pixel_count)
+    """
+    modulus = round_up_to_power_of_2(opaque_pixel_count)
+
+    shuffled = lcg(
+        modulus, np.arange(opaque_pixel_count, dtype=np.uint64), rand1, rand2
+    )
+
+    # Cycle-walk the indices that landed outside of the opaque pixels,
+    # just like the do-while loop in get_shuffled_index()
+    outside = np.flatnonzero(shuffled >= opaque_pixel_count)
+    while outside.size > 0:
+        shuffled[outside] = lcg(modulus, shuffled[outside], rand1, rand2)
+        outside = outside[shuffled[outside] >= opaque_pixel_count]
+
+    return shuffled.astype(np.int64)
+
+
+def hash_u32(x):
+    # Mirrors hash() in sort.cl
+    x = int(x) & 0xFFFFFFFF
+    x ^= x >> 16
+    x = (x * 0x7FEB352D) & 0xFFFFFFFF
+    x ^= x >> 15
+    x = (x * 0x846CA68B) & 0xFFFFFFFF
+    x ^= x >> 16
+    return x
+
+
+def get_window_offset(window_side, rand1, rand2):
+    # Mirrors the window_offset in sort_in_windows() in sort.cl
+    return (
+        hash_u32(rand1) % window_side,
+        hash_u32(int(rand1) ^ int(rand2)) % window_side,
+    )
+
+
+def get_window_pairs(width, height, window_side, window_offset, rand1, rand2, windows):
+    """
+    Returns the flat indices of the pixel pairs that sort_in_windows() in sort.cl
+    proposes in the given windows, along with the window and the number of every pair within its window
+    """
+    windows_per_row = width // window_side + 2
+
+    window_xs = (windows % windows_per_row) * window_side - window_offset[0]
+    window_ys = (windows // windows_per_row) * window_side - window_offset[1]
+
+    clipped_xs = np.maximum(window_xs, 0)
+    clipped_ys = np.maximum(window_ys, 0)
+    clipped_widths = np.maximum(
+        np.minimum(window_xs + window_side, width) - clipped_xs, 0
+    )
+    clipped_heights = np.maximum(
+        np.minimum(window_ys + window_side, height) - clipped_ys, 0
+    )
+
+    indices1 = [np.empty(0, dtype=np.int64)]
+    indices2 = [np.empty(0, dtype=np.int64)]
+    pair_windows = [np.empty(0, dtype=np.int64)]
+    pair_numbers = [np.empty(0, dtype=np.int64)]
+
+    # Only the windows on the edges are clipped, so there are just a few different sizes,
+    # and all windows of the same size get shuffled the same way
+    clipped_sizes = np.stack((clipped_widths, clipped_heights), axis=1)
+    for clipped_width, clipped_height in np.unique(clipped_sizes, axis=0):
+        clipped_area = int(clipped_width * clipped_height)
+        if clipped_area < 2:
+            continue
+
+        same_size = (clipped_widths == clipped_width) & (
+            clipped_heights == clipped_height
+        )
+
+        shuffled = get_shuffled_indices(clipped_area, rand1, rand2)[
+            : clipped_area // 2 * 2
+        ]
+
+        xs = clipped_xs[same_size, np.newaxis] + shuffled % clipped_width
+        ys = clipped_ys[same_size, np.newaxis] + shuffled // clipped_width
+        indices = ys * width + xs
+
+        indices1.append(indices[:, 0::2].reshape(-1))
+        indices2.append(indices[:, 1::2].reshape(-1))
+
+        pair_count = clipped_area // 2
+        pair_windows.append(np.repeat(windows[same_size], pair_count))
+        pair_numbers.append(np.tile(np.arange(pair_count), np.count_nonzero(same_size)))
+
+    return (
+        np.concatenate(indices1),
+        np.concatenate(indices2),
+        np.concatenate(pair_windows),
+        np.concatenate(pair_numbers),
+    )
+
+
+def get_phase_tiles(width, height, tile_side, phase):
+    """
+    Returns the tiles that sort_in_tiles() in sort.cl sorts in the given phase
+    """
+    tiles_per_row = width // tile_side + 2
+    tiles_per_column = height // tile_side + 2
+
+    tile_xs = np.arange(phase % 2, tiles_per_row, 2)
+    tile_ys = np.arange(phase // 2, tiles_per_column, 2)
+
+    return (tile_ys[:, np.newaxis] * tiles_per_row + tile_xs).reshape(-1)
+
+
+def get_squared_color_differences(pixels, neighbor_pixels):
+    diff = pixels[:, :3] - neighbor_pixels[:, :3]
+    return np.einsum("ij,ij->i", diff, diff)
+
+
+def get_score_differences(neighbor_totals, pixels1, pixels2, indices1, indices2):
+    """
+    Vectorized get_score_difference() from sort.cl
+    """
+    i1_neighbor_totals = neighbor_totals[indices1]
+    i1_old_scores = get_squared_color_differences(pixels1, i1_neighbor_totals)
+    i1_new_scores = get_squared_color_differences(pixels2, i1_neighbor_totals)
+    i1_score_differences = -i1_old_scores + i1_new_scores
+
+    i2_neighbor_totals = neighbor_totals[indices2]
+    i2_old_scores = get_squared_color_differences(pixels2, i2_neighbor_totals)
+    i2_new_scores = get_squared_color_differences(pixels1, i2_neighbor_totals)
+    i2_score_differences = -i2_old_scores + i2_new_scores
+
+    return i1_score_differences + i2_score_differences
+
+
+def get_disc_offsets(kernel):
+    """
+    Returns the (dy, dx) offsets and weights of all nonzero kernel taps
+    """
+    kernel_radius = kernel.shape[0] // 2
+    dys, dxs = np.nonzero(kernel)
+    weights = kernel[dys, dxs]
+    return dys - kernel_radius, dxs - kernel_radius, weights
+
+
+# How many (swapped pixel, kernel tap) pairs get scattered at once,
+# which bounds the memory used by scatter_deltas()
+SCATTER_CHUNK_SIZE = 1 << 22
+
+
+def scatter_deltas(neighbor_totals, deltas, indices, width, height, disc_offsets):
+    """
+    Adds delta * weight to the neighbor total of every pixel in the disc
+    around each of the indices, like update_neighbors() in cpp/main.cpp
+    """
+    dys, dxs, weights = disc_offsets
+
+    chunk_size = max(1, SCATTER_CHUNK_SIZE // weights.size)
+
+    for start in range(0, indices.size, chunk_size):
+        chunk_indices = indices[start : start + chunk_size]
+        chunk_deltas = deltas[start : start + chunk_size]
+
+        ys = (chunk_indices // width)[:, np.newaxis] + dys
+        xs = (chunk_indices % width)[:, np.newaxis] + dxs
+
+        inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+
+        neighbor_indices = (ys * width + xs)[inside]
+        tap_weights = np.broadcast_to(weights, inside.shape)[inside]
+        swap_numbers = np.nonzero(inside)[0]
+
+        for channel in range(3):
+            neighbor_totals[:, channel] += np.bincount(
+                neighbor_indices,
+                weights=tap_weights * chunk_deltas[swap_numbers, channel],
+                minlength=width * height,
+            )
+
+
+def refresh_neighbor_totals(
+    neighbor_totals, deltas, indices, width, height, kernel, disc_offsets
+):
+    """
+    Adds the contribution of the changed pixels at indices to neighbor_totals
+    """
+    # Scattering every swap's disc is cheap while few pixels change,
+    # but a single FFT convolution of the delta image wins once lots of them do
+    scatter_cost = indices.size * disc_offsets[2].size
+    if scatter_cost < width * height * 64:
+        scatter_deltas(neighbor_totals, deltas, indices, width, height, disc_offsets)
+        return
+
+    delta_image = np.zeros((width * height, 3), dtype=np.float32)
+    delta_image[indices] = deltas[:, :3]
+    delta_image = delta_image.reshape(height, width, 3)
+
+    neighbor_totals[:, :3] += signal.fftconvolve(
+        delta_image, kernel[:, :, :1], mode="same", axes=(0, 1)
+    ).reshape(-1, 3)
+
+
+def sort_batch(
+    pixels, neighbor_totals, indices1, indices2, width, height, kernel, disc_offsets
+):
+    """
+    Attempts to swap every pair of pixels (indices1[j], indices2[j]) at once.
+    The pairs must be disjoint, which the shuffled indices guarantee.
+
+    Returns the number of accepted swaps, and the sum of their score differences.
+    """
+    pixels1 = pixels[indices1]
+    pixels2 = pixels[indices2]
+
+    score_differences = get_score_differences(
+        neighbor_totals, pixels1, pixels2, indices1, indices2
+    )
+    swapping = score_differences < 0
+
+    indices1 = indices1[swapping]
+    indices2 = indices2[swapping]
+    pixels1 = pixels1[swapping]
+    pixels2 = pixels2[swapping]
+
+    pixels[indices1] = pixels2
+    pixels[indices2] = pixels1
+
+    deltas = pixels2 - pixels1
+
+    refresh_neighbor_totals(
+        neighbor_totals,
+        np.concatenate((deltas, -deltas)),
+        np.concatenate((indices1, indices2)),
+        width,
+        height,
+        kernel,
+        disc_offsets,
+    )
+
+    return indices1.size, float(score_differences[swapping].sum())
+
+
+def sort(
+    pixels,
+    neighbor_totals,
+    width,
+    height,
+    kernel,
+    disc_offsets,
+    normal_to_opaque_index_lut,
+    iterations,
+    rand1,
+    rand2,
+    batch_size,
+    window_side=None,
+):
+    """
+    Does what a single call of the sort kernel in sort.cl does,
+    on flattened (width * height, 4) pixels and neighbor_totals,
+    or what the sort_in_windows kernel does if window_side isn't None
+
+    Returns the number of accepted swaps, and the sum of their score differences.
+    """
+    opaque_pixel_count = normal_to_opaque_index_lut.size
+
+    accepted_swaps = 0
+    score_difference = 0
+
+    for _ in range(iterations):
+        # Numpy does unsigned wraparound for us
+        rand1 = np.uint32(rand1 + 1)
+
+        if window_side is None:
+            shuffled = get_shuffled_indices(opaque_pixel_count, rand1, rand2)
+            shuffled = normal_to_opaque_index_lut[shuffled]
+            indices1 = shuffled[0::2]
+            indices2 = shuffled[1::2]
+        else:
+            windows_per_row = width // window_side + 2
+            windows_per_column = height // window_side + 2
+
+            indices1, indices2, _, _ = get_window_pairs(
+                width,
+                height,
+                window_side,
+                get_window_offset(window_side, rand1, rand2),
+                rand1,
+                rand2,
+                np.arange(windows_per_row * windows_per_column),
+            )
+
+            opaque = (pixels[indices1, 3] != 0) & (pixels[indices2, 3] != 0)
+            indices1 = indices1[opaque]
+            indices2 = indices2[opaque]
+
+        pair_count = indices1.size
+        if batch_size > 0:
+            iteration_batch_size = batch_size
+        else:
+            iteration_batch_size = max(pair_count, 1)
+
+        for start in range(0, pair_count, iteration_batch_size):
+            end = min(start + iteration_batch_size, pair_count)
+
+            batch_accepted_swaps, batch_score_difference = sort_batch(
+                pixels,
+                neighbor_totals,
+                indices1[start:end],
+                indices2[start:end],
+                width,
+                height,
+                kernel,
+                disc_offsets,
+            )
+
+            accepted_swaps += batch_accepted_swaps
+            score_difference += batch_score_difference
+
+    return accepted_swaps, score_difference
+
+
+def sort_in_tiles(
+    pixels,
+    neighbor_totals,
+    width,
+    height,
+    kernel,
+    disc_offsets,
+    iterations,
+    rand1,
+    rand2,
+    tile_side,
+    workgroup_size,
+):
+    """
+    Does what the four calls of the sort_in_tiles kernel in sort.cl do, one for every phase
+
+    Returns the number of accepted swaps, and the sum of their score differences.
+    """
+    accepted_swaps = 0
+    score_difference = 0
+
+    tile_offset = get_window_offset(tile_side, rand1, rand2)
+
+    for phase in range(4):
+        tiles = get_phase_tiles(width, height, tile_side, phase)
+
+        iteration_rand1 = rand1
+
+        for _ in range(iterations):
+            # Numpy does unsigned wraparound for us
+            iteration_rand1 = np.uint32(iteration_rand1 + 1)
+
+            indices1, indices2, _, pair_numbers = get_window_pairs(
+                width,
+                height,
+                tile_side,
+                tile_offset,
+                iteration_rand1,
+                rand2,
+                tiles,
+            )
+
+            # Every work-group goes through the pairs of its tile workgroup_size at a time,
+            # and the tiles of a phase are too far apart to affect each other,
+            # so doing the same chunk of every tile at once gives the same result
+            chunks = pair_numbers // workgroup_size
+
+            for chunk in range(chunks.max(initial=-1) + 1):
+                in_chunk = chunks == chunk
+                chunk_indices1 = indices1[in_chunk]
+                chunk_indices2 = indices2[in_chunk]
+
+                opaque = (pixels[chunk_indices1, 3] != 0) & (
+                    pixels[chunk_indices2, 3] != 0
+                )
+
+                chunk_accepted_swaps, chunk_score_difference = sort_batch(
+                    pixels,
+                    neighbor_totals,
+                    chunk_indices1[opaque],
+                    chunk_indices2[opaque],
+                    width,
+                    height,
+                    kernel,
+                    disc_offsets,
+                )
+
+                accepted_swaps += chunk_accepted_swaps
+                score_difference += chunk_score_difference
+
+    return accepted_swaps, score_difference
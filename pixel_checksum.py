@@ -0,0 +1,41 @@
+import numpy as np
+
+import color_cache
+
+
+def hash_pixels(pixels):
+    """
+    Returns the uint64 hash of every pixel, exactly like hash_pixel() in sort.cl does,
+    which is splitmix64's finalizer applied to the 4 uint16 values of the pixel packed into a uint64
+    """
+    # Source: https://prng.di.unimi.it/splitmix64.c
+    z = color_cache.pack_colors(pixels.astype(np.uint16)).astype(np.uint64)
+    z += np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def combine_checksums(checksums):
+    """
+    Combines the (sum, xor) checksums of several parts of an image into that of the whole image
+    """
+    checksums = np.array(checksums, dtype=np.uint64).reshape(-1, 2)
+
+    # The uint64 sum wraps around, just like it does in sort.cl
+    return (
+        int(np.add.reduce(checksums[:, 0], dtype=np.uint64)),
+        int(np.bitwise_xor.reduce(checksums[:, 1])),
+    )
+
+
+def get_checksum(pixels):
+    """
+    Returns the sum and XOR of the hashes of every pixel.
+    Neither depends on where the pixels are, so sorting never changes them,
+    but a pixel that got duplicated or lost almost certainly does.
+    """
+    hashes = hash_pixels(pixels).ravel()
+    return combine_checksums(
+        [np.add.reduce(hashes, dtype=np.uint64), np.bitwise_xor.reduce(hashes)]
+    )
@@ -0,0 +1,237 @@
+import csv
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import pyopencl as cl
+
+# Beyond this many, events only get added to the summary, so long runs don't run out of memory
+MAX_TRACE_EVENTS = 100_000
+
+# Once this many OpenCL events haven't been looked at yet, the finished ones get collected
+MAX_PENDING_EVENTS = 1000
+
+
+class Profiler:
+    """
+    Collects how long every setup step took on the host, and how long every kernel launch and copy took on the device.
+
+    A disabled profiler does nothing, so callers don't have to check whether --profile was passed.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start_ns = time.perf_counter_ns()
+
+        # (category, name, thread, start_ns, duration_ns) tuples, relative to start_ns
+        self.trace_events = []
+
+        # Maps (category, name) to [count, total_ns, max_ns]
+        self.totals = {}
+
+        # (name, event, host_ns) tuples of OpenCL events that might not have finished yet
+        self.pending_events = deque()
+
+        # Every context's device clock has its own zero point, so this maps it to the host's clock
+        self.device_clock_offsets = {}
+
+        # Steps can be timed on the snapshot writer's thread too
+        self.lock = threading.Lock()
+
+    def get_queue_properties(self):
+        """
+        Returns the properties every cl.CommandQueue has to be created with
+        """
+        if self.enabled:
+            return cl.command_queue_properties.PROFILING_ENABLE
+        return 0
+
+    def add(self, category, name, thread, start_ns, duration_ns):
+        with self.lock:
+            if len(self.trace_events) < MAX_TRACE_EVENTS:
+                self.trace_events.append(
+                    (category, name, thread, start_ns, duration_ns)
+                )
+
+            totals = self.totals.setdefault((category, name), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += duration_ns
+            totals[2] = max(totals[2], duration_ns)
+
+    @contextmanager
+    def step(self, name):
+        """
+        Times the host-side step inside of the with-block
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(
+                "host",
+                name,
+                threading.current_thread().name,
+                start_ns - self.start_ns,
+                time.perf_counter_ns() - start_ns,
+            )
+
+    def timed(self, name, function):
+        """
+        Returns the function, wrapped so that every call of it is timed as a step
+        """
+        if not self.enabled:
+            return function
+
+        def timed_function(*args, **kwargs):
+            with self.step(name):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    def add_event(self, name, event):
+        """
+        Times the OpenCL kernel launch or copy of the event on the device, once it has finished
+        """
+        if not self.enabled:
+            return event
+
+        self.pending_events.append((name, event, time.perf_counter_ns()))
+
+        if len(self.pending_events) > MAX_PENDING_EVENTS:
+            self.collect_events(wait=False)
+
+        return event
+
+    def collect_events(self, wait):
+        """
+        Reads the device-side start and end times of the pending events,
+        stopping at the first unfinished one, unless wait is True
+        """
+        while self.pending_events:
+            name, event, host_ns = self.pending_events[0]
+
+            if (
+                not wait
+                and event.command_execution_status
+                != cl.command_execution_status.COMPLETE
+            ):
+                break
+
+            self.pending_events.popleft()
+            event.wait()
+
+            context = event.get_info(cl.event_info.CONTEXT).int_ptr
+
+            # The first event of every context lines the device clock up with when the event was enqueued
+            offset = self.device_clock_offsets.setdefault(
+                context, host_ns - self.start_ns - event.profile.queued
+            )
+
+            queue = event.get_info(cl.event_info.COMMAND_QUEUE).int_ptr
+
+            self.add(
+                "device",
+                name,
+                f"queue {queue:#x}",
+                event.profile.start + offset,
+                event.profile.end - event.profile.start,
+            )
+
+    def write(self, profile_path):
+        """
+        Writes every collected step and event as a Chrome trace if the path ends in .json, and as CSV otherwise
+        """
+        self.collect_events(wait=True)
+
+        profile_path = Path(profile_path)
+
+        with self.lock:
+            trace_events = sorted(self.trace_events, key=lambda event: event[3])
+
+        if profile_path.suffix == ".json":
+            # Can be opened with chrome://tracing or https://ui.perfetto.dev, which want numeric ids,
+            # so the names of the categories and threads are given by metadata events
+            # Source: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+            pids = {}
+            tids = {}
+            chrome_trace_events = []
+
+            for category, name, thread, start_ns, duration_ns in trace_events:
+                if category not in pids:
+                    pids[category] = len(pids)
+                    chrome_trace_events.append(
+                        {
+                            "name": "process_name",
+                            "ph": "M",
+                            "pid": pids[category],
+                            "args": {"name": category},
+                        }
+                    )
+
+                if (category, thread) not in tids:
+                    tids[category, thread] = len(tids)
+                    chrome_trace_events.append(
+                        {
+                            "name": "thread_name",
+                            "ph": "M",
+                            "pid": pids[category],
+                            "tid": tids[category, thread],
+                            "args": {"name": thread},
+                        }
+                    )
+
+                chrome_trace_events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "pid": pids[category],
+                        "tid": tids[category, thread],
+                        "ts": start_ns / 1000,
+                        "dur": duration_ns / 1000,
+                    }
+                )
+
+            with open(profile_path, "w") as f:
+                json.dump({"traceEvents": chrome_trace_events}, f)
+        else:
+            with open(profile_path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(
+                    ("category", "name", "thread", "start_seconds", "duration_seconds")
+                )
+                for category, name, thread, start_ns, duration_ns in trace_events:
+                    writer.writerow(
+                        (category, name, thread, start_ns / 1e9, duration_ns / 1e9)
+                    )
+
+        print(f"Wrote the profile to {profile_path}")
+
+    def print_summary(self):
+        """
+        Prints the total time of every step and event, from the most to the least time spent
+        """
+        self.collect_events(wait=True)
+
+        wall_ns = time.perf_counter_ns() - self.start_ns
+
+        print(
+            f"{'category':<8} {'name':<40} {'count':>9} {'total s':>10} {'mean ms':>10} {'max ms':>10} {'% of run':>8}"
+        )
+
+        with self.lock:
+            totals = sorted(
+                self.totals.items(), key=lambda item: item[1][1], reverse=True
+            )
+
+        for (category, name), (count, total_ns, max_ns) in totals:
+            print(
+                f"{category:<8} {name:<40} {count:>9} {total_ns / 1e9:>10.3f} {total_ns / count / 1e6:>10.3f} {max_ns / 1e6:>10.3f} {total_ns / wall_ns:>8.1%}"
+            )
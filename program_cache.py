@@ -0,0 +1,109 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+
+import pyopencl as cl
+
+# Programs that were already built in this process, so sorting several images
+# of the same size in one process, like batch.py does, only builds them once per context
+built_programs = {}
+
+
+def get_cache_key(device, source, options):
+    """
+    Hashes everything that can change the compiled binary
+    """
+    key = hashlib.sha256()
+
+    for part in (
+        source,
+        *options,
+        device.platform.name,
+        device.platform.version,
+        device.name,
+        device.version,
+        device.driver_version,
+        cl.VERSION_TEXT,
+    ):
+        key.update(part.encode())
+        # Separates the parts, so ("ab", "c") and ("a", "bc") get different keys
+        key.update(b"\0")
+
+    return key.hexdigest()
+
+
+def evict_least_recently_used(cache_path, max_bytes):
+    """
+    Deletes the least recently used binaries until the cache fits in max_bytes,
+    but never the most recently used one, which was just built
+    """
+    binary_paths = sorted(
+        cache_path.glob("*.bin"), key=lambda binary_path: binary_path.stat().st_mtime
+    )
+
+    total_bytes = sum(binary_path.stat().st_size for binary_path in binary_paths)
+
+    for binary_path in binary_paths[:-1]:
+        if total_bytes <= max_bytes:
+            break
+
+        total_bytes -= binary_path.stat().st_size
+        binary_path.unlink(missing_ok=True)
+
+
+def build_program(ctx, source, options, cache_path, max_bytes):
+    """
+    Builds the program from a cached binary if there is one,
+    and otherwise builds it from source and caches its binary.
+
+    Passing None as the cache_path always builds from source.
+    """
+    built_program = built_programs.get((ctx, source, options))
+    if built_program is not None:
+        return built_program
+
+    start_time = time.time()
+
+    device = ctx.devices[0]
+
+    if cache_path is None:
+        prg = cl.Program(ctx, source).build(options=options)
+        print(f"Built from source in {time.time() - start_time:.2f} seconds")
+        built_programs[(ctx, source, options)] = prg
+        return prg
+
+    cache_path = Path(cache_path)
+    cache_path.mkdir(parents=True, exist_ok=True)
+
+    binary_path = cache_path / f"{get_cache_key(device, source, options)}.bin"
+
+    if binary_path.is_file():
+        try:
+            prg = cl.Program(ctx, [device], [binary_path.read_bytes()]).build(
+                options=options
+            )
+
+            # The modification time is what the eviction uses to tell how recently it was used
+            os.utime(binary_path)
+
+            print(f"Program cache hit, took {time.time() - start_time:.2f} seconds")
+            built_programs[(ctx, source, options)] = prg
+            return prg
+        except cl.Error as e:
+            # A driver update can reject an old binary, even with the same version strings
+            print(f"Ignoring the cached binary, since it failed to load: {e}")
+
+    prg = cl.Program(ctx, source).build(options=options)
+
+    # Writing to a temporary file first means that processes running at the same time
+    # can never read a half-written binary
+    tmp_binary_path = binary_path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_binary_path.write_bytes(prg.get_info(cl.program_info.BINARIES)[0])
+    os.replace(tmp_binary_path, binary_path)
+
+    evict_least_recently_used(cache_path, max_bytes)
+
+    print(f"Program cache miss, took {time.time() - start_time:.2f} seconds")
+    built_programs[(ctx, source, options)] = prg
+    return prg
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def get_blocks(pixels, block_side):
+    """
+    Returns a (block count, block_side, block_side, 4) copy of the pixels
+    that are covered by whole blocks, in row-major block order
+    """
+    coarse_height = pixels.shape[0] // block_side
+    coarse_width = pixels.shape[1] // block_side
+
+    blocks = pixels[: coarse_height * block_side, : coarse_width * block_side]
+    blocks = blocks.reshape(coarse_height, block_side, coarse_width, block_side, 4)
+    return blocks.swapaxes(1, 2).reshape(-1, block_side, block_side, 4)
+
+
+def get_coarse_pixels(pixels, block_side):
+    """
+    Shrinks every block_side x block_side block of pixels into a single pixel with its mean color.
+
+    Only fully opaque blocks get moved around, so every other block becomes transparent.
+    The alpha channel of the opaque ones holds their block index + 1,
+    which the sorter carries along with every swap, so the sorted coarse pixels
+    tell apply_coarse_pixels() where each block ended up.
+    """
+    coarse_height = pixels.shape[0] // block_side
+    coarse_width = pixels.shape[1] // block_side
+
+    blocks = get_blocks(pixels, block_side)
+
+    coarse_pixels = blocks.mean(axis=(1, 2), dtype=np.float64).astype(np.float32)
+
+    opaque_block_indices = np.flatnonzero((blocks[..., 3] != 0).all(axis=(1, 2)))
+
+    # The sorter pairs up all opaque pixels, so an odd one out has to stay where it is
+    if opaque_block_indices.size % 2 != 0:
+        opaque_block_indices = opaque_block_indices[:-1]
+
+    coarse_pixels[..., 3] = 0
+    coarse_pixels[opaque_block_indices, 3] = opaque_block_indices + 1
+
+    transparent = coarse_pixels[..., 3] == 0
+    coarse_pixels[transparent] = 0
+
+    return coarse_pixels.reshape(coarse_height, coarse_width, 4)
+
+
+def apply_coarse_pixels(pixels, coarse_pixels, block_side):
+    """
+    Moves the blocks of pixels to wherever their coarse pixel got sorted to
+    """
+    source_block_indices = coarse_pixels[..., 3].reshape(-1).astype(np.int64) - 1
+    moved = source_block_indices >= 0
+
+    blocks = get_blocks(pixels, block_side)
+    sorted_blocks = blocks.copy()
+    sorted_blocks[moved] = blocks[source_block_indices[moved]]
+
+    coarse_height, coarse_width = coarse_pixels.shape[:2]
+
+    pixels[: coarse_height * block_side, : coarse_width * block_side] = (
+        sorted_blocks.reshape(coarse_height, coarse_width, block_side, block_side, 4)
+        .swapaxes(1, 2)
+        .reshape(coarse_height * block_side, coarse_width * block_side, 4)
+    )
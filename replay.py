@@ -0,0 +1,211 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+import frame_sink
+import sort
+import swap_log
+
+
+def get_swap_position(target_seconds, prev_seconds, seconds, block_start, record_count):
+    """
+    Returns how many swaps had been done target_seconds into the run,
+    assuming the swaps of the block were spread evenly between the flushes at prev_seconds and seconds
+    """
+    fraction = (target_seconds - prev_seconds) / max(seconds - prev_seconds, 1e-9)
+    return block_start + round(min(max(fraction, 0), 1) * record_count)
+
+
+def replay(args):
+    print("Loading input npy...")
+    pixels = np.load(args.input_npy_path)
+    height, width = pixels.shape[:2]
+
+    # The swaps are indices into the flattened pixels
+    flat_pixels = pixels.reshape(-1, 4)
+
+    writing_frames = args.every_swaps is not None or args.every_seconds is not None
+    sink = (
+        frame_sink.create_frame_sink(args, width, height, 0) if writing_frames else None
+    )
+
+    frames = 0
+    swaps = 0
+
+    def write_frame():
+        nonlocal frames
+
+        if sink is None:
+            np.save(
+                sort.get_output_npy_path(
+                    args.output_npy_path,
+                    True,
+                    args.saved_image_leading_zero_count,
+                    frames,
+                ),
+                pixels,
+            )
+        else:
+            sink.write(args.output_npy_path, pixels)
+
+        frames += 1
+
+    def get_next_positions(prev_seconds, seconds, block_start, record_count):
+        """
+        Returns the swap positions in this block where the next frame is due, and where the replay stops,
+        which are None if that doesn't happen in this block
+        """
+        frame_position = None
+        if args.every_swaps is not None:
+            frame_position = (frames + 1) * args.every_swaps
+        elif (
+            args.every_seconds is not None
+            and (frames + 1) * args.every_seconds <= seconds
+        ):
+            frame_position = get_swap_position(
+                (frames + 1) * args.every_seconds,
+                prev_seconds,
+                seconds,
+                block_start,
+                record_count,
+            )
+
+        stop_position = None
+        if args.at_swaps is not None:
+            stop_position = args.at_swaps
+        elif args.at_seconds is not None and args.at_seconds <= seconds:
+            stop_position = get_swap_position(
+                args.at_seconds, prev_seconds, seconds, block_start, record_count
+            )
+
+        return frame_position, stop_position
+
+    print("Replaying the swap log...")
+    with open(args.swap_log_path, "rb") as f:
+        header = swap_log.read_header(f)
+
+        if (header["height"], header["width"]) != (height, width):
+            raise ValueError(
+                f"The swap log is of a {header['width']}x{header['height']} image, but the input npy is {width}x{height}"
+            )
+        if header["pixels_sha256"] != swap_log.get_pixels_sha256(pixels):
+            raise ValueError(
+                "The swap log didn't start from the pixels of the input npy"
+            )
+
+        prev_seconds = 0
+        stopped = False
+
+        for seconds, records in swap_log.read_blocks(f):
+            block_start = swaps
+            block_end = swaps + len(records)
+
+            while True:
+                frame_position, stop_position = get_next_positions(
+                    prev_seconds, seconds, block_start, len(records)
+                )
+
+                positions = [
+                    position
+                    for position in (frame_position, stop_position)
+                    if position is not None and position <= block_end
+                ]
+                if not positions:
+                    swap_log.apply_swaps(flat_pixels, records[swaps - block_start :])
+                    swaps = block_end
+                    break
+
+                position = min(positions)
+                swap_log.apply_swaps(
+                    flat_pixels, records[swaps - block_start : position - block_start]
+                )
+                swaps = position
+
+                if position == stop_position:
+                    stopped = True
+                    break
+
+                write_frame()
+
+            if stopped:
+                break
+
+            prev_seconds = seconds
+
+    if sink is not None:
+        sink.close()
+
+    np.save(args.output_npy_path, pixels)
+
+    print(f"Replayed {swaps} swaps, and wrote {frames} frames")
+
+
+def add_parser_arguments(parser):
+    parser.add_argument(
+        "input_npy_path",
+        type=Path,
+        help="The input npy that sort.py was started with",
+    )
+    parser.add_argument(
+        "swap_log_path",
+        type=Path,
+        help="The log that sort.py's --swap-log-path wrote",
+    )
+    parser.add_argument(
+        "output_npy_path",
+        type=Path,
+        help="Where the pixels at the end of the replay get saved, which can then be passed to lab2rgb.py",
+    )
+
+    frames = parser.add_mutually_exclusive_group()
+    frames.add_argument(
+        "--every-swaps",
+        type=int,
+        help="Also write a frame every time this many more swaps have been replayed",
+    )
+    frames.add_argument(
+        "--every-seconds",
+        type=float,
+        help="Also write a frame for every this many seconds of the original run",
+    )
+
+    stop = parser.add_mutually_exclusive_group()
+    stop.add_argument(
+        "--at-swaps",
+        type=int,
+        help="Stop the replay once this many swaps have been replayed, instead of at the end of the log",
+    )
+    stop.add_argument(
+        "--at-seconds",
+        type=float,
+        help="Stop the replay at this many seconds into the original run, instead of at the end of the log",
+    )
+
+    parser.add_argument(
+        "-z",
+        "--saved-image-leading-zero-count",
+        type=int,
+        default=4,
+        help="The number of leading zeros of the frames that --frame-sink npy saves",
+    )
+    frame_sink.add_parser_arguments(parser)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_parser_arguments(parser)
+    args = parser.parse_args()
+
+    if (args.every_swaps is not None and args.every_swaps <= 0) or (
+        args.every_seconds is not None and args.every_seconds <= 0
+    ):
+        parser.error("--every-swaps and --every-seconds have to be positive")
+
+    replay(args)
+
+
+if __name__ == "__main__":
+    main()
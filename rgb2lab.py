@@ -5,8 +5,13 @@ import numpy as np
 from PIL import Image
 from skimage import color
 
+import color_cache
 
-def verify(input_rgb_image_path, output_lab_npy_path):
+
+def convert_rgb_to_lab(pixels):
+    """
+    Converts uint8 RGBA pixels to the uint16 LAB pixels that sort.py takes
+    """
     # "The L* values range from 0 to 100; the a* and b* values range from -128 to 127."
     # https://scikit-image.org/docs/stable/api/skimage.color.html#skimage.color.lab2rgb
     signed_to_unsigned = 128
@@ -15,29 +20,43 @@ def verify(input_rgb_image_path, output_lab_npy_path):
     # 82 is the lowest integer value that works
     precision_compensation = 82
 
-    print("Loading input RGB image")
-    input_img = Image.open(input_rgb_image_path).convert("RGBA")
-    pixels = np.array(input_img, dtype=np.float32)
+    pixels = pixels.astype(np.float32)
 
-    print("/= 255")
     # I do [:, :, :3] everywhere so only RGB is affected, and not a potential A
     pixels[:, :, :3] /= 255
 
-    print("Running rgb2lab()")
     pixels[:, :, :3] = color.rgb2lab(pixels[:, :, :3])
 
-    print("+= signed_to_unsigned")
     pixels[:, :, :3] += signed_to_unsigned
 
-    print("*= precision_compensation")
     pixels[:, :, :3] *= precision_compensation
 
-    print("Rounding to uint16")
     pixels = np.round(pixels).astype(np.uint16)
 
-    print("Setting LAB values to 0 that have an alpha of 0")
+    # Setting LAB values to 0 that have an alpha of 0
     pixels[pixels[:, :, 3] == 0] = 0
 
+    return pixels
+
+
+def rgb_to_lab(pixels, cache_path=None):
+    """
+    Does what convert_rgb_to_lab() does, but only converts every unique color once,
+    since images like palettes have way fewer colors than pixels
+    """
+    return color_cache.convert_unique_colors(
+        pixels, convert_rgb_to_lab, "rgb2lab", cache_path
+    )
+
+
+def verify(input_rgb_image_path, output_lab_npy_path, color_cache_path):
+    print("Loading input RGB image")
+    input_img = Image.open(input_rgb_image_path).convert("RGBA")
+    pixels = np.array(input_img, dtype=np.uint8)
+
+    print("Running rgb_to_lab()")
+    pixels = rgb_to_lab(pixels, color_cache_path)
+
     print("Saving output LAB image")
     np.save(output_lab_npy_path, pixels)
 
@@ -55,6 +74,17 @@ def add_parser_arguments(parser):
         type=Path,
         help="Path to the LAB output npy",
     )
+    parser.add_argument(
+        "--color-cache-path",
+        type=Path,
+        default=color_cache.DEFAULT_COLOR_CACHE_PATH,
+        help="Where already converted colors are kept, so converting an image with the same colors again is nearly instant",
+    )
+    parser.add_argument(
+        "--no-color-cache",
+        action="store_true",
+        help="Convert every unique color, without reading or writing the color cache",
+    )
 
 
 def main():
@@ -64,7 +94,11 @@ def main():
     add_parser_arguments(parser)
     args = parser.parse_args()
 
-    verify(args.input_rgb_image_path, args.output_lab_npy_path)
+    verify(
+        args.input_rgb_image_path,
+        args.output_lab_npy_path,
+        None if args.no_color_cache else args.color_cache_path,
+    )
 
 
 if __name__ == "__main__":
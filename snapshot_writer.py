@@ -0,0 +1,84 @@
+import queue
+import threading
+
+import numpy as np
+
+
+class SnapshotWriter:
+    """
+    Writes snapshots to disk on a background thread.
+
+    Snapshots are read into a fixed pool of reusable host buffers.
+    Once every buffer is waiting to be written, acquire() blocks,
+    so a slow disk slows down the sorting rather than eating up all memory.
+    """
+
+    def __init__(self, buffer_count, shape, dtype, write=np.save):
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in range(buffer_count)]
+        self.write = write
+
+        self.free_buffer_indices = queue.Queue()
+        for buffer_index in range(buffer_count):
+            self.free_buffer_indices.put(buffer_index)
+
+        self.pending = queue.Queue()
+        self.exception = None
+
+        self.thread = threading.Thread(target=self._write_snapshots, daemon=True)
+        self.thread.start()
+
+    def acquire(self):
+        """
+        Returns the index of a free buffer and the buffer itself
+        """
+        buffer_index = self.free_buffer_indices.get()
+        return buffer_index, self.buffers[buffer_index]
+
+    def submit(self, buffer_index, path, event=None):
+        """
+        Writes the buffer to path once the OpenCL event filling it has completed
+        """
+        if self.exception is not None:
+            raise self.exception
+
+        self.pending.put((buffer_index, path, event))
+
+    def flush(self):
+        """
+        Waits until every submitted snapshot has been written, without stopping the thread
+        """
+        # A buffer only becomes free again once its snapshot has been written
+        buffer_indices = [self.free_buffer_indices.get() for _ in self.buffers]
+        for buffer_index in buffer_indices:
+            self.free_buffer_indices.put(buffer_index)
+
+        if self.exception is not None:
+            raise self.exception
+
+    def close(self):
+        """
+        Waits until every submitted snapshot has been written
+        """
+        self.pending.put(None)
+        self.thread.join()
+
+        if self.exception is not None:
+            raise self.exception
+
+    def _write_snapshots(self):
+        while True:
+            snapshot = self.pending.get()
+            if snapshot is None:
+                break
+
+            buffer_index, path, event = snapshot
+
+            try:
+                if event is not None:
+                    event.wait()
+
+                self.write(path, self.buffers[buffer_index])
+            except Exception as e:
+                self.exception = e
+
+            self.free_buffer_indices.put(buffer_index)
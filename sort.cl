@@ -7,45 +7,30 @@
 #define OPAQUE_PIXEL_COUNT 0
 #define ITERATIONS_IN_KERNEL_PER_CALL 0
 #define KERNEL_RADIUS 0
+#define NEIGHBOR_TOTALS_TILE_SIDE 0
 #endif
 
 #define KERNEL_RADIUS_SQUARED (KERNEL_RADIUS * KERNEL_RADIUS)
 
+// The neighbor totals have KERNEL_RADIUS pixels of padding on every side,
+// so swaps near the border can add their deltas to them without any bounds checks
+#define PADDED_WIDTH (WIDTH + KERNEL_RADIUS * 2)
+
 typedef uint u32;
 typedef ulong u64;
 
+// When PIXELS_UINT16 is defined, the pixels are stored as the CL_UNSIGNED_INT16 LAB values rgb2lab.py outputs,
+// which takes half the memory of CL_FLOAT, while every value can still be converted to a float exactly
 void set_pixel(
 	read_write image2d_t pixels,
 	int2 pos,
 	float4 pixel
 ) {
+#ifdef PIXELS_UINT16
+	write_imageui(pixels, pos, convert_uint4(pixel));
+#else
 	write_imagef(pixels, pos, pixel);
-}
-
-void mark_neighbors_as_updated(
-	read_write image2d_t updated,
-	int2 center
-) {
-	// TODO: By padding the input image, it should be possible to get rid of these bounds variables
-	int dy_min = -min(center.y, KERNEL_RADIUS);
-	int dy_max = min(HEIGHT - 1 - center.y, KERNEL_RADIUS);
-
-	int dx_min = -min(center.x, KERNEL_RADIUS);
-	int dx_max = min(WIDTH - 1 - center.x, KERNEL_RADIUS);
-
-	for (int dy = dy_min; dy <= dy_max; dy++) {
-		for (int dx = dx_min; dx <= dx_max; dx++) {
-
-			int2 neighbor = (int2){center.x + dx, center.y + dy};
-
-            int distance_squared = dx * dx + dy * dy;
-			if (distance_squared > KERNEL_RADIUS_SQUARED) {
-				continue;
-			}
-
-			set_pixel(updated, neighbor, 1);
-		}
-	}
+#endif
 }
 
 float get_squared_color_difference(
@@ -68,47 +53,199 @@ float4 get_pixel(
 	int2 pos
 ) {
 	// Samplerless: https://registry.khronos.org/OpenCL/sdk/3.0/docs/man/html/imageSamplerlessReadFunctions.html
+#ifdef PIXELS_UINT16
+	return convert_float4(read_imageui(pixels, pos));
+#else
 	return read_imagef(pixels, pos);
+#endif
+}
+
+// The kernel is a single-channel CL_R image, so only .x holds the weight
+float get_weight(
+	read_write image2d_t kernel_,
+	int2 kernel_pos
+) {
+	return read_imagef(kernel_, kernel_pos).x;
 }
 
-void update_neighbor_total(
+// The alpha channel of the neighbor totals is never read, so they are stored as three floats per pixel
+float4 get_neighbor_total(
+	global float *neighbor_totals,
+	int2 pos
+) {
+	return (float4)(vload3((pos.y + KERNEL_RADIUS) * PADDED_WIDTH + pos.x + KERNEL_RADIUS, neighbor_totals), 0);
+}
+
+// OpenCL 1.2 has no atomic float addition, so this emulates it with a compare-and-swap loop
+// Source: https://streamhpc.com/blog/2016-02-09/atomic-operations-for-floats-in-opencl-improved/
+void atomic_add_float(
+	volatile global float *address,
+	float value
+) {
+	union {
+		u32 u;
+		float f;
+	} expected, desired;
+
+	do {
+		expected.f = *address;
+		desired.f = expected.f + value;
+	} while (atomic_cmpxchg((volatile global u32 *)address, expected.u, desired.u) != expected.u);
+}
+
+// Swapping a pixel changes the neighbor total of every pixel in its radius by (new - old) * weight,
+// so rather than recomputing all of their totals from scratch, just the difference is added,
+// just like update_neighbors() in cpp/main.cpp does.
+//
+// disc_half_widths[dy + KERNEL_RADIUS] is how far the disc reaches left and right at row dy,
+// see get_disc_half_widths() in sort.py, so only the taps inside of the disc get visited.
+void add_delta_to_neighbor_totals(
+	global float *neighbor_totals,
+	read_write image2d_t kernel_,
+	constant int *disc_half_widths,
+	int2 center,
+	float4 delta
+) {
+	for (int dy = -KERNEL_RADIUS; dy <= KERNEL_RADIUS; dy++) {
+		int half_width = disc_half_widths[dy + KERNEL_RADIUS];
+
+		int kernel_y = KERNEL_RADIUS + dy;
+
+		global float *row = neighbor_totals + ((center.y + KERNEL_RADIUS + dy) * PADDED_WIDTH + center.x + KERNEL_RADIUS) * 3;
+
+		for (int dx = -half_width; dx <= half_width; dx++) {
+			float weight = get_weight(kernel_, (int2)(KERNEL_RADIUS + dx, kernel_y));
+
+			float4 weighted_delta = delta * weight;
+
+			global float *neighbor_total = row + dx * 3;
+			atomic_add_float(neighbor_total + 0, weighted_delta.x);
+			atomic_add_float(neighbor_total + 1, weighted_delta.y);
+			atomic_add_float(neighbor_total + 2, weighted_delta.z);
+		}
+	}
+}
+
+// Computes the neighbor total of every pixel from scratch, one pixel per work-item,
+// by reading every neighbor and kernel weight in its radius straight from the images
+kernel void compute_neighbor_totals(
 	read_write image2d_t pixels,
-	read_write image2d_t neighbor_totals,
+	global float *neighbor_totals,
 	read_write image2d_t kernel_,
-	int2 center
+	constant int *disc_half_widths
 ) {
+	int2 center = (int2)(get_global_id(0), get_global_id(1));
+
+	// The global size is rounded up to a multiple of the work-group size
+	if (center.x >= WIDTH || center.y >= HEIGHT) {
+		return;
+	}
+
 	float4 neighbor_total = 0;
 	int2 kernel_center = (int2){KERNEL_RADIUS, KERNEL_RADIUS};
 
-	// TODO: By padding the input image, it should be possible to get rid of these bounds variables
+	// The pixels aren't padded, so every row of the disc gets clamped to the image instead
 	int dy_min = -min(center.y, KERNEL_RADIUS);
 	int dy_max = min(HEIGHT - 1 - center.y, KERNEL_RADIUS);
 
-	int dx_min = -min(center.x, KERNEL_RADIUS);
-	int dx_max = min(WIDTH - 1 - center.x, KERNEL_RADIUS);
-
 	for (int dy = dy_min; dy <= dy_max; dy++) {
+		int half_width = disc_half_widths[dy + KERNEL_RADIUS];
+
+		int dx_min = -min(center.x, half_width);
+		int dx_max = min(WIDTH - 1 - center.x, half_width);
+
 		for (int dx = dx_min; dx <= dx_max; dx++) {
 			int2 offset = (int2){dx, dy};
 
-			int2 neighbor = center + offset;
+			float4 neighbor_pixel = get_pixel(pixels, center + offset);
 
-            int distance_squared = dx * dx + dy * dy;
-			if (distance_squared > KERNEL_RADIUS_SQUARED) {
+			float weight = get_weight(kernel_, kernel_center + offset);
+
+			neighbor_total += neighbor_pixel * weight;
+		}
+	}
+
+	vstore3(neighbor_total.xyz, (center.y + KERNEL_RADIUS) * PADDED_WIDTH + center.x + KERNEL_RADIUS, neighbor_totals);
+}
+
+#define WEIGHT_TILE_SIDE (NEIGHBOR_TOTALS_TILE_SIDE * 2 - 1)
+
+// Does the same as compute_neighbor_totals(), but every work-group computes a square tile of pixels.
+// The tile's disc of neighbors is walked in tile-sized chunks, where every chunk of pixels
+// and the window of kernel weights between it and the tile are staged in local memory once,
+// after which every work-item of the tile reads them from there.
+//
+// The kernel image is 0 outside of the disc, so the inner loop doesn't need a distance check.
+kernel void compute_neighbor_totals_tiled(
+	read_write image2d_t pixels,
+	global float *neighbor_totals,
+	read_write image2d_t kernel_,
+	local float4 pixel_tile[NEIGHBOR_TOTALS_TILE_SIDE * NEIGHBOR_TOTALS_TILE_SIDE],
+	local float weight_tile[WEIGHT_TILE_SIDE * WEIGHT_TILE_SIDE]
+) {
+	int2 lid = (int2)(get_local_id(0), get_local_id(1));
+	int local_index = lid.y * NEIGHBOR_TOTALS_TILE_SIDE + lid.x;
+
+	int2 tile_origin = (int2)(get_group_id(0), get_group_id(1)) * NEIGHBOR_TOTALS_TILE_SIDE;
+	int2 center = tile_origin + lid;
+
+	int2 kernel_center = (int2){KERNEL_RADIUS, KERNEL_RADIUS};
+
+	int chunks_per_side = (KERNEL_RADIUS * 2 + NEIGHBOR_TOTALS_TILE_SIDE - 1) / NEIGHBOR_TOTALS_TILE_SIDE + 1;
+
+	float4 neighbor_total = 0;
+
+	for (int chunk_y = 0; chunk_y < chunks_per_side; chunk_y++) {
+		for (int chunk_x = 0; chunk_x < chunks_per_side; chunk_x++) {
+			int2 chunk_offset = (int2)(chunk_x, chunk_y) * NEIGHBOR_TOTALS_TILE_SIDE - KERNEL_RADIUS;
+			int2 chunk_origin = tile_origin + chunk_offset;
+
+			// These are the same for the whole work-group, so skipping chunks can't deadlock the barriers
+			if (chunk_origin.x >= WIDTH || chunk_origin.y >= HEIGHT
+			|| chunk_origin.x + NEIGHBOR_TOTALS_TILE_SIDE <= 0 || chunk_origin.y + NEIGHBOR_TOTALS_TILE_SIDE <= 0) {
 				continue;
 			}
 
-			float4 neighbor_pixel = get_pixel(pixels, neighbor);
+			// Skips the corner chunks that no pixel of the tile can reach
+			int2 gap = max(convert_int2(abs(chunk_offset)) - (NEIGHBOR_TOTALS_TILE_SIDE - 1), 0);
+			if (gap.x * gap.x + gap.y * gap.y > KERNEL_RADIUS_SQUARED) {
+				continue;
+			}
 
-			int2 kernel_pos = kernel_center + offset;
+			int2 staged = chunk_origin + lid;
+			bool inside = staged.x >= 0 && staged.x < WIDTH && staged.y >= 0 && staged.y < HEIGHT;
+			pixel_tile[local_index] = inside ? get_pixel(pixels, staged) : 0;
 
-			float weight = get_pixel(kernel_, kernel_pos).x;
+			// weight_tile[0] holds the weight of the offset between the tile's last pixel
+			// and the chunk's first pixel
+			int2 weight_tile_offset = chunk_offset - (NEIGHBOR_TOTALS_TILE_SIDE - 1);
 
-			neighbor_total += neighbor_pixel * weight;
+			for (int i = local_index; i < WEIGHT_TILE_SIDE * WEIGHT_TILE_SIDE; i += NEIGHBOR_TOTALS_TILE_SIDE * NEIGHBOR_TOTALS_TILE_SIDE) {
+				int2 offset = weight_tile_offset + (int2)(i % WEIGHT_TILE_SIDE, i / WEIGHT_TILE_SIDE);
+
+				bool in_kernel = abs(offset.x) <= KERNEL_RADIUS && abs(offset.y) <= KERNEL_RADIUS;
+				weight_tile[i] = in_kernel ? get_weight(kernel_, kernel_center + offset) : 0;
+			}
+
+			barrier(CLK_LOCAL_MEM_FENCE);
+
+			for (int y = 0; y < NEIGHBOR_TOTALS_TILE_SIDE; y++) {
+				local float4 *pixel_row = pixel_tile + y * NEIGHBOR_TOTALS_TILE_SIDE;
+				local float *weight_row = weight_tile + (NEIGHBOR_TOTALS_TILE_SIDE - 1 + y - lid.y) * WEIGHT_TILE_SIDE + NEIGHBOR_TOTALS_TILE_SIDE - 1 - lid.x;
+
+				for (int x = 0; x < NEIGHBOR_TOTALS_TILE_SIDE; x++) {
+					neighbor_total += pixel_row[x] * weight_row[x];
+				}
+			}
+
+			// Every work-item has to be done with the chunk before the next one overwrites it
+			barrier(CLK_LOCAL_MEM_FENCE);
 		}
 	}
 
-	set_pixel(neighbor_totals, center, neighbor_total);
+	if (center.x < WIDTH && center.y < HEIGHT) {
+		vstore3(neighbor_total.xyz, (center.y + KERNEL_RADIUS) * PADDED_WIDTH + center.x + KERNEL_RADIUS, neighbor_totals);
+	}
 }
 
 u64 round_up_to_power_of_2(
@@ -161,62 +298,165 @@ int2 get_pos(
 	return (int2)(x, y);
 }
 
-int get_shuffled_index(
+int shuffle_index(
 	int i,
+	int capacity,
 	u32 rand1,
 	u32 rand2
 ) {
-	// assert(i < OPAQUE_PIXEL_COUNT);
+	// assert(i < capacity);
 	// TODO: Replace with proper assert() somehow
-	if (!(i < OPAQUE_PIXEL_COUNT)) {
-		printf("Assertion failure: i < OPAQUE_PIXEL_COUNT was false!\n");
+	if (!(i < capacity)) {
+		printf("Assertion failure: i < capacity was false!\n");
 	}
 
 	int shuffled = i;
 
-	// This loop is guaranteed to terminate if i < OPAQUE_PIXEL_COUNT
+	// This loop is guaranteed to terminate if i < capacity
 	do {
-		shuffled = lcg(OPAQUE_PIXEL_COUNT, shuffled, rand1, rand2);
-	} while (shuffled >= OPAQUE_PIXEL_COUNT);
+		shuffled = lcg(capacity, shuffled, rand1, rand2);
+	} while (shuffled >= capacity);
 
 	return shuffled;
 }
 
-bool should_swap(
-	read_write image2d_t neighbor_totals,
+int get_shuffled_index(
+	int i,
+	u32 rand1,
+	u32 rand2
+) {
+	return shuffle_index(i, OPAQUE_PIXEL_COUNT, rand1, rand2);
+}
+
+// Integer hash by Chris Wellons
+// Source: https://nullprogram.com/blog/2018/07/31/
+u32 hash(
+	u32 x
+) {
+	x ^= x >> 16;
+	x *= 0x7feb352dU;
+	x ^= x >> 15;
+	x *= 0x846ca68bU;
+	x ^= x >> 16;
+	return x;
+}
+
+// A negative score difference means that swapping the pixels makes them fit in better
+float get_score_difference(
+	global float *neighbor_totals,
 	float4 pixel1,
 	float4 pixel2,
 	int2 pos1,
 	int2 pos2
 ) {
-	float4 i1_neighbor_total = get_pixel(neighbor_totals, pos1);
+	float4 i1_neighbor_total = get_neighbor_total(neighbor_totals, pos1);
 	float i1_old_score = get_squared_color_difference(pixel1, i1_neighbor_total);
 	float i1_new_score = get_squared_color_difference(pixel2, i1_neighbor_total);
 	float i1_score_difference = -i1_old_score + i1_new_score;
 
-	float4 i2_neighbor_total = get_pixel(neighbor_totals, pos2);
+	float4 i2_neighbor_total = get_neighbor_total(neighbor_totals, pos2);
 	float i2_old_score = get_squared_color_difference(pixel2, i2_neighbor_total);
 	float i2_new_score = get_squared_color_difference(pixel1, i2_neighbor_total);
 	float i2_score_difference = -i2_old_score + i2_new_score;
 
-	float score_difference = i1_score_difference + i2_score_difference;
+	return i1_score_difference + i2_score_difference;
+}
 
-	return score_difference < 0;
+void swap(
+	read_write image2d_t pixels,
+	global float *neighbor_totals,
+	read_write image2d_t kernel_,
+	constant int *disc_half_widths,
+	float4 pixel1,
+	float4 pixel2,
+	int2 pos1,
+	int2 pos2
+) {
+	set_pixel(pixels, pos1, pixel2);
+	set_pixel(pixels, pos2, pixel1);
+
+	float4 delta = pixel2 - pixel1;
+
+	add_delta_to_neighbor_totals(neighbor_totals, kernel_, disc_half_widths, pos1, delta);
+	add_delta_to_neighbor_totals(neighbor_totals, kernel_, disc_half_widths, pos2, -delta);
+}
+
+// Sums the accepted swaps and score differences of every work-item in the work-group,
+// so only one work-item per work-group has to do the slow global atomics.
+// counters[0] is the number of accepted swaps, and counters[1] holds the float sum of their score differences.
+void add_to_counters(
+	global u32 *counters,
+	local u32 *local_accepted_swaps,
+	local float *local_score_differences,
+	u32 accepted_swaps,
+	float score_difference
+) {
+	// sort() can be launched with a 2D work-group, see get_sort_sizes() in sort.py
+	int lid = get_local_id(1) * get_local_size(0) + get_local_id(0);
+
+	local_accepted_swaps[lid] = accepted_swaps;
+	local_score_differences[lid] = score_difference;
+
+	barrier(CLK_LOCAL_MEM_FENCE);
+
+	if (lid == 0) {
+		u32 group_accepted_swaps = 0;
+		float group_score_difference = 0;
+
+		for (int i = 0; i < get_local_size(0) * get_local_size(1); i++) {
+			group_accepted_swaps += local_accepted_swaps[i];
+			group_score_difference += local_score_differences[i];
+		}
+
+		atomic_add(&counters[0], group_accepted_swaps);
+		atomic_add_float((volatile global float *)&counters[1], group_score_difference);
+	}
+}
+
+// Appends the flat indices of the two swapped pixels to the swap log of --swap-log-path, see swap_log.py.
+// A capacity of 0 means that nothing is being logged, and sort.py flushes the log before it can overflow.
+// A work-group only swaps a pixel again after a barrier, and the work-groups of a call never swap the same pixels,
+// so replaying the records in order gives the same pixels, as long as -i doesn't make sort() race.
+void log_swap(
+	global uint2 *swap_log,
+	global u32 *swap_log_count,
+	u32 swap_log_capacity,
+	int2 pos1,
+	int2 pos2
+) {
+	if (swap_log_capacity == 0) {
+		return;
+	}
+
+	u32 record = atomic_inc(swap_log_count);
+
+	if (record < swap_log_capacity) {
+		swap_log[record] = (uint2)(pos1.y * WIDTH + pos1.x, pos2.y * WIDTH + pos2.x);
+	}
 }
 
 kernel void sort(
 	read_write image2d_t pixels,
-	read_write image2d_t neighbor_totals,
-	read_write image2d_t updated,
+	global float *neighbor_totals,
 	read_write image2d_t kernel_,
+	constant int *disc_half_widths,
 	global int normal_to_opaque_index_lut[OPAQUE_PIXEL_COUNT],
+	global u32 *counters,
+	local u32 *local_accepted_swaps,
+	local float *local_score_differences,
+	global uint2 *swap_log,
+	global u32 *swap_log_count,
+	u32 swap_log_capacity,
 	u32 rand1,
 	u32 rand2
 ) {
-	int gid = get_global_id(0);
+	int gid = get_global_id(1) * get_global_size(0) + get_global_id(0);
 	int i1 = gid * 2;
 	int i2 = i1 + 1;
 
+	u32 accepted_swaps = 0;
+	float accepted_score_difference = 0;
+
 	for (int iteration = 0; iteration < ITERATIONS_IN_KERNEL_PER_CALL; iteration++) {
 		// TODO: Is this defined to wrap around in OpenCL?
 		rand1++;
@@ -231,41 +471,321 @@ kernel void sort(
 		int2 pos1 = get_pos(shuffled_i1);
 		int2 pos2 = get_pos(shuffled_i2);
 
-		set_pixel(updated, pos1, 0);
-		set_pixel(updated, pos2, 0);
-
-		barrier(CLK_LOCAL_MEM_FENCE | CLK_GLOBAL_MEM_FENCE);
-
 		float4 pixel1 = get_pixel(pixels, pos1);
 		float4 pixel2 = get_pixel(pixels, pos2);
 
 		// printf("i1: %d, i2: %d, shuffled_i1: %d, shuffled_i2: %d, pos1: {%d,%d}, pos2: {%d,%d}", i1, i2, shuffled_i1, shuffled_i2, pos1.x, pos1.y, pos2.x, pos2.y);
 
-		bool swapping = should_swap(neighbor_totals, pixel1, pixel2, pos1, pos2);
+		float score_difference = get_score_difference(neighbor_totals, pixel1, pixel2, pos1, pos2);
+		bool swapping = score_difference < 0;
+
+		// Every pair needs to have read the neighbor totals before any of them get changed
+		barrier(CLK_GLOBAL_MEM_FENCE);
+
+		if (swapping) {
+			swap(pixels, neighbor_totals, kernel_, disc_half_widths, pixel1, pixel2, pos1, pos2);
+			log_swap(swap_log, swap_log_count, swap_log_capacity, pos1, pos2);
+
+			accepted_swaps++;
+			accepted_score_difference += score_difference;
+		}
+
+		barrier(CLK_GLOBAL_MEM_FENCE);
+	}
+
+	add_to_counters(counters, local_accepted_swaps, local_score_differences, accepted_swaps, accepted_score_difference);
+}
+
+// Does the same as sort(), except that every pixel only gets paired up with a pixel in its own window.
+// The image is covered by a grid of window_side x window_side windows, which gets shifted by a random offset
+// every iteration so the window borders move around, and the pixels of every window get shuffled.
+// Every pixel still gets proposed once per iteration, but once the image is roughly sorted,
+// nearby partners are far more likely to be accepted than ones from across the whole image.
+//
+// Windows on the edges of the image only shuffle the part of them that is inside of the image,
+// so only the last pixel of a window with an odd number of them sits an iteration out.
+// Pairs with a transparent pixel are skipped.
+//
+// Only the rows above band_height get sorted, which is HEIGHT unless the image is sharded
+// across several devices, in which case it is the height of this device's band, see ShardedSorter in sort.py.
+kernel void sort_in_windows(
+	read_write image2d_t pixels,
+	global float *neighbor_totals,
+	read_write image2d_t kernel_,
+	constant int *disc_half_widths,
+	global u32 *counters,
+	local u32 *local_accepted_swaps,
+	local float *local_score_differences,
+	global uint2 *swap_log,
+	global u32 *swap_log_count,
+	u32 swap_log_capacity,
+	u32 rand1,
+	u32 rand2,
+	int window_side,
+	int band_height
+) {
+	int gid = get_global_id(0);
+
+	int pairs_per_window = window_side * window_side / 2;
+	int window = gid / pairs_per_window;
+	int i1 = (gid % pairs_per_window) * 2;
+	int i2 = i1 + 1;
+
+	// Shifting the grid can make it stick out on both sides, which takes up to two extra windows per row and column
+	int windows_per_row = WIDTH / window_side + 2;
+	int2 window_pos = (int2)(window % windows_per_row, window / windows_per_row) * window_side;
+
+	u32 accepted_swaps = 0;
+	float accepted_score_difference = 0;
+
+	for (int iteration = 0; iteration < ITERATIONS_IN_KERNEL_PER_CALL; iteration++) {
+		rand1++;
+
+		int2 window_offset = (int2)(hash(rand1) % window_side, hash(rand1 ^ rand2) % window_side);
+		int2 window_origin = window_pos - window_offset;
+
+		int2 clipped_origin = max(window_origin, 0);
+		int2 clipped_size = max(min(window_origin + window_side, (int2)(WIDTH, band_height)) - clipped_origin, 0);
+		int clipped_area = clipped_size.x * clipped_size.y;
+
+		bool proposed = i2 < clipped_area;
+
+		float4 pixel1 = 0;
+		float4 pixel2 = 0;
+		int2 pos1 = 0;
+		int2 pos2 = 0;
+
+		if (proposed) {
+			int shuffled_i1 = shuffle_index(i1, clipped_area, rand1, rand2);
+			int shuffled_i2 = shuffle_index(i2, clipped_area, rand1, rand2);
 
-		// TODO: Not sure which of these two flags I should use,
-		// cause either seems to work.
-		// TODO: Not sure if this barrier is still necessary
-		barrier(CLK_LOCAL_MEM_FENCE | CLK_GLOBAL_MEM_FENCE);
+			pos1 = clipped_origin + (int2)(shuffled_i1 % clipped_size.x, shuffled_i1 / clipped_size.x);
+			pos2 = clipped_origin + (int2)(shuffled_i2 % clipped_size.x, shuffled_i2 / clipped_size.x);
+
+			pixel1 = get_pixel(pixels, pos1);
+			pixel2 = get_pixel(pixels, pos2);
+
+			proposed = pixel1.w != 0 && pixel2.w != 0;
+		}
+
+		float score_difference = proposed ? get_score_difference(neighbor_totals, pixel1, pixel2, pos1, pos2) : 0;
+		bool swapping = score_difference < 0;
+
+		barrier(CLK_GLOBAL_MEM_FENCE);
 
 		if (swapping) {
-			set_pixel(pixels, pos1, pixel2);
-			mark_neighbors_as_updated(updated, pos1);
+			swap(pixels, neighbor_totals, kernel_, disc_half_widths, pixel1, pixel2, pos1, pos2);
+			log_swap(swap_log, swap_log_count, swap_log_capacity, pos1, pos2);
+
+			accepted_swaps++;
+			accepted_score_difference += score_difference;
+		}
+
+		barrier(CLK_GLOBAL_MEM_FENCE);
+	}
+
+	add_to_counters(counters, local_accepted_swaps, local_score_differences, accepted_swaps, accepted_score_difference);
+}
+
+// Does the same as sort_in_windows(), except that every work-group owns a whole tile of the image for the entire call,
+// so every iteration only ever swaps pixels within tiles that no other work-group touches.
+// That makes it safe to loop ITERATIONS_IN_KERNEL_PER_CALL times, since barrier() only synchronizes a work-group.
+//
+// A call only sorts one of the four phases of a checkerboard of tiles, so every other tile in both directions.
+// Because tile_side is at least KERNEL_RADIUS, the pixels of different tiles in a phase are further apart
+// than KERNEL_RADIUS, so no pair can change the neighbor totals that a pair of another tile reads.
+// The tile grid is shifted by rand1, which has to be the same for all four phases.
+// Like in sort_in_windows(), only the rows above band_height get sorted.
+kernel void sort_in_tiles(
+	read_write image2d_t pixels,
+	global float *neighbor_totals,
+	read_write image2d_t kernel_,
+	constant int *disc_half_widths,
+	global u32 *counters,
+	local u32 *local_accepted_swaps,
+	local float *local_score_differences,
+	global uint2 *swap_log,
+	global u32 *swap_log_count,
+	u32 swap_log_capacity,
+	u32 rand1,
+	u32 rand2,
+	int tile_side,
+	int phase,
+	int band_height
+) {
+	int lid = get_local_id(0);
+	int local_size = get_local_size(0);
+
+	// Shifting the grid can make it stick out on both sides, which takes up to two extra tiles per row and column
+	int tiles_per_row = WIDTH / tile_side + 2;
+	int phase_tiles_per_row = (tiles_per_row + 1) / 2;
+
+	int group = get_group_id(0);
+	int2 tile = (int2)(group % phase_tiles_per_row, group / phase_tiles_per_row) * 2 + (int2)(phase % 2, phase / 2);
+
+	int2 tile_offset = (int2)(hash(rand1) % tile_side, hash(rand1 ^ rand2) % tile_side);
+	int2 tile_origin = tile * tile_side - tile_offset;
+
+	int2 clipped_origin = max(tile_origin, 0);
+	int2 clipped_size = max(min(tile_origin + tile_side, (int2)(WIDTH, band_height)) - clipped_origin, 0);
+	int clipped_area = clipped_size.x * clipped_size.y;
+
+	int pair_count = clipped_area / 2;
+
+	u32 accepted_swaps = 0;
+	float accepted_score_difference = 0;
+
+	for (int iteration = 0; iteration < ITERATIONS_IN_KERNEL_PER_CALL; iteration++) {
+		rand1++;
+
+		// A tile usually has more pairs than the work-group has work-items
+		for (int start = 0; start < pair_count; start += local_size) {
+			int i1 = (start + lid) * 2;
+			int i2 = i1 + 1;
+
+			bool proposed = i2 < clipped_area;
 
-			set_pixel(pixels, pos2, pixel1);
-			mark_neighbors_as_updated(updated, pos2);
+			float4 pixel1 = 0;
+			float4 pixel2 = 0;
+			int2 pos1 = 0;
+			int2 pos2 = 0;
+
+			if (proposed) {
+				int shuffled_i1 = shuffle_index(i1, clipped_area, rand1, rand2);
+				int shuffled_i2 = shuffle_index(i2, clipped_area, rand1, rand2);
+
+				pos1 = clipped_origin + (int2)(shuffled_i1 % clipped_size.x, shuffled_i1 / clipped_size.x);
+				pos2 = clipped_origin + (int2)(shuffled_i2 % clipped_size.x, shuffled_i2 / clipped_size.x);
+
+				pixel1 = get_pixel(pixels, pos1);
+				pixel2 = get_pixel(pixels, pos2);
+
+				proposed = pixel1.w != 0 && pixel2.w != 0;
+			}
+
+			float score_difference = proposed ? get_score_difference(neighbor_totals, pixel1, pixel2, pos1, pos2) : 0;
+			bool swapping = score_difference < 0;
+
+			// Unlike in the other kernels, the next pairs read pixels that were written in this work-group,
+			// so the image writes have to be made visible as well
+			barrier(CLK_GLOBAL_MEM_FENCE | CLK_IMAGE_MEM_FENCE);
+
+			if (swapping) {
+				swap(pixels, neighbor_totals, kernel_, disc_half_widths, pixel1, pixel2, pos1, pos2);
+				log_swap(swap_log, swap_log_count, swap_log_capacity, pos1, pos2);
+
+				accepted_swaps++;
+				accepted_score_difference += score_difference;
+			}
+
+			barrier(CLK_GLOBAL_MEM_FENCE | CLK_IMAGE_MEM_FENCE);
 		}
+	}
+
+	add_to_counters(counters, local_accepted_swaps, local_score_differences, accepted_swaps, accepted_score_difference);
+}
+
+// Converts the uint16 LAB pixels that rgb2lab.py outputs to 8-bit sRGB, like lab_to_rgb() in lab2rgb.py does,
+// which uses skimage's lab2rgb() with its default D65 illuminant and 2 degree observer.
+// Every preview pixel is the top-left pixel of its downsample x downsample block of pixels.
+// Source: https://github.com/scikit-image/scikit-image/blob/main/skimage/color/colorconv.py
+kernel void convert_to_rgb_preview(
+	read_write image2d_t pixels,
+	global uchar4 *preview,
+	int preview_width,
+	int preview_height,
+	int downsample
+) {
+	int2 preview_pos = (int2)(get_global_id(0), get_global_id(1));
+
+	// The global size is rounded up to a multiple of the work-group size
+	if (preview_pos.x >= preview_width || preview_pos.y >= preview_height) {
+		return;
+	}
+
+	float4 pixel = get_pixel(pixels, preview_pos * downsample);
 
-		barrier(CLK_LOCAL_MEM_FENCE | CLK_GLOBAL_MEM_FENCE);
+	// Undoes the precision_compensation and signed_to_unsigned of rgb2lab.py,
+	// where transparent pixels become black, just like in lab2rgb.py
+	float3 lab = pixel.w == 0 ? 0 : pixel.xyz / 82 - 128;
 
-		if (swapping || get_pixel(updated, pos1).x != 0) {
-			update_neighbor_total(pixels, neighbor_totals, kernel_, pos1);
+	float fy = (lab.x + 16) / 116;
+	float fx = lab.y / 500 + fy;
+	float fz = max(fy - lab.z / 200, 0.0f);
+
+	float3 f = (float3)(fx, fy, fz);
+	float3 xyz = select((f - 16.0f / 116) / 7.787f, f * f * f, f > 0.2068966f);
+
+	// The D65 reference white
+	xyz *= (float3)(0.95047f, 1, 1.08883f);
+
+	float3 rgb = (float3)(
+		dot(xyz, (float3)(3.24048134f, -1.53715152f, -0.49853633f)),
+		dot(xyz, (float3)(-0.96925495f, 1.87599f, 0.04155593f)),
+		dot(xyz, (float3)(0.05564664f, -0.20404134f, 1.05731107f))
+	);
+
+	rgb = select(rgb * 12.92f, 1.055f * pow(rgb, 1 / 2.4f) - 0.055f, rgb > 0.0031308f);
+	rgb = clamp(rgb, 0.0f, 1.0f);
+
+	preview[preview_pos.y * preview_width + preview_pos.x] = convert_uchar4_sat_rte((float4)(rgb * 255, pixel.w));
+}
+
+// splitmix64's finalizer, applied to the 4 uint16 values of the pixel packed into a u64,
+// exactly like hash_pixels() in pixel_checksum.py does.
+// Source: https://prng.di.unimi.it/splitmix64.c
+u64 hash_pixel(
+	float4 pixel
+) {
+	uint4 values = convert_uint4(pixel);
+	u64 z = (u64)values.x | (u64)values.y << 16 | (u64)values.z << 32 | (u64)values.w << 48;
+
+	z += 0x9E3779B97F4A7C15UL;
+	z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9UL;
+	z = (z ^ (z >> 27)) * 0x94D049BB133111EBUL;
+	return z ^ (z >> 31);
+}
+
+// Sums and XORs the hashes of the pixels in the first height rows.
+// Neither depends on where the pixels are, so they only change when a pixel got duplicated or lost.
+// Like add_to_counters(), only one work-item per work-group adds up the work-group's,
+// and checksums[group * 2] and checksums[group * 2 + 1] get its sum and XOR, which the host combines.
+kernel void checksum_pixels(
+	read_write image2d_t pixels,
+	global u64 *checksums,
+	local u64 *local_sums,
+	local u64 *local_xors,
+	int height
+) {
+	u64 sum = 0;
+	u64 xor_ = 0;
+
+	// Every work-group takes whole rows, whose neighboring pixels are read by neighboring work-items
+	for (int y = get_group_id(0); y < height; y += get_num_groups(0)) {
+		for (int x = get_local_id(0); x < WIDTH; x += get_local_size(0)) {
+			u64 hash = hash_pixel(get_pixel(pixels, (int2)(x, y)));
+			sum += hash;
+			xor_ ^= hash;
 		}
+	}
+
+	int lid = get_local_id(0);
+
+	local_sums[lid] = sum;
+	local_xors[lid] = xor_;
+
+	barrier(CLK_LOCAL_MEM_FENCE);
+
+	if (lid == 0) {
+		u64 group_sum = 0;
+		u64 group_xor = 0;
 
-		if (swapping || get_pixel(updated, pos2).x != 0) {
-			update_neighbor_total(pixels, neighbor_totals, kernel_, pos2);
+		for (int i = 0; i < get_local_size(0); i++) {
+			group_sum += local_sums[i];
+			group_xor ^= local_xors[i];
 		}
 
-		barrier(CLK_LOCAL_MEM_FENCE | CLK_GLOBAL_MEM_FENCE);
+		checksums[get_group_id(0) * 2] = group_sum;
+		checksums[get_group_id(0) * 2 + 1] = group_xor;
 	}
 }
@@ -1,13 +1,38 @@
 import argparse
+import copy
+import json
+import math
 import os
+import signal as sig
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import humanize
 import numpy as np
 import pyopencl as cl
+from PIL import Image
 from scipy import signal
 
+import autotune
+import checkpoint
+import frame_sink
+import lab2rgb
+import numpy_backend
+import pixel_checksum
+import program_cache
+import pyramid
+import swap_log
+from profiler import Profiler
+from snapshot_writer import SnapshotWriter
+
+
+def get_attempted_swaps(python_iteration, iterations_in_kernel_per_call, pair_count):
+    iteration = python_iteration * iterations_in_kernel_per_call
+    return iteration * pair_count
+
 
 def print_status(
     saved_results,
@@ -15,33 +40,66 @@ def print_status(
     python_iteration,
     iterations_in_kernel_per_call,
     start_time,
+    prev_status_time,
     pair_count,
+    accepted_swaps,
+    accepted_swaps_difference,
+    score_difference,
 ):
-    prev_iteration = (prev_python_iteration + 1) * iterations_in_kernel_per_call
-    iteration = (python_iteration + 1) * iterations_in_kernel_per_call
+    iteration = python_iteration * iterations_in_kernel_per_call
 
-    prev_attempted_swaps = prev_iteration * pair_count
-    attempted_swaps = iteration * pair_count
+    prev_attempted_swaps = get_attempted_swaps(
+        prev_python_iteration, iterations_in_kernel_per_call, pair_count
+    )
+    attempted_swaps = get_attempted_swaps(
+        python_iteration, iterations_in_kernel_per_call, pair_count
+    )
 
     attempted_swaps_difference = attempted_swaps - prev_attempted_swaps
 
+    seconds = max(time.time() - prev_status_time, 1e-9)
+    attempted_swaps_per_second = attempted_swaps_difference / seconds
+    accepted_swaps_per_second = accepted_swaps_difference / seconds
+
+    accept_rate = accepted_swaps_difference / max(attempted_swaps_difference, 1)
+
     print(
         f"Frame {saved_results}"
         f", {humanize.precisedelta(time.time() - start_time)}"
         f", iteration {iteration:.0f}"
-        f" ({python_iteration + 1:.0f} * {iterations_in_kernel_per_call:.0f})"
+        f" ({python_iteration:.0f} * {iterations_in_kernel_per_call:.0f})"
         f", {humanize.intword(attempted_swaps, '%.3f')} attempted swaps"
         f" ({humanize.intword(attempted_swaps_difference, '%+.3f')})"
+        f", {humanize.intword(attempted_swaps_per_second, '%.3f')} attempted swaps/s"
+        f", {humanize.intword(accepted_swaps, '%.3f')} accepted swaps"
+        f" ({humanize.intword(accepted_swaps_difference, '%+.3f')})"
+        f", {humanize.intword(accepted_swaps_per_second, '%.3f')} accepted swaps/s"
+        f", {accept_rate:.3%} accept rate"
+        f", score change {score_difference:+.4g}"
     )
 
 
-def save_result(pixels, queue, pixels_buf, width, height, output_npy_path):
-    saved = np.empty_like(pixels)
-    cl.enqueue_copy(
-        queue, saved, pixels_buf, origin=(0, 0), region=(width, height)
-    ).wait()
+def write_stats(stats_file, **stats):
+    """
+    Appends one JSON line to the --stats-path file, for tools like bench/bench.py
+    """
+    if stats_file is not None:
+        stats_file.write(json.dumps(stats) + "\n")
+        stats_file.flush()
+
 
-    np.save(output_npy_path, saved)
+def get_window_side(args, seconds):
+    """
+    Returns the window side that --proposals window uses after sorting for this many seconds,
+    which gets halved every --window-halving-seconds, like the temperature of simulated annealing.
+    Returns None before --window-start-seconds, since until the image is roughly sorted,
+    partners from across the whole image are what make the most progress.
+    """
+    if seconds < args.window_start_seconds:
+        return None
+
+    halvings = int((seconds - args.window_start_seconds) / args.window_halving_seconds)
+    return max(args.window_side_start >> halvings, args.window_side_end)
 
 
 def get_output_npy_path(
@@ -56,6 +114,16 @@ def get_output_npy_path(
         return output_npy_path
 
 
+def write_preview(preview_path, preview):
+    """
+    Writes the RGBA preview to preview_path as a PNG
+    """
+    # Writing to a temporary file first means that image viewers can never show a half-written preview
+    tmp_path = preview_path.with_name(f".{preview_path.name}.tmp")
+    Image.fromarray(preview).save(tmp_path, format="PNG")
+    os.replace(tmp_path, preview_path)
+
+
 def get_normal_to_opaque_index_lut(pixels):
     normal_to_opaque_index_lut = []
 
@@ -70,31 +138,196 @@ def get_normal_to_opaque_index_lut(pixels):
                 index = len(normal_to_opaque_index_lut) + offset
                 normal_to_opaque_index_lut.append(index)
 
-    return np.array(normal_to_opaque_index_lut)
+    return np.array(normal_to_opaque_index_lut, dtype=np.int32)
 
 
-def initialize_neighbor_totals_buf(
-    queue, neighbor_totals_buf, pixels, width, height, kernel
-):
+# Rough number of bytes fftconvolve() needs per element of its padded FFT shape,
+# covering the float32 input, its complex64 spectrum, the product and the output
+FFT_BYTES_PER_ELEMENT = 32
+
+
+def get_neighbor_totals_tile_size(kernel_radius, memory_limit, worker_count):
+    """
+    Returns the largest square tile side for which worker_count tiles
+    can be convolved at the same time within memory_limit bytes
+    """
+    # Every tile is convolved together with a kernel_radius halo on each side,
+    # and the FFT then pads that with the kernel diameter again
+    memory_per_worker = memory_limit / worker_count
+    fft_side = math.isqrt(int(memory_per_worker / (FFT_BYTES_PER_ELEMENT * 3)))
+    tile_side = fft_side - kernel_radius * 4
+
+    # Tiles much smaller than the kernel spend all their time on the halo,
+    # so rather go a bit over the limit
+    return max(tile_side, kernel_radius, 64)
+
+
+def get_neighbor_totals_tiles(pixels, kernel, memory_limit):
+    """
+    Yields (y, x, neighbor_totals_tile) for every tile, in the order they finish
+    """
+    height, width = pixels.shape[:2]
+    kernel_radius = kernel.shape[0] // 2
+
+    worker_count = os.cpu_count() or 1
+    tile_side = get_neighbor_totals_tile_size(kernel_radius, memory_limit, worker_count)
+
+    # Padding with the kernel radius lets every tile grab its halo without bounds checks.
+    # Only LAB is convolved, since sort.cl never reads the alpha of neighbor totals.
+    padded = np.pad(
+        pixels[:, :, :3],
+        ((kernel_radius, kernel_radius), (kernel_radius, kernel_radius), (0, 0)),
+    )
+
+    def convolve_tile(y, x):
+        tile_height = min(tile_side, height - y)
+        tile_width = min(tile_side, width - x)
+
+        # This is overlap-save rather than overlap-add: each tile convolves its halo as well,
+        # and keeps only the "valid" part, so a finished tile never needs to be added to again
+        halo = padded[
+            y : y + tile_height + kernel_radius * 2,
+            x : x + tile_width + kernel_radius * 2,
+        ]
+
+        # [:, :, :1] means only grabbing the R out of RGBA,
+        # since a deeper kernel would also convolve across the channels.
+        # Play around with extra/kernel_tests.py to see how convolve() works.
+        # Source: https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.fftconvolve.html
+        tile = np.zeros((tile_height, tile_width, 4), dtype=np.float32)
+        tile[:, :, :3] = signal.fftconvolve(
+            halo, kernel[:, :, :1], mode="valid", axes=(0, 1)
+        )
+
+        return y, x, tile
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        # Submitting lazily keeps at most worker_count tiles in memory
+        tile_origins = iter(
+            [
+                (y, x)
+                for y in range(0, height, tile_side)
+                for x in range(0, width, tile_side)
+            ]
+        )
+
+        futures = {
+            executor.submit(convolve_tile, *origin)
+            for _, origin in zip(range(worker_count), tile_origins)
+        }
+
+        while futures:
+            future = next(as_completed(futures))
+            futures.remove(future)
+
+            yield future.result()
+
+            origin = next(tile_origins, None)
+            if origin is not None:
+                futures.add(executor.submit(convolve_tile, *origin))
+
+
+def get_neighbor_totals(pixels, kernel, memory_limit):
     print("Running convolve(pixels, kernel)...")
 
-    # [:, :, :3] means only grabbing the R out of RGBA
-    # Play around with extra/kernel_tests.py to see how convolve() works.
-    # Source: https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.convolve.html
-    neighbor_totals = signal.convolve(pixels, kernel[:, :, :3], mode="same")
+    neighbor_totals = np.zeros_like(pixels, dtype=np.float32)
+
+    for y, x, tile in get_neighbor_totals_tiles(pixels, kernel, memory_limit):
+        neighbor_totals[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
+
+    return neighbor_totals
+
+
+# neighbor_totals_buf leaves out the alpha channel, since sort.cl never reads it
+NEIGHBOR_TOTAL_CHANNELS = 3
+
+# How many work-groups checksum_pixels() in sort.cl splits the pixels over
+CHECKSUM_GROUP_COUNT = 64
+
+
+def get_pixel_format(args, pixels):
+    """
+    Returns the OpenCL channel type and numpy dtype that pixels_buf stores the pixels as
+    """
+    # rgb2lab.py outputs uint16 LAB values, which are stored as such to halve the memory,
+    # but the means of blocks that the pyramid sorts generally aren't whole numbers
+    fits_in_uint16 = np.array_equal(pixels, pixels.astype(np.uint16))
+
+    if args.pixel_format == "uint16" and not fits_in_uint16:
+        raise ValueError("--pixel-format uint16 needs pixels that fit in an uint16")
+
+    if args.pixel_format == "float" or not fits_in_uint16:
+        return cl.channel_type.FLOAT, np.float32
+
+    return cl.channel_type.UNSIGNED_INT16, np.uint16
+
 
-    # In practice seeding neighbor_totals with random values works fine as well,
-    # since sort.cl will overwrite the initial values quickly anyways
-    # neighbor_totals = np.random.rand(width, height, 4)
+def enqueue_neighbor_totals_copy(
+    queue, dest, src, y, x, padded_width, kernel_radius, is_blocking=True
+):
+    """
+    Copies a (height, width, NEIGHBOR_TOTAL_CHANNELS) host array to or from
+    the rectangle at (y, x) of the padded neighbor_totals_buf, depending on which one is the dest
+    """
+    host = src if isinstance(dest, cl.Buffer) else dest
+    height, width = host.shape[:2]
+
+    bytes_per_pixel = NEIGHBOR_TOTAL_CHANNELS * np.float32().itemsize
 
-    print("Copying neighbor_totals to neighbor_totals_buf...")
-    cl.enqueue_copy(
+    # Source: https://documen.tician.de/pyopencl/runtime_memory.html#pyopencl.enqueue_copy
+    return cl.enqueue_copy(
         queue,
-        neighbor_totals_buf,
-        neighbor_totals,
-        origin=(0, 0),
-        region=(width, height),
-    ).wait()
+        dest,
+        src,
+        buffer_origin=((x + kernel_radius) * bytes_per_pixel, y + kernel_radius, 0),
+        host_origin=(0, 0, 0),
+        region=(width * bytes_per_pixel, height, 1),
+        buffer_pitches=(padded_width * bytes_per_pixel,),
+        host_pitches=(width * bytes_per_pixel,),
+        is_blocking=is_blocking,
+    )
+
+
+def initialize_neighbor_totals_buf(
+    queue, neighbor_totals_buf, pixels, padded_width, kernel, memory_limit
+):
+    print("Running convolve(pixels, kernel) and streaming it to neighbor_totals_buf...")
+
+    # Seeding neighbor_totals with random values used to work fine as well,
+    # but sort.cl now only adds the differences caused by swaps to them,
+    # so they have to start out correct
+
+    kernel_radius = kernel.shape[0] // 2
+
+    copies = []
+
+    for y, x, tile in get_neighbor_totals_tiles(pixels, kernel, memory_limit):
+        tile = np.ascontiguousarray(tile[:, :, :NEIGHBOR_TOTAL_CHANNELS])
+
+        # Copies the tile into its rectangle of the row-major neighbor_totals_buf,
+        # without waiting for it, so the next tile can already be convolved
+        event = enqueue_neighbor_totals_copy(
+            queue,
+            neighbor_totals_buf,
+            tile,
+            y,
+            x,
+            padded_width,
+            kernel_radius,
+            is_blocking=False,
+        )
+
+        # The tile has to be kept alive until its copy is done
+        copies.append((event, tile))
+
+        # Finished copies are released, so only the tiles still in flight stay in memory
+        copies = [
+            (event, tile)
+            for event, tile in copies
+            if event.command_execution_status != cl.command_execution_status.COMPLETE
+        ]
+
+    queue.finish()
 
 
 def get_kernel(kernel_radius):
@@ -118,6 +351,20 @@ def get_kernel(kernel_radius):
     return kernel
 
 
+def get_disc_half_widths(kernel_radius):
+    """
+    Returns how far the disc of get_kernel() reaches to the left and right of its center
+    at every row, so sort.cl only has to loop over the taps inside of the disc
+    """
+    return np.array(
+        [
+            math.isqrt(kernel_radius**2 - dy**2)
+            for dy in range(-kernel_radius, kernel_radius + 1)
+        ],
+        dtype=np.int32,
+    )
+
+
 def get_pair_count(pixels):
     opaque_pixel_count = np.sum(pixels[:, :, 3] != 0)
 
@@ -130,6 +377,52 @@ def get_pair_count(pixels):
     return int(opaque_pixel_count / 2)
 
 
+def get_largest_divisor(n, limit):
+    """
+    Returns the largest divisor of n that is at most limit
+    """
+    divisor = max(min(limit, n), 1)
+    while n % divisor != 0:
+        divisor -= 1
+    return divisor
+
+
+def get_sort_sizes(pair_count, width, workgroup_size, layout):
+    """
+    Returns the global and local size sort() in sort.cl gets launched with,
+    where there is a work-item for every pair of pixels.
+
+    The "1d" layout is a single row of pairs, while the "2d" layout
+    has rows of about width / 2 pairs, and work-groups that are as square as possible.
+    """
+    if layout == "1d":
+        # Work groups have to be able to exactly consume all work-items, with no leftovers
+        return (pair_count, 1), (get_largest_divisor(pair_count, workgroup_size), 1)
+
+    # An image without transparent pixels gets exactly (width / 2, height) work-items
+    global_width = get_largest_divisor(pair_count, width // 2)
+    global_height = pair_count // global_width
+
+    # The largest work-groups come first, and of those the squarest
+    local_sizes = []
+    for local_height in range(1, min(workgroup_size, global_height) + 1):
+        if global_height % local_height == 0:
+            local_width = get_largest_divisor(
+                global_width, workgroup_size // local_height
+            )
+            local_sizes.append(
+                (
+                    local_width * local_height,
+                    -abs(local_width - local_height),
+                    local_width,
+                    local_height,
+                )
+            )
+    _, _, local_width, local_height = max(local_sizes)
+
+    return (global_width, global_height), (local_width, local_height)
+
+
 def add_parser_arguments(parser):
     parser.add_argument(
         "input_npy_path",
@@ -146,7 +439,7 @@ def add_parser_arguments(parser):
         "--iterations-in-kernel-per-call",
         type=int,
         default=1,
-        help="Setting this higher than 1 can give a massive speedup, but the end of the program may tell you it messed up the output image!",
+        help="Setting this higher than 1 can give a massive speedup, but the end of the program may tell you it messed up the output image, unless --proposals tiles is used!",
     )
     parser.add_argument(
         "-s",
@@ -182,25 +475,1744 @@ def add_parser_arguments(parser):
         default=8,
         help="The workgroup size; the actually used workgroup size can be lower, and will be printed",
     )
+    parser.add_argument(
+        "--layout",
+        choices=("1d", "2d"),
+        default="1d",
+        help="Whether sort.cl's work-items form a single row of pixel pairs, or rows of about width / 2 pairs with work-groups spanning several rows",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Before sorting, time short trials of workgroup sizes, layouts and iteration counts that can't mess up the output image on this device, and sort with the one that accepted the most swaps per second; the result is cached per device, image size, kernel radius and --proposals",
+    )
+    parser.add_argument(
+        "--autotune-seconds",
+        type=float,
+        default=1,
+        help="How long every trial of --autotune sorts for",
+    )
+    parser.add_argument(
+        "--autotune-cache-path",
+        type=Path,
+        default=autotune.DEFAULT_AUTOTUNE_CACHE_PATH,
+        help="The JSON file the results of --autotune are kept in",
+    )
+    parser.add_argument(
+        "--no-autotune-cache",
+        action="store_true",
+        help="Always run the trials of --autotune, without reading or writing the autotune cache",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        choices=("opencl", "numpy"),
+        default="opencl",
+        help="Whether to sort with sort.cl on an OpenCL device, or with vectorized numpy on the CPU",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=1,
+        help="How many OpenCL devices to split the image into horizontal bands for, where a device is split into sub-devices if its platform doesn't have enough of them; needs --proposals window or tiles",
+    )
+    parser.add_argument(
+        "--seconds-between-band-exchanges",
+        type=float,
+        default=1,
+        help="How often the devices exchange the neighbor totals around their bands and move the band borders, which happens on every save as well; this has no effect if --devices isn't passed!",
+    )
+    parser.add_argument(
+        "--pixel-format",
+        choices=("auto", "uint16", "float"),
+        default="auto",
+        help="How the OpenCL device stores the pixels, where auto picks uint16 whenever every value is a whole number that fits in one, which takes half the memory of float",
+    )
+    parser.add_argument(
+        "--program-cache-path",
+        type=Path,
+        default=Path.home() / ".cache" / "pixel-sorter" / "programs",
+        help="Where compiled sort.cl binaries are kept, so the next start with the same settings can skip compiling",
+    )
+    parser.add_argument(
+        "--program-cache-max-mib",
+        type=float,
+        default=256,
+        help="Once the program cache grows past this many MiB, the least recently used binaries get deleted",
+    )
+    parser.add_argument(
+        "--no-program-cache",
+        action="store_true",
+        help="Always compile sort.cl from source, without reading or writing the program cache",
+    )
+    parser.add_argument(
+        "--neighbor-totals-init",
+        choices=("fft", "gather", "tiled"),
+        default="fft",
+        help="How the initial neighbor totals get computed: fft convolves tiles on the CPU, gather has every OpenCL work-item read its own disc, and tiled has every work-group share its disc through local memory",
+    )
+    parser.add_argument(
+        "--neighbor-totals-tile-side",
+        type=int,
+        default=16,
+        help="The side of the square tile of pixels every work-group computes with --neighbor-totals-init tiled; it gets lowered if the device can't run that many work-items per work-group",
+    )
+    parser.add_argument(
+        "--proposals",
+        choices=("global", "window", "tiles"),
+        default="global",
+        help="Whether every pixel gets paired up with a random pixel from across the whole image, or from a window around it; window raises how many swaps get accepted once the image is roughly sorted, and tiles sorts a checkerboard of tiles in four phases so that no swaps can race, which makes -i higher than 1 safe",
+    )
+    parser.add_argument(
+        "--tile-side",
+        type=int,
+        default=32,
+        help="The side of the tiles that --proposals tiles sorts, which gets raised to the kernel radius if it's lower",
+    )
+    parser.add_argument(
+        "--window-start-seconds",
+        type=float,
+        default=60,
+        help="How long --proposals window keeps pairing up pixels from across the whole image, before it switches to windows",
+    )
+    parser.add_argument(
+        "--window-side-start",
+        type=int,
+        default=64,
+        help="The side of the windows that --proposals window starts with, which has to be a power of two",
+    )
+    parser.add_argument(
+        "--window-side-end",
+        type=int,
+        default=8,
+        help="The side that the windows of --proposals window stop shrinking at, which has to be a power of two",
+    )
+    parser.add_argument(
+        "--window-halving-seconds",
+        type=float,
+        default=60,
+        help="How often the windows of --proposals window get halved in size",
+    )
+    parser.add_argument(
+        "--pyramid-levels",
+        type=int,
+        default=0,
+        help="Before sorting individual pixels, first sort blocks of 2^levels x 2^levels pixels, then blocks of half that size, and so on down to 2x2 blocks, which is much faster at getting the rough order right",
+    )
+    parser.add_argument(
+        "--pyramid-kernel-radius",
+        type=int,
+        default=8,
+        help="The largest kernel radius used while sorting blocks; this has no effect if --pyramid-levels isn't passed!",
+    )
+    parser.add_argument(
+        "--pyramid-seconds-per-level",
+        type=float,
+        default=10,
+        help="The longest that sorting the blocks of a single pyramid level may take",
+    )
+    parser.add_argument(
+        "--pyramid-accept-rate",
+        type=float,
+        default=0.001,
+        help="A pyramid level is done once the fraction of attempted block swaps that got accepted during the last second drops below this",
+    )
+    parser.add_argument(
+        "--init-memory-limit",
+        type=float,
+        default=1024,
+        help="Roughly how many MiB the initial convolution of the neighbor totals may use; it is split into tiles to stay under this",
+    )
+    parser.add_argument(
+        "--stop-when-accept-rate-below",
+        type=float,
+        help="Stop once the fraction of attempted swaps that got accepted since the previous save drops below this, e.g. 0.001",
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="Stop once the program has been running for this many seconds, not counting the time that --pyramid-levels takes",
+    )
+    frame_sink.add_parser_arguments(parser)
+    parser.add_argument(
+        "--preview-path",
+        type=Path,
+        help="Also write the pixels as an sRGB PNG to this path on every save, converted on the OpenCL device, so progress can be watched without running lab2rgb.py",
+    )
+    parser.add_argument(
+        "--preview-downsample",
+        type=int,
+        default=1,
+        help="Only put every this many-th pixel in both directions in the --preview-path PNG, which shrinks the readback and PNG encoding",
+    )
+    parser.add_argument(
+        "--stats-path",
+        type=Path,
+        help="Append the startup time and every status line as JSON lines to this file",
+    )
+    parser.add_argument(
+        "--launches-in-flight",
+        type=int,
+        default=4,
+        help="How many sort.cl calls can be queued up on the device at once, so it never has to wait on Python",
+    )
+    parser.add_argument(
+        "--snapshot-buffers",
+        type=int,
+        default=2,
+        help="How many snapshots can be waiting to be written to disk at once, before sorting waits for the disk",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="Periodically save everything needed to continue sorting later to this file",
+    )
+    parser.add_argument(
+        "--seconds-between-checkpoints",
+        type=float,
+        default=60,
+        help="How often the checkpoint gets saved; this has no effect if --checkpoint isn't passed!",
+    )
+    parser.add_argument(
+        "--resume",
+        type=Path,
+        help="Continue sorting from a file saved with --checkpoint, instead of from input_npy_path",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="Time every setup step on the host, and every kernel launch and copy on the OpenCL device, and write them to this .json Chrome trace or .csv file, along with printing a summary when sorting stops",
+    )
+    parser.add_argument(
+        "--swap-log-path",
+        type=Path,
+        help="Append every accepted swap to this compact binary log, which replay.py can turn into frames at any interval, without having to save full frames with -n",
+    )
+    parser.add_argument(
+        "--swap-log-buffer-mib",
+        type=float,
+        default=64,
+        help="How many MiB of swaps --swap-log-path collects on the device before they get flushed to the log in bulk; it grows if a single call could log more swaps than this",
+    )
+    parser.add_argument(
+        "--checksum-mismatch",
+        choices=("warn", "stop", "rollback"),
+        default="warn",
+        help="What to do when the checksum of the pixels, which is checked at startup and before every save, shows that pixels got duplicated or lost: warn saves anyway, stop stops without saving them, and rollback continues from the pixels of the last save",
+    )
+    parser.add_argument(
+        "--numpy-batch-size",
+        type=int,
+        default=0,
+        help="How many pixel pairs the numpy backend attempts to swap at once before refreshing the neighbor totals, where 0 means all pairs of an iteration, like sort.cl",
+    )
 
 
-def main():
-    start_time = time.time()
+class OpenCLSorter:
+    """
+    Sorts the pixels with sort.cl on an OpenCL device
+    """
+
+    def __init__(
+        self,
+        args,
+        pixels,
+        width,
+        height,
+        kernel_radius,
+        pair_count,
+        neighbor_totals=None,
+        normal_to_opaque_index_lut=None,
+        ctx=None,
+        snapshot_buffers=None,
+        profiler=None,
+    ):
+        self.width = width
+        self.height = height
+
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        self.profiler = profiler
+
+        os.environ["PYOPENCL_COMPILER_OUTPUT"] = "1"
+        if ctx is None:
+            print("Initializing OpenCL...")
+            # os.environ["PYOPENCL_CTX"] = "0" # Use this to automatically pick the 1st available driver
+            ctx = cl.create_some_context()
+        self.ctx = ctx
+        self.queue = cl.CommandQueue(ctx, properties=profiler.get_queue_properties())
+
+        self.pair_count = pair_count
+
+        # The tiled neighbor totals kernel runs one work-item per pixel of its square tile
+        max_workgroup_size = ctx.devices[0].max_work_group_size
+        self.neighbor_totals_tile_side = min(
+            args.neighbor_totals_tile_side, math.isqrt(max_workgroup_size)
+        )
 
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        pixel_channel_type, self.pixel_dtype = get_pixel_format(args, pixels)
+        print(f"Storing the pixels as {np.dtype(self.pixel_dtype).name}")
+
+        print("Building sort.cl...")
+        defines = (
+            f"-D MAKE_VSCODE_HIGHLIGHTER_HAPPY=1",
+            f"-D WIDTH={width}",
+            f"-D HEIGHT={height}",
+            f"-D OPAQUE_PIXEL_COUNT={pair_count * 2}",
+            f"-D ITERATIONS_IN_KERNEL_PER_CALL={args.iterations_in_kernel_per_call}",
+            f"-D KERNEL_RADIUS={kernel_radius}",
+            f"-D NEIGHBOR_TOTALS_TILE_SIDE={self.neighbor_totals_tile_side}",
+        )
+        if self.pixel_dtype == np.uint16:
+            defines += ("-D PIXELS_UINT16=1",)
+
+        # Source: https://man.opencl.org/clBuildProgram.html
+        # optimization_flags = (
+        #     "-cl-single-precision-constant",
+        #     "-cl-denorms-are-zero",
+        #     "-cl-fp32-correctly-rounded-divide-sqrt",
+        #     "-cl-mad-enable",
+        #     "-cl-no-signed-zeros",
+        #     "-cl-unsafe-math-optimizations",
+        #     "-cl-finite-math-only",
+        #     "-cl-fast-relaxed-math",
+        #     # "-cl-uniform-work-group-size",
+        # )
+
+        options = defines
+        # Optimization flags don't help in practice :(
+        # options += optimization_flags
+
+        with profiler.step("build sort.cl"):
+            self.prg = program_cache.build_program(
+                ctx,
+                Path("sort.cl").read_text(),
+                options,
+                None if args.no_program_cache else args.program_cache_path,
+                args.program_cache_max_mib * 1024 * 1024,
+            )
+
+        pixel_format = cl.ImageFormat(cl.channel_order.RGBA, pixel_channel_type)
+        self.pixel_format = pixel_format
+
+        print("Creating pixels_buf...")
+        self.pixels_buf = cl.Image(
+            ctx, cl.mem_flags.READ_WRITE, pixel_format, shape=(width, height)
+        )
+
+        if snapshot_buffers is None:
+            snapshot_buffers = args.snapshot_buffers
+
+        print("Creating snapshot_bufs...")
+        # Snapshots are first copied to one of these on the device,
+        # so sort.cl can keep changing pixels_buf while they are read back
+        # on a second queue, and written to disk by the snapshot writer's thread
+        self.readback_queue = cl.CommandQueue(
+            ctx, properties=profiler.get_queue_properties()
+        )
+        self.snapshot_bufs = [
+            cl.Image(ctx, cl.mem_flags.READ_WRITE, pixel_format, shape=(width, height))
+            for _ in range(snapshot_buffers)
+        ]
+        self.snapshot_writer = SnapshotWriter(
+            snapshot_buffers, (height, width, 4), self.pixel_dtype
+        )
+
+        print("Creating image kernel...")
+        with profiler.step("get_kernel"):
+            self.kernel = get_kernel(kernel_radius)
+        kernel_width = self.kernel.shape[0]
+        kernel_height = self.kernel.shape[1]
+
+        print("Creating kernel_buf...")
+        # sort.cl only ever reads the weight in .x, so a single channel is enough
+        kernel_format = cl.ImageFormat(cl.channel_order.R, cl.channel_type.FLOAT)
+        self.kernel_buf = cl.Image(
+            ctx,
+            cl.mem_flags.READ_WRITE,
+            kernel_format,
+            shape=(kernel_width, kernel_height),
+        )
+        profiler.add_event(
+            "upload kernel",
+            cl.enqueue_copy(
+                self.queue,
+                self.kernel_buf,
+                np.ascontiguousarray(self.kernel[:, :, 0]),
+                origin=(0, 0),
+                region=(kernel_width, kernel_height),
+            ),
+        ).wait()
+
+        print("Creating disc_half_widths_buf...")
+        self.disc_half_widths_buf = cl.Buffer(
+            ctx,
+            cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+            hostbuf=get_disc_half_widths(kernel_radius),
+        )
+
+        print("Creating neighbor_totals_buf...")
+        # A plain buffer rather than an image, since sort.cl atomically adds to it.
+        # Swaps near the border add to the padding around the image,
+        # which is never read, but saves sort.cl from checking bounds.
+        self.kernel_radius = kernel_radius
+        self.padded_width = width + kernel_radius * 2
+        padded_height = height + kernel_radius * 2
+        self.neighbor_totals_buf = cl.Buffer(
+            ctx,
+            cl.mem_flags.READ_WRITE,
+            size=self.padded_width
+            * padded_height
+            * NEIGHBOR_TOTAL_CHANNELS
+            * np.float32().itemsize,
+        )
+
+        # Created by load(), since its size comes from the LUT
+        self.normal_to_opaque_index_lut_buf = None
+
+        print("Creating counters_buf...")
+        # Holds the number of accepted swaps and the sum of their score differences,
+        # see add_to_counters() in sort.cl
+        self.counters = np.zeros(2, dtype=np.uint32)
+        self.counters_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_WRITE, size=self.counters.nbytes
+        )
+
+        print("Creating checksums_buf...")
+        # Holds the sum and XOR of the pixel hashes of every work-group, see checksum_pixels() in sort.cl
+        self.checksums = np.zeros(CHECKSUM_GROUP_COUNT * 2, dtype=np.uint64)
+        self.checksums_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_WRITE, size=self.checksums.nbytes
+        )
+
+        # Created by keep_last_good(), which only --checksum-mismatch rollback calls
+        self.last_good_pixels_buf = None
+
+        # Replaced by start_swap_log(), and passed to the sort kernels with a capacity of 0 until then
+        self.swap_log_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_WRITE, size=swap_log.RECORD_DTYPE.itemsize
+        )
+        self.swap_log_count = np.zeros(1, dtype=np.uint32)
+        self.swap_log_count_buf = cl.Buffer(
+            ctx, cl.mem_flags.READ_WRITE, size=self.swap_log_count.nbytes
+        )
+        self.swap_log_capacity = 0
+        self.swap_log_writer = None
+        self.swap_log_records = None
+        self.swap_log_reserved = 0
+
+        # Every pair can swap once per iteration, so a call can log at most this many swaps
+        self.max_swaps_per_call = (
+            width * height // 2 * args.iterations_in_kernel_per_call
+        )
+
+        # The program can be shared with other sorters in this process, see program_cache.py,
+        # so every sorter creates its own kernels, whose arguments the others can't change
+        self.opencl_sort = cl.Kernel(self.prg, "sort")
+        self.opencl_sort_in_windows = cl.Kernel(self.prg, "sort_in_windows")
+        self.opencl_sort_in_tiles = cl.Kernel(self.prg, "sort_in_tiles")
+        self.opencl_checksum_pixels = cl.Kernel(self.prg, "checksum_pixels")
+
+        self.set_workgroup_size(args.workgroup_size, args.layout)
+
+        print(
+            f"Using workgroup-size {self.workgroup_size}, and a {args.layout} layout with local size {self.local_size}"
+        )
+
+        self.launches_in_flight = args.launches_in_flight
+        self.launched_events = deque()
+
+        # Created by save_preview(), once it is first called
+        self.preview_downsample = None
+        self.preview_writer = None
+
+        self.load(args, pixels, neighbor_totals, normal_to_opaque_index_lut)
+
+        device_bytes = sum(
+            buf.size
+            for buf in (
+                self.pixels_buf,
+                *self.snapshot_bufs,
+                self.kernel_buf,
+                self.disc_half_widths_buf,
+                self.neighbor_totals_buf,
+                self.normal_to_opaque_index_lut_buf,
+            )
+        )
+        print(
+            f"Allocated {humanize.naturalsize(device_bytes, binary=True)} on the device"
+        )
+
+    def set_workgroup_size(self, workgroup_size, layout):
+        """
+        Sets how the work-items of the sort kernels are split into work-groups,
+        which autotune.py tries out without having to build the program again
+        """
+        # How many work-items to put in a work-group, i.e. how to partition work-items.
+        # Items in a work-group can work together, e.g. they can share fast local memory.
+        # Because the global size is partitioned with the local size into groups,
+        # both must have the same dimension, e.g. g.s=(1,10) and l.s=(1,2) gives 5 groups.
+        # If you don't care about work-groups, just put None.
+        # Source is Harry's comment below this answer: https://stackoverflow.com/a/50373589/13279557
+        #
+        # Setting this to None to go would mean an implementation-defined workgroups size would be used,
+        # which crashes your GPU after a few minutes when input/all_colors_shuffled.png is the input
+        # when a huge kernel_size is used (30 on my GPU).
+        # Source: https://stackoverflow.com/a/25443544/13279557
+        self.global_size, self.local_size = get_sort_sizes(
+            self.pair_count, self.width, workgroup_size, layout
+        )
+
+        # sort_in_windows() and checksum_pixels() always use a 1D layout
+        self.workgroup_size = get_largest_divisor(self.pair_count, workgroup_size)
+
+        local_items = max(self.workgroup_size, math.prod(self.local_size))
+        self.local_accepted_swaps = cl.LocalMemory(local_items * np.uint32().itemsize)
+        self.local_score_differences = cl.LocalMemory(
+            local_items * np.float32().itemsize
+        )
+        self.local_checksum_sums = cl.LocalMemory(
+            self.workgroup_size * np.uint64().itemsize
+        )
+        self.local_checksum_xors = cl.LocalMemory(
+            self.workgroup_size * np.uint64().itemsize
+        )
+
+        # Every work-group of sort_in_tiles() owns a whole tile, so unlike with sort(),
+        # the workgroup size doesn't have to divide the number of pairs
+        self.tile_workgroup_size = min(
+            workgroup_size, self.ctx.devices[0].max_work_group_size
+        )
+        self.tile_local_accepted_swaps = cl.LocalMemory(
+            self.tile_workgroup_size * np.uint32().itemsize
+        )
+        self.tile_local_score_differences = cl.LocalMemory(
+            self.tile_workgroup_size * np.float32().itemsize
+        )
+
+    def load(self, args, pixels, neighbor_totals=None, normal_to_opaque_index_lut=None):
+        """
+        Copies the pixels to sort to the device, and sets up their neighbor totals.
+        Calling this again with the pixels of another image of the same size, pixel format
+        and number of opaque pixels reuses the compiled program and every buffer.
+        """
+        self.finish()
+
+        # roll_back() recomputes the neighbor totals the same way
+        self.neighbor_totals_init = args.neighbor_totals_init
+
+        self.profiler.add_event(
+            "upload pixels",
+            cl.enqueue_copy(
+                self.queue,
+                self.pixels_buf,
+                np.ascontiguousarray(pixels, dtype=self.pixel_dtype),
+                origin=(0, 0),
+                region=(self.width, self.height),
+            ),
+        )
+
+        self.profiler.add_event(
+            "zero neighbor totals",
+            cl.enqueue_fill_buffer(
+                self.queue,
+                self.neighbor_totals_buf,
+                np.float32(0),
+                0,
+                self.neighbor_totals_buf.size,
+            ),
+        )
+
+        if neighbor_totals is None and args.neighbor_totals_init == "fft":
+            with self.profiler.step("initialize_neighbor_totals_buf"):
+                initialize_neighbor_totals_buf(
+                    self.queue,
+                    self.neighbor_totals_buf,
+                    pixels,
+                    self.padded_width,
+                    self.kernel,
+                    args.init_memory_limit * 1024**2,
+                )
+        elif neighbor_totals is None:
+            self.compute_neighbor_totals(self.prg, args.neighbor_totals_init == "tiled")
+        else:
+            print("Copying the resumed neighbor_totals to neighbor_totals_buf...")
+            self.profiler.add_event(
+                "upload neighbor totals",
+                enqueue_neighbor_totals_copy(
+                    self.queue,
+                    self.neighbor_totals_buf,
+                    np.ascontiguousarray(
+                        neighbor_totals[:, :, :NEIGHBOR_TOTAL_CHANNELS]
+                    ),
+                    0,
+                    0,
+                    self.padded_width,
+                    self.kernel_radius,
+                ),
+            )
+
+        if normal_to_opaque_index_lut is None:
+            print("Creating normal_to_opaque_index_lut...")
+            with self.profiler.step("get_normal_to_opaque_index_lut"):
+                normal_to_opaque_index_lut = get_normal_to_opaque_index_lut(pixels)
+        self.normal_to_opaque_index_lut = normal_to_opaque_index_lut
+
+        normal_to_opaque_index_lut = np.ascontiguousarray(
+            normal_to_opaque_index_lut, dtype=np.int32
+        )
+        if (
+            self.normal_to_opaque_index_lut_buf is None
+            or self.normal_to_opaque_index_lut_buf.size
+            != normal_to_opaque_index_lut.nbytes
+        ):
+            self.normal_to_opaque_index_lut_buf = cl.Buffer(
+                self.ctx,
+                cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                hostbuf=normal_to_opaque_index_lut,
+            )
+        else:
+            self.profiler.add_event(
+                "upload normal_to_opaque_index_lut",
+                cl.enqueue_copy(
+                    self.queue,
+                    self.normal_to_opaque_index_lut_buf,
+                    normal_to_opaque_index_lut,
+                ),
+            )
+
+        cl.enqueue_fill_buffer(
+            self.queue, self.counters_buf, np.uint32(0), 0, self.counters.nbytes
+        )
+
+        self.queue.finish()
+
+    def compute_neighbor_totals(self, prg, tiled):
+        """
+        Computes neighbor_totals_buf from scratch on the device
+        """
+        start_time = time.time()
+
+        tile_side = self.neighbor_totals_tile_side
+        local_size = (tile_side, tile_side)
+        global_size = (
+            math.ceil(self.width / tile_side) * tile_side,
+            math.ceil(self.height / tile_side) * tile_side,
+        )
+
+        if tiled:
+            print("Running compute_neighbor_totals_tiled()...")
+            weight_tile_side = tile_side * 2 - 1
+            event = cl.Kernel(prg, "compute_neighbor_totals_tiled")(
+                self.queue,
+                global_size,
+                local_size,
+                self.pixels_buf,
+                self.neighbor_totals_buf,
+                self.kernel_buf,
+                cl.LocalMemory(tile_side * tile_side * 4 * np.float32().itemsize),
+                cl.LocalMemory(
+                    weight_tile_side * weight_tile_side * np.float32().itemsize
+                ),
+            )
+            self.profiler.add_event("compute_neighbor_totals_tiled", event).wait()
+        else:
+            print("Running compute_neighbor_totals()...")
+            event = cl.Kernel(prg, "compute_neighbor_totals")(
+                self.queue,
+                global_size,
+                local_size,
+                self.pixels_buf,
+                self.neighbor_totals_buf,
+                self.kernel_buf,
+                self.disc_half_widths_buf,
+            )
+            self.profiler.add_event("compute_neighbor_totals", event).wait()
+
+        print(f"Computed the neighbor totals in {time.time() - start_time:.2f} seconds")
+
+    def sort(self, rand1, rand2, window_side=None, band_height=None):
+        if band_height is None:
+            band_height = self.height
+
+        self.reserve_swap_log()
+
+        # The OpenCL kernel call is async, so this used to .wait() on every call
+        # to be able to use Ctrl+C, but that left the device idle between calls.
+        # main() now handles Ctrl+C itself, so a few calls are kept in flight instead,
+        # and only the oldest one gets waited on.
+        #
+        # Here's the documentation of the function arguments:
+        # https://documen.tician.de/pyopencl/runtime_program.html#pyopencl.Kernel.__call__
+        if window_side is None:
+            event = self.opencl_sort(
+                self.queue,
+                self.global_size,
+                self.local_size,
+                self.pixels_buf,
+                self.neighbor_totals_buf,
+                self.kernel_buf,
+                self.disc_half_widths_buf,
+                self.normal_to_opaque_index_lut_buf,
+                self.counters_buf,
+                self.local_accepted_swaps,
+                self.local_score_differences,
+                self.swap_log_buf,
+                self.swap_log_count_buf,
+                np.uint32(self.swap_log_capacity),
+                rand1,
+                rand2,
+            )
+            self.profiler.add_event("sort", event)
+        else:
+            # One work-item for every pair of pixels of every window in the shifted grid
+            pairs_per_window = window_side * window_side // 2
+            window_count = (self.width // window_side + 2) * (
+                band_height // window_side + 2
+            )
+
+            event = self.opencl_sort_in_windows(
+                self.queue,
+                (window_count * pairs_per_window, 1),
+                (math.gcd(self.workgroup_size, pairs_per_window), 1),
+                self.pixels_buf,
+                self.neighbor_totals_buf,
+                self.kernel_buf,
+                self.disc_half_widths_buf,
+                self.counters_buf,
+                self.local_accepted_swaps,
+                self.local_score_differences,
+                self.swap_log_buf,
+                self.swap_log_count_buf,
+                np.uint32(self.swap_log_capacity),
+                rand1,
+                rand2,
+                np.int32(window_side),
+                np.int32(band_height),
+            )
+            self.profiler.add_event("sort_in_windows", event)
+
+        self.launched_events.append(event)
+        if len(self.launched_events) > self.launches_in_flight:
+            self.launched_events.popleft().wait()
+
+    def sort_in_tiles(self, rand1, rand2, tile_side, band_height=None):
+        if band_height is None:
+            band_height = self.height
+
+        self.reserve_swap_log()
+
+        tiles_per_row = self.width // tile_side + 2
+        tiles_per_column = band_height // tile_side + 2
+        phase_tile_count = ((tiles_per_row + 1) // 2) * ((tiles_per_column + 1) // 2)
+
+        # The queue is in-order, so every phase only starts once the previous one is done
+        for phase in range(4):
+            event = self.opencl_sort_in_tiles(
+                self.queue,
+                (phase_tile_count * self.tile_workgroup_size, 1),
+                (self.tile_workgroup_size, 1),
+                self.pixels_buf,
+                self.neighbor_totals_buf,
+                self.kernel_buf,
+                self.disc_half_widths_buf,
+                self.counters_buf,
+                self.tile_local_accepted_swaps,
+                self.tile_local_score_differences,
+                self.swap_log_buf,
+                self.swap_log_count_buf,
+                np.uint32(self.swap_log_capacity),
+                rand1,
+                rand2,
+                np.int32(tile_side),
+                np.int32(phase),
+                np.int32(band_height),
+            )
+            self.profiler.add_event("sort_in_tiles", event)
+
+        self.launched_events.append(event)
+        if len(self.launched_events) > self.launches_in_flight:
+            self.launched_events.popleft().wait()
+
+    def finish(self):
+        self.queue.finish()
+        self.launched_events.clear()
+
+    def start_swap_log(self, swap_log_writer, max_bytes):
+        """
+        Has every accepted swap get logged on the device, from where it gets flushed to the writer in bulk
+        """
+        capacity = max(
+            int(max_bytes // swap_log.RECORD_DTYPE.itemsize), self.max_swaps_per_call
+        )
+
+        self.finish()
+
+        self.swap_log_buf = cl.Buffer(
+            self.ctx,
+            cl.mem_flags.READ_WRITE,
+            size=capacity * swap_log.RECORD_DTYPE.itemsize,
+        )
+        self.swap_log_records = np.empty(capacity, dtype=swap_log.RECORD_DTYPE)
+        self.swap_log_capacity = capacity
+        self.swap_log_writer = swap_log_writer
+
+        cl.enqueue_fill_buffer(
+            self.queue,
+            self.swap_log_count_buf,
+            np.uint32(0),
+            0,
+            self.swap_log_count.nbytes,
+        )
+
+        # How many records the launched calls can have logged at most
+        self.swap_log_reserved = 0
+        self.swap_log_last_good_offset = swap_log_writer.tell()
+
+    def reserve_swap_log(self):
+        """
+        Flushes the swap log if the next call could overflow it
+        """
+        if self.swap_log_writer is None:
+            return
+
+        if self.swap_log_reserved + self.max_swaps_per_call > self.swap_log_capacity:
+            self.flush_swap_log()
+
+        self.swap_log_reserved += self.max_swaps_per_call
+
+    def flush_swap_log(self):
+        """
+        Writes the swaps that the launched calls logged, which waits for them to finish
+        """
+        # Nothing can have been logged if nothing was launched since the last flush
+        if self.swap_log_writer is None or self.swap_log_reserved == 0:
+            return
+
+        self.profiler.add_event(
+            "read back swap log count",
+            cl.enqueue_copy(self.queue, self.swap_log_count, self.swap_log_count_buf),
+        )
+        record_count = int(self.swap_log_count[0])
+        records = self.swap_log_records[:record_count]
+
+        if record_count > 0:
+            self.profiler.add_event(
+                "read back swap log",
+                cl.enqueue_copy(self.queue, records, self.swap_log_buf),
+            )
+            self.profiler.add_event(
+                "zero swap log count",
+                cl.enqueue_fill_buffer(
+                    self.queue,
+                    self.swap_log_count_buf,
+                    np.uint32(0),
+                    0,
+                    self.swap_log_count.nbytes,
+                ),
+            )
+
+        with self.profiler.step("write swap log"):
+            self.swap_log_writer.write(records)
+
+        self.swap_log_reserved = 0
+
+    def stop_swap_log(self):
+        """
+        Flushes the swap log, and stops logging swaps
+        """
+        if self.swap_log_writer is None:
+            return
+
+        self.finish()
+        self.flush_swap_log()
+
+        self.swap_log_writer = None
+        self.swap_log_capacity = 0
+
+        # Frees the device memory, since a pooled sorter can be reused without a swap log
+        self.swap_log_buf = cl.Buffer(
+            self.ctx, cl.mem_flags.READ_WRITE, size=swap_log.RECORD_DTYPE.itemsize
+        )
+        self.swap_log_records = None
+
+    def read_counters(self):
+        """
+        Returns the number of accepted swaps and the sum of their score differences
+        since the previous call, which waits for the launched calls to finish
+        """
+        self.profiler.add_event(
+            "read back counters",
+            cl.enqueue_copy(self.queue, self.counters, self.counters_buf),
+        )
+
+        # The accepted swaps are an u32, so they get reset before they can overflow
+        self.profiler.add_event(
+            "zero counters",
+            cl.enqueue_fill_buffer(
+                self.queue, self.counters_buf, np.uint32(0), 0, self.counters.nbytes
+            ),
+        )
+
+        return int(self.counters[0]), float(self.counters[1:].view(np.float32)[0])
+
+    def checksum(self, band_height=None):
+        """
+        Returns the sum and XOR of the hashes of the pixels in the first band_height rows,
+        which waits for the launched calls to finish
+        """
+        if band_height is None:
+            band_height = self.height
+
+        self.profiler.add_event(
+            "checksum_pixels",
+            self.opencl_checksum_pixels(
+                self.queue,
+                (CHECKSUM_GROUP_COUNT * self.workgroup_size, 1),
+                (self.workgroup_size, 1),
+                self.pixels_buf,
+                self.checksums_buf,
+                self.local_checksum_sums,
+                self.local_checksum_xors,
+                np.int32(band_height),
+            ),
+        )
+        self.profiler.add_event(
+            "read back checksums",
+            cl.enqueue_copy(self.queue, self.checksums, self.checksums_buf),
+        )
+
+        return pixel_checksum.combine_checksums(self.checksums)
+
+    def keep_last_good(self):
+        """
+        Copies the pixels on the device, so roll_back() can restore them
+        """
+        if self.last_good_pixels_buf is None:
+            self.last_good_pixels_buf = cl.Image(
+                self.ctx,
+                cl.mem_flags.READ_WRITE,
+                self.pixel_format,
+                shape=(self.width, self.height),
+            )
+
+        self.profiler.add_event(
+            "copy pixels to last_good_pixels_buf",
+            cl.enqueue_copy(
+                self.queue,
+                self.last_good_pixels_buf,
+                self.pixels_buf,
+                src_origin=(0, 0),
+                dest_origin=(0, 0),
+                region=(self.width, self.height),
+            ),
+        )
+
+        if self.swap_log_writer is not None:
+            self.flush_swap_log()
+            self.swap_log_last_good_offset = self.swap_log_writer.tell()
+
+    def roll_back(self):
+        """
+        Restores the pixels that keep_last_good() copied, and recomputes their neighbor totals from scratch
+        """
+        self.finish()
+
+        if self.swap_log_writer is not None:
+            # The swaps since keep_last_good() are undone, so they get cut from the swap log
+            cl.enqueue_fill_buffer(
+                self.queue,
+                self.swap_log_count_buf,
+                np.uint32(0),
+                0,
+                self.swap_log_count.nbytes,
+            )
+            self.swap_log_reserved = 0
+            self.swap_log_writer.truncate(self.swap_log_last_good_offset)
+
+        cl.enqueue_copy(
+            self.queue,
+            self.pixels_buf,
+            self.last_good_pixels_buf,
+            src_origin=(0, 0),
+            dest_origin=(0, 0),
+            region=(self.width, self.height),
+        )
+
+        cl.enqueue_fill_buffer(
+            self.queue,
+            self.neighbor_totals_buf,
+            np.float32(0),
+            0,
+            self.neighbor_totals_buf.size,
+        )
+
+        # The fft initialization needs the pixels on the host, so this stays on the device instead
+        self.compute_neighbor_totals(self.prg, self.neighbor_totals_init == "tiled")
+
+    def save(self, output_npy_path):
+        # Flushing on every save lets replay.py line the swaps up with the saved frames
+        self.flush_swap_log()
+
+        # Once the writer hands out a host buffer, the snapshot written from it
+        # is on disk, so its snapshot_buf isn't being read back anymore either
+        buffer_index, saved = self.snapshot_writer.acquire()
+        snapshot_buf = self.snapshot_bufs[buffer_index]
+
+        copy_event = cl.enqueue_copy(
+            self.queue,
+            snapshot_buf,
+            self.pixels_buf,
+            src_origin=(0, 0),
+            dest_origin=(0, 0),
+            region=(self.width, self.height),
+        )
+        readback_event = cl.enqueue_copy(
+            self.readback_queue,
+            saved,
+            snapshot_buf,
+            origin=(0, 0),
+            region=(self.width, self.height),
+            wait_for=[copy_event],
+            is_blocking=False,
+        )
+        self.profiler.add_event("copy pixels to snapshot_buf", copy_event)
+        self.profiler.add_event("read back snapshot", readback_event)
+
+        self.queue.flush()
+        self.readback_queue.flush()
+
+        self.snapshot_writer.submit(buffer_index, output_npy_path, readback_event)
+
+    def save_preview(self, preview_path, downsample):
+        """
+        Converts the pixels to an sRGB PNG on the device, only reading back every downsample-th pixel
+        """
+        preview_width = math.ceil(self.width / downsample)
+        preview_height = math.ceil(self.height / downsample)
+
+        if self.preview_downsample != downsample:
+            if self.preview_writer is not None:
+                self.preview_writer.close()
+
+            self.preview_downsample = downsample
+            self.preview_buf = cl.Buffer(
+                self.ctx,
+                cl.mem_flags.WRITE_ONLY,
+                size=preview_width * preview_height * 4,
+            )
+            self.opencl_convert_to_rgb_preview = cl.Kernel(
+                self.prg, "convert_to_rgb_preview"
+            )
+            self.preview_writer = SnapshotWriter(
+                1,
+                (preview_height, preview_width, 4),
+                np.uint8,
+            )
+
+        # A pooled sorter gets the profiler of every job it is reused by
+        self.preview_writer.write = self.profiler.timed("write preview", write_preview)
+
+        buffer_index, preview = self.preview_writer.acquire()
+
+        local_size = (8, 8)
+        convert_event = self.opencl_convert_to_rgb_preview(
+            self.queue,
+            (
+                math.ceil(preview_width / local_size[0]) * local_size[0],
+                math.ceil(preview_height / local_size[1]) * local_size[1],
+            ),
+            local_size,
+            self.pixels_buf,
+            self.preview_buf,
+            np.int32(preview_width),
+            np.int32(preview_height),
+            np.int32(downsample),
+        )
+        readback_event = cl.enqueue_copy(
+            self.readback_queue,
+            preview,
+            self.preview_buf,
+            wait_for=[convert_event],
+            is_blocking=False,
+        )
+        self.profiler.add_event("convert_to_rgb_preview", convert_event)
+        self.profiler.add_event("read back preview", readback_event)
+
+        self.queue.flush()
+        self.readback_queue.flush()
+
+        self.preview_writer.submit(buffer_index, preview_path, readback_event)
+
+    def read_state(self, pixels, neighbor_totals):
+        device_pixels = np.empty((self.height, self.width, 4), dtype=self.pixel_dtype)
+        cl.enqueue_copy(
+            self.queue,
+            device_pixels,
+            self.pixels_buf,
+            origin=(0, 0),
+            region=(self.width, self.height),
+        )
+
+        device_neighbor_totals = np.empty(
+            (self.height, self.width, NEIGHBOR_TOTAL_CHANNELS), dtype=np.float32
+        )
+        enqueue_neighbor_totals_copy(
+            self.queue,
+            device_neighbor_totals,
+            self.neighbor_totals_buf,
+            0,
+            0,
+            self.padded_width,
+            self.kernel_radius,
+        )
+
+        pixels[...] = device_pixels
+        neighbor_totals[:, :, :NEIGHBOR_TOTAL_CHANNELS] = device_neighbor_totals
+        neighbor_totals[:, :, NEIGHBOR_TOTAL_CHANNELS:] = 0
+
+    def close(self):
+        self.snapshot_writer.close()
+
+        if self.preview_writer is not None:
+            self.preview_writer.close()
+
+
+class NumpySorter:
+    """
+    Does what sort.cl does with vectorized numpy on the CPU
+    """
+
+    def __init__(
+        self,
+        args,
+        pixels,
+        width,
+        height,
+        kernel_radius,
+        neighbor_totals=None,
+        normal_to_opaque_index_lut=None,
+        profiler=None,
+    ):
+        self.args = args
+        self.width = width
+        self.height = height
+
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        self.profiler = profiler
+
+        print("Creating image kernel...")
+        with profiler.step("get_kernel"):
+            self.kernel = get_kernel(kernel_radius)
+        self.disc_offsets = numpy_backend.get_disc_offsets(self.kernel[:, :, 0])
+
+        if neighbor_totals is None:
+            with profiler.step("get_neighbor_totals"):
+                neighbor_totals = get_neighbor_totals(
+                    pixels, self.kernel, args.init_memory_limit * 1024**2
+                )
+        self.neighbor_totals = np.array(neighbor_totals, dtype=np.float32)
+
+        if normal_to_opaque_index_lut is None:
+            print("Creating normal_to_opaque_index_lut...")
+            with profiler.step("get_normal_to_opaque_index_lut"):
+                normal_to_opaque_index_lut = get_normal_to_opaque_index_lut(pixels)
+        self.normal_to_opaque_index_lut = np.array(normal_to_opaque_index_lut)
+
+        self.pixels = np.array(pixels, dtype=np.float32)
+
+        self.snapshot_writer = SnapshotWriter(
+            args.snapshot_buffers, self.pixels.shape, np.float32
+        )
+
+        # Flattened views, so pixels can be indexed with the shuffled indices
+        self.flat_pixels = self.pixels.reshape(-1, 4)
+        self.flat_neighbor_totals = self.neighbor_totals.reshape(-1, 4)
+
+        self.accepted_swaps = 0
+        self.score_difference = 0
+
+    def sort(self, rand1, rand2, window_side=None):
+        with self.profiler.step("numpy_backend.sort"):
+            accepted_swaps, score_difference = numpy_backend.sort(
+                self.flat_pixels,
+                self.flat_neighbor_totals,
+                self.width,
+                self.height,
+                self.kernel[:, :, :1],
+                self.disc_offsets,
+                self.normal_to_opaque_index_lut,
+                self.args.iterations_in_kernel_per_call,
+                rand1,
+                rand2,
+                self.args.numpy_batch_size,
+                window_side,
+            )
+
+        self.accepted_swaps += accepted_swaps
+        self.score_difference += score_difference
+
+    def sort_in_tiles(self, rand1, rand2, tile_side):
+        with self.profiler.step("numpy_backend.sort_in_tiles"):
+            accepted_swaps, score_difference = numpy_backend.sort_in_tiles(
+                self.flat_pixels,
+                self.flat_neighbor_totals,
+                self.width,
+                self.height,
+                self.kernel[:, :, :1],
+                self.disc_offsets,
+                self.args.iterations_in_kernel_per_call,
+                rand1,
+                rand2,
+                tile_side,
+                self.args.workgroup_size,
+            )
+
+        self.accepted_swaps += accepted_swaps
+        self.score_difference += score_difference
+
+    def finish(self):
+        pass
+
+    def read_counters(self):
+        """
+        Returns the number of accepted swaps and the sum of their score differences
+        since the previous call
+        """
+        counters = self.accepted_swaps, self.score_difference
+
+        self.accepted_swaps = 0
+        self.score_difference = 0
+
+        return counters
+
+    def checksum(self):
+        with self.profiler.step("get_checksum"):
+            return pixel_checksum.get_checksum(self.pixels)
+
+    def keep_last_good(self):
+        self.last_good_pixels = self.pixels.copy()
+
+    def roll_back(self):
+        self.pixels[...] = self.last_good_pixels
+        self.neighbor_totals[...] = get_neighbor_totals(
+            self.pixels, self.kernel, self.args.init_memory_limit * 1024**2
+        )
+
+    def save(self, output_npy_path):
+        buffer_index, saved = self.snapshot_writer.acquire()
+        saved[...] = self.pixels
+        self.snapshot_writer.submit(buffer_index, output_npy_path)
+
+    def save_preview(self, preview_path, downsample):
+        write_preview(
+            preview_path,
+            lab2rgb.lab_to_rgb(self.pixels[::downsample, ::downsample]),
+        )
+
+    def read_state(self, pixels, neighbor_totals):
+        pixels[...] = self.pixels
+        neighbor_totals[...] = self.neighbor_totals
+
+    def close(self):
+        self.snapshot_writer.close()
+
+
+def get_devices(device_count):
+    """
+    Returns device_count devices of the platform that create_some_context() picks.
+    If the platform doesn't have that many, its device is split into equally sized sub-devices,
+    which lets pocl's CPU device run a shard per group of cores.
+    """
+    device = cl.create_some_context().devices[0]
+
+    devices = device.platform.get_devices(device_type=device.type)
+    if len(devices) >= device_count:
+        return devices[:device_count]
+
+    compute_units = device.max_compute_units // device_count
+    if compute_units == 0:
+        raise ValueError(
+            f"Can't split {device.name} into {device_count} devices, since it only has {device.max_compute_units} compute units"
+        )
+
+    print(f"Splitting {device.name} into sub-devices of {compute_units} compute units")
+    # Source: https://documen.tician.de/pyopencl/runtime_platform.html#pyopencl.Device.create_sub_devices
+    sub_devices = device.create_sub_devices(
+        [cl.device_partition_property.EQUALLY, compute_units]
     )
-    add_parser_arguments(parser)
-    args = parser.parse_args()
+    return sub_devices[:device_count]
+
+
+class ShardedSorter:
+    """
+    Sorts the pixels with sort.cl on several OpenCL devices at once,
+    by splitting the image into horizontal bands, one per device.
+
+    Every device only holds the pixels and neighbor totals of its own band,
+    and only pairs up pixels inside of it. The padding of its neighbor_totals_buf
+    is the halo of kernel_radius rows that swaps near the band's edges add their deltas to.
+
+    Every exchange gathers the bands on the host, and adds the deltas that each device
+    added to its halo to the band they belong to. The band borders then get moved
+    by a random offset, so pixels can cross every border, and the new bands are sent back.
+    """
+
+    def __init__(
+        self,
+        args,
+        pixels,
+        width,
+        height,
+        kernel_radius,
+        neighbor_totals=None,
+        normal_to_opaque_index_lut=None,
+        profiler=None,
+    ):
+        self.args = args
+        self.width = width
+        self.height = height
+        self.kernel_radius = kernel_radius
+
+        if profiler is None:
+            profiler = Profiler(enabled=False)
+        self.profiler = profiler
+
+        if neighbor_totals is None:
+            with profiler.step("get_neighbor_totals"):
+                neighbor_totals = get_neighbor_totals(
+                    pixels, get_kernel(kernel_radius), args.init_memory_limit * 1024**2
+                )
+        # The sum of what every device added to the neighbor totals gets added to these,
+        # so every exchange starts off with the same correct neighbor totals on every device
+        self.neighbor_totals = np.array(
+            neighbor_totals[:, :, :NEIGHBOR_TOTAL_CHANNELS], dtype=np.float32
+        )
 
-    print("Initializing OpenCL...")
-    # os.environ["PYOPENCL_CTX"] = "0" # Use this to automatically pick the 1st available driver
-    os.environ["PYOPENCL_COMPILER_OUTPUT"] = "1"
-    ctx = cl.create_some_context()
-    queue = cl.CommandQueue(ctx)
+        if normal_to_opaque_index_lut is None:
+            print("Creating normal_to_opaque_index_lut...")
+            with profiler.step("get_normal_to_opaque_index_lut"):
+                normal_to_opaque_index_lut = get_normal_to_opaque_index_lut(pixels)
+        self.normal_to_opaque_index_lut = normal_to_opaque_index_lut
 
-    print("Loading input npy...")
-    pixels = np.load(args.input_npy_path)
+        self.pixels = np.array(pixels, dtype=np.float32)
+
+        self.snapshot_writer = SnapshotWriter(
+            args.snapshot_buffers, self.pixels.shape, np.float32
+        )
+
+        devices = get_devices(args.devices)
+
+        # Moving the borders by up to half a band makes the first and last band up to that much taller
+        self.band_side = math.ceil(height / len(devices))
+        self.max_band_offset = self.band_side // 2
+        max_band_height = min(self.band_side + self.max_band_offset, height)
+
+        # Rows move between devices, so every one of them has to store the pixels the same way
+        _, pixel_dtype = get_pixel_format(args, pixels)
+        shard_args = argparse.Namespace(**vars(args))
+        shard_args.pixel_format = "uint16" if pixel_dtype == np.uint16 else "float"
+
+        self.shards = []
+        for device in devices:
+            print(f"Creating the shard on {device.name}...")
+            self.shards.append(
+                OpenCLSorter(
+                    shard_args,
+                    np.zeros((max_band_height, width, 4), dtype=np.float32),
+                    width,
+                    max_band_height,
+                    kernel_radius,
+                    max_band_height * width // 2,
+                    # Uploaded by send_bands() right after this
+                    np.zeros((max_band_height, width, 4), dtype=np.float32),
+                    # Shards never run sort(), which is the only kernel that reads the LUT
+                    np.zeros(1, dtype=np.int32),
+                    cl.Context([device]),
+                    snapshot_buffers=0,
+                    profiler=profiler,
+                )
+            )
+
+        self.rng = np.random.default_rng(42424242)
+        self.bands = self.get_bands(0)
+        self.send_bands()
+
+        self.last_exchange_time = time.time()
+
+    def get_bands(self, offset):
+        """
+        Returns the (start, end) rows of every device's band,
+        with every border between two bands moved up by offset rows
+        """
+        borders = [
+            min(max(band_index * self.band_side - offset, 0), self.height)
+            for band_index in range(1, len(self.shards))
+        ]
+        return list(zip([0, *borders], [*borders, self.height]))
+
+    def send_bands(self):
+        """
+        Copies the pixels and neighbor totals of every device's band to it,
+        along with the neighbor totals of the halo rows around it
+        """
+        for shard, (band_start, band_end) in zip(self.shards, self.bands):
+            if band_end > band_start:
+                cl.enqueue_copy(
+                    shard.queue,
+                    shard.pixels_buf,
+                    np.ascontiguousarray(
+                        self.pixels[band_start:band_end], dtype=shard.pixel_dtype
+                    ),
+                    origin=(0, 0),
+                    region=(self.width, band_end - band_start),
+                )
+
+            halo_start = max(band_start - self.kernel_radius, 0)
+            halo_end = min(band_end + self.kernel_radius, self.height)
+            enqueue_neighbor_totals_copy(
+                shard.queue,
+                shard.neighbor_totals_buf,
+                self.neighbor_totals[halo_start:halo_end],
+                halo_start - band_start,
+                0,
+                shard.padded_width,
+                self.kernel_radius,
+            )
+
+    def receive_bands(self):
+        """
+        Gathers the pixels of every device's band,
+        and adds the deltas every device added to the neighbor totals of its band and halo
+        """
+        neighbor_totals = self.neighbor_totals.copy()
+
+        for shard, (band_start, band_end) in zip(self.shards, self.bands):
+            shard.finish()
+
+            if band_end > band_start:
+                band_pixels = np.empty(
+                    (band_end - band_start, self.width, 4), dtype=shard.pixel_dtype
+                )
+                cl.enqueue_copy(
+                    shard.queue,
+                    band_pixels,
+                    shard.pixels_buf,
+                    origin=(0, 0),
+                    region=(self.width, band_end - band_start),
+                )
+                self.pixels[band_start:band_end] = band_pixels
+
+            halo_start = max(band_start - self.kernel_radius, 0)
+            halo_end = min(band_end + self.kernel_radius, self.height)
+            halo_neighbor_totals = np.empty(
+                (halo_end - halo_start, self.width, NEIGHBOR_TOTAL_CHANNELS),
+                dtype=np.float32,
+            )
+            enqueue_neighbor_totals_copy(
+                shard.queue,
+                halo_neighbor_totals,
+                shard.neighbor_totals_buf,
+                halo_start - band_start,
+                0,
+                shard.padded_width,
+                self.kernel_radius,
+            )
+
+            neighbor_totals[halo_start:halo_end] += (
+                halo_neighbor_totals - self.neighbor_totals[halo_start:halo_end]
+            )
+
+        self.neighbor_totals = neighbor_totals
+
+    def exchange_bands(self):
+        with self.profiler.step("exchange bands"):
+            self.receive_bands()
+
+            offset = int(
+                self.rng.integers(
+                    -self.max_band_offset, self.max_band_offset, endpoint=True
+                )
+            )
+            self.bands = self.get_bands(offset)
+            self.send_bands()
+
+        self.last_exchange_time = time.time()
+
+    def exchange_bands_if_due(self):
+        if (
+            time.time()
+            > self.last_exchange_time + self.args.seconds_between_band_exchanges
+        ):
+            self.exchange_bands()
+
+    def sort(self, rand1, rand2, window_side=None):
+        self.exchange_bands_if_due()
+
+        # Pairs from across the whole image would cross the bands,
+        # so until the windows start shrinking, the biggest windows are used
+        if window_side is None:
+            window_side = self.args.window_side_start
+
+        for shard, (band_start, band_end) in zip(self.shards, self.bands):
+            shard.sort(rand1, rand2, window_side, band_end - band_start)
+
+    def sort_in_tiles(self, rand1, rand2, tile_side):
+        self.exchange_bands_if_due()
+
+        for shard, (band_start, band_end) in zip(self.shards, self.bands):
+            shard.sort_in_tiles(rand1, rand2, tile_side, band_end - band_start)
+
+    def finish(self):
+        for shard in self.shards:
+            shard.finish()
+
+    def read_counters(self):
+        """
+        Returns the number of accepted swaps and the sum of their score differences
+        since the previous call, summed over every device
+        """
+        accepted_swaps = 0
+        score_difference = 0
+
+        for shard in self.shards:
+            shard_accepted_swaps, shard_score_difference = shard.read_counters()
+            accepted_swaps += shard_accepted_swaps
+            score_difference += shard_score_difference
+
+        return accepted_swaps, score_difference
+
+    def checksum(self):
+        """
+        Returns the sum and XOR of the hashes of the pixels, combined from those of every device's band
+        """
+        return pixel_checksum.combine_checksums(
+            [
+                shard.checksum(band_end - band_start)
+                for shard, (band_start, band_end) in zip(self.shards, self.bands)
+            ]
+        )
+
+    def keep_last_good(self):
+        # save() gathered the bands on the host right before this
+        self.last_good_pixels = self.pixels.copy()
+
+    def roll_back(self):
+        self.finish()
+
+        self.pixels[...] = self.last_good_pixels
+        self.neighbor_totals = get_neighbor_totals(
+            self.pixels,
+            get_kernel(self.kernel_radius),
+            self.args.init_memory_limit * 1024**2,
+        )[:, :, :NEIGHBOR_TOTAL_CHANNELS].copy()
+
+        self.send_bands()
+
+    def save(self, output_npy_path):
+        # The bands have to be gathered anyway, so this doubles as an exchange
+        self.exchange_bands()
+
+        buffer_index, saved = self.snapshot_writer.acquire()
+        saved[...] = self.pixels
+        self.snapshot_writer.submit(buffer_index, output_npy_path)
+
+    def save_preview(self, preview_path, downsample):
+        # save() gathered the bands on the host right before this
+        write_preview(
+            preview_path,
+            lab2rgb.lab_to_rgb(self.pixels[::downsample, ::downsample]),
+        )
+
+    def read_state(self, pixels, neighbor_totals):
+        self.exchange_bands()
+
+        pixels[...] = self.pixels
+        neighbor_totals[:, :, :NEIGHBOR_TOTAL_CHANNELS] = self.neighbor_totals
+        neighbor_totals[:, :, NEIGHBOR_TOTAL_CHANNELS:] = 0
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+        self.snapshot_writer.close()
+
+
+def create_sorter(
+    args,
+    pixels,
+    width,
+    height,
+    kernel_radius,
+    pair_count,
+    neighbor_totals=None,
+    normal_to_opaque_index_lut=None,
+    profiler=None,
+    ctx=None,
+):
+    if args.backend == "numpy":
+        return NumpySorter(
+            args,
+            pixels,
+            width,
+            height,
+            kernel_radius,
+            neighbor_totals,
+            normal_to_opaque_index_lut,
+            profiler=profiler,
+        )
+
+    return OpenCLSorter(
+        args,
+        pixels,
+        width,
+        height,
+        kernel_radius,
+        pair_count,
+        neighbor_totals,
+        normal_to_opaque_index_lut,
+        ctx,
+        profiler=profiler,
+    )
+
+
+def sort_pyramid(args, pixels, kernel_radius):
+    """
+    Roughly sorts the pixels in place by sorting whole blocks of them,
+    going from the coarsest level with the biggest blocks down to blocks of 2x2 pixels.
+    Every level is a downsampled image with one pixel per block,
+    which is far cheaper to sort than the full image, and the blocks are then
+    moved accordingly, so the pixels stay a permutation of the original ones.
+    """
+    for level in range(args.pyramid_levels, 0, -1):
+        block_side = 2**level
+
+        coarse_pixels = pyramid.get_coarse_pixels(pixels, block_side)
+        coarse_height, coarse_width = coarse_pixels.shape[:2]
+
+        pair_count = get_pair_count(coarse_pixels)
+        if pair_count == 0:
+            continue
+
+        # A block covers block_side pixels, so this covers about the same area as the full kernel
+        coarse_kernel_radius = min(
+            math.ceil(kernel_radius / block_side),
+            args.pyramid_kernel_radius,
+            max(coarse_width, coarse_height) - 1,
+        )
+
+        print(
+            f"Sorting pyramid level {level}: {coarse_width}x{coarse_height} blocks of {block_side}x{block_side} pixels, with kernel radius {coarse_kernel_radius}"
+        )
+
+        # The means of the blocks generally aren't whole numbers,
+        # so only the full image can be stored as uint16
+        coarse_args = copy.copy(args)
+        coarse_args.pixel_format = "float"
+
+        sorter = create_sorter(
+            coarse_args,
+            coarse_pixels,
+            coarse_width,
+            coarse_height,
+            coarse_kernel_radius,
+            pair_count,
+        )
+
+        try:
+            rand1 = np.uint32(42424242)
+            rand2 = np.uint32(69696969 + level)
+
+            level_start_time = time.time()
+            last_check_time = level_start_time
+            calls_since_check = 0
+
+            while time.time() < level_start_time + args.pyramid_seconds_per_level:
+                rand1 = np.uint32(rand1 + 1)
+                sorter.sort(rand1, rand2)
+                calls_since_check += 1
+
+                if time.time() > last_check_time + 1:
+                    accepted_swaps, _ = sorter.read_counters()
+                    attempted_swaps = get_attempted_swaps(
+                        calls_since_check,
+                        args.iterations_in_kernel_per_call,
+                        pair_count,
+                    )
+
+                    if accepted_swaps / attempted_swaps < args.pyramid_accept_rate:
+                        break
+
+                    last_check_time = time.time()
+                    calls_since_check = 0
+
+            sorter.finish()
+
+            neighbor_totals = np.empty_like(coarse_pixels)
+            sorter.read_state(coarse_pixels, neighbor_totals)
+        finally:
+            sorter.close()
+
+        pyramid.apply_coarse_pixels(pixels, coarse_pixels, block_side)
+
+        print(
+            f"Sorted pyramid level {level} in {time.time() - level_start_time:.2f} seconds"
+        )
+
+
+def check_args(args):
+    """
+    Raises a ValueError if the arguments can't be used together
+    """
+    for window_side in (args.window_side_start, args.window_side_end):
+        if window_side < 2 or window_side & (window_side - 1):
+            raise ValueError(
+                f"The window sides have to be powers of two of at least 2, but got {window_side}"
+            )
+
+    if args.devices > 1 and args.backend != "opencl":
+        raise ValueError("--devices needs --backend opencl")
+    if args.swap_log_path and (args.backend != "opencl" or args.devices > 1):
+        raise ValueError("--swap-log-path needs --backend opencl and a single device")
+    if args.swap_log_path and (args.resume or args.pyramid_levels > 0):
+        raise ValueError(
+            "--swap-log-path can't be used with --resume or --pyramid-levels, since replay.py starts from the input npy"
+        )
+    if args.autotune and (args.backend != "opencl" or args.devices > 1):
+        raise ValueError("--autotune needs --backend opencl and a single device")
+    if args.devices > 1 and args.proposals == "global":
+        raise ValueError(
+            "--devices needs --proposals window or tiles, since every device only sorts its own band"
+        )
+
+
+def sort_image(args, start_time, stopping=None, sorter_pool=None):
+    """
+    Sorts the input npy, or the checkpoint passed with --resume, until one of the stop conditions
+    in args is reached, or until the stopping event gets set.
+    Passing None as stopping has Ctrl+C stop the sorting instead.
+
+    A sorter_pool, like the one of batch.py, hands out the sorter and gets it back afterwards,
+    rather than this creating and closing one.
+
+    Returns the totals of the run.
+    """
+    profiler = Profiler(enabled=args.profile is not None)
+
+    if args.resume:
+        print("Loading checkpoint...")
+        resumed = checkpoint.load_checkpoint(args.resume)
+        pixels = resumed["pixels"]
+        neighbor_totals = resumed["neighbor_totals"]
+        normal_to_opaque_index_lut = resumed["normal_to_opaque_index_lut"]
+    else:
+        print("Loading input npy...")
+        with profiler.step("load input npy"):
+            # rgb2lab.py saves uint16 LAB values, while both backends sort float32 RGBA pixels
+            pixels = np.load(args.input_npy_path).astype(np.float32)
+        neighbor_totals = None
+        normal_to_opaque_index_lut = None
 
     width = pixels.shape[1]
     height = pixels.shape[0]
@@ -210,116 +2222,140 @@ def main():
     kernel_radius = min(kernel_radius, max_kernel_radius)
     print(f"Using kernel radius {kernel_radius}")
 
-    # How many work-items to have (one for every pair of pixels)
-    # TODO: Changing local and global workgroup sizes to (width / 2, height) might improve performance?
+    if args.resume and resumed["kernel_radius"] != kernel_radius:
+        raise ValueError(
+            f"The checkpoint was made with kernel radius {resumed['kernel_radius']}, so its neighbor totals can't be resumed with kernel radius {kernel_radius}"
+        )
+
+    # Tiles that are sorted at the same time have a tile between them,
+    # so this keeps them further apart than the kernel radius
+    tile_side = max(args.tile_side, kernel_radius, 2)
+    if args.proposals == "tiles":
+        print(f"Using tile side {tile_side}")
+
     pair_count = get_pair_count(pixels)
-    global_size = (pair_count, 1)
-
-    # Work groups have to be able to exactly consume all work-items, with no leftovers
-    workgroup_size = args.workgroup_size
-    while pair_count % workgroup_size != 0:
-        workgroup_size -= 1
-
-    print(f"Using workgroup-size {workgroup_size}")
-
-    # How many work-items to put in a work-group, i.e. how to partition work-items.
-    # Items in a work-group can work together, e.g. they can share fast local memory.
-    # Because the global size is partitioned with the local size into groups,
-    # both must have the same dimension, e.g. g.s=(1,10) and l.s=(1,2) gives 5 groups.
-    # If you don't care about work-groups, just put None.
-    # Source is Harry's comment below this answer: https://stackoverflow.com/a/50373589/13279557
-    #
-    # Setting this to None to go would mean an implementation-defined workgroups size would be used,
-    # which crashes your GPU after a few minutes when input/all_colors_shuffled.png is the input
-    # when a huge kernel_size is used (30 on my GPU).
-    # Source: https://stackoverflow.com/a/25443544/13279557
-    local_size = (workgroup_size, 1)
-
-    print("Building sort.cl...")
-    defines = (
-        f"-D MAKE_VSCODE_HIGHLIGHTER_HAPPY=1",
-        f"-D WIDTH={width}",
-        f"-D HEIGHT={height}",
-        f"-D OPAQUE_PIXEL_COUNT={pair_count * 2}",
-        f"-D ITERATIONS_IN_KERNEL_PER_CALL={args.iterations_in_kernel_per_call}",
-        f"-D KERNEL_RADIUS={kernel_radius}",
-    )
-
-    # Source: https://man.opencl.org/clBuildProgram.html
-    # optimization_flags = (
-    #     "-cl-single-precision-constant",
-    #     "-cl-denorms-are-zero",
-    #     "-cl-fp32-correctly-rounded-divide-sqrt",
-    #     "-cl-mad-enable",
-    #     "-cl-no-signed-zeros",
-    #     "-cl-unsafe-math-optimizations",
-    #     "-cl-finite-math-only",
-    #     "-cl-fast-relaxed-math",
-    #     # "-cl-uniform-work-group-size",
-    # )
-
-    options = defines
-    # Optimization flags don't help in practice :(
-    # options += optimization_flags
-
-    prg = cl.Program(ctx, Path("sort.cl").read_text()).build(options=options)
-
-    rgba_format = cl.ImageFormat(cl.channel_order.RGBA, cl.channel_type.FLOAT)
-
-    print("Creating pixels_buf...")
-    pixels_buf = cl.Image(
-        ctx, cl.mem_flags.READ_WRITE, rgba_format, shape=(width, height)
-    )
-    cl.enqueue_copy(
-        queue, pixels_buf, pixels, origin=(0, 0), region=(width, height)
-    ).wait()
-
-    print("Creating image kernel...")
-    kernel = get_kernel(kernel_radius)
-    kernel_width = kernel.shape[0]
-    kernel_height = kernel.shape[1]
-
-    print("Creating kernel_buf...")
-    # TODO: Try using kernel_format:
-    # kernel_format = cl.ImageFormat(cl.channel_order.INTENSITY, cl.channel_type.FLOAT)
-    kernel_buf = cl.Image(
-        ctx, cl.mem_flags.READ_WRITE, rgba_format, shape=(kernel_width, kernel_height)
-    )
-    cl.enqueue_copy(
-        queue,
-        kernel_buf,
-        kernel,
-        origin=(0, 0),
-        region=(kernel_width, kernel_height),
-    ).wait()
 
-    neighbor_totals_buf = cl.Image(
-        ctx, cl.mem_flags.READ_WRITE, rgba_format, shape=(width, height)
-    )
-    initialize_neighbor_totals_buf(
-        queue, neighbor_totals_buf, pixels, width, height, kernel
-    )
+    # Computed before the pyramid runs, so a pyramid level that loses pixels gets caught too
+    print("Computing the checksum of the pixels...")
+    with profiler.step("get_checksum"):
+        expected_checksum = pixel_checksum.get_checksum(pixels)
+
+    # --max-seconds is meant for sorting the full image, so the pyramid doesn't use it up
+    pyramid_seconds = 0
+    if args.pyramid_levels > 0 and not args.resume:
+        pyramid_start_time = time.time()
+        with profiler.step("sort_pyramid"):
+            sort_pyramid(args, pixels, kernel_radius)
+        pyramid_seconds = time.time() - pyramid_start_time
+
+    ctx = None
+    if args.autotune:
+        # The trials build their programs in the same context as the sorter, so it can reuse them
+        ctx = sorter_pool.ctx if sorter_pool is not None else cl.create_some_context()
+
+        def create_trial_sorter(
+            trial_args, trial_neighbor_totals, trial_normal_to_opaque_index_lut
+        ):
+            return OpenCLSorter(
+                trial_args,
+                pixels,
+                width,
+                height,
+                kernel_radius,
+                pair_count,
+                trial_neighbor_totals,
+                trial_normal_to_opaque_index_lut,
+                ctx,
+                snapshot_buffers=0,
+            )
+
+        with profiler.step("autotune"):
+            settings = autotune.autotune(
+                args,
+                ctx.devices[0],
+                pixels,
+                kernel_radius,
+                get_pixel_format(args, pixels)[1],
+                tile_side,
+                neighbor_totals,
+                normal_to_opaque_index_lut,
+                expected_checksum,
+                create_trial_sorter,
+            )
+
+        print(
+            f"Autotuned to {settings['iterations_in_kernel_per_call']} iterations per call, a {settings['layout']} layout and workgroup size {settings['workgroup_size']}"
+        )
 
-    print("Creating updated_buf...")
-    updated_buf = cl.Image(
-        ctx, cl.mem_flags.READ_WRITE, rgba_format, shape=(width, height)
-    )
+        # The caller's args are left alone, since batch.py can pass the same ones to several jobs
+        args = copy.copy(args)
+        args.iterations_in_kernel_per_call = settings["iterations_in_kernel_per_call"]
+        args.layout = settings["layout"]
+        args.workgroup_size = settings["workgroup_size"]
+
+    if sorter_pool is not None:
+        sorter = sorter_pool.acquire(
+            args,
+            pixels,
+            width,
+            height,
+            kernel_radius,
+            pair_count,
+            neighbor_totals,
+            normal_to_opaque_index_lut,
+            profiler,
+        )
+    elif args.devices > 1:
+        sorter = ShardedSorter(
+            args,
+            pixels,
+            width,
+            height,
+            kernel_radius,
+            neighbor_totals,
+            normal_to_opaque_index_lut,
+            profiler,
+        )
+    else:
+        sorter = create_sorter(
+            args,
+            pixels,
+            width,
+            height,
+            kernel_radius,
+            pair_count,
+            neighbor_totals,
+            normal_to_opaque_index_lut,
+            profiler,
+            ctx,
+        )
 
-    rand1 = np.uint32(42424242)
-    rand2 = np.uint32(69696969)
+    if args.resume:
+        rand1 = np.uint32(resumed["rand1"])
+        rand2 = np.uint32(resumed["rand2"])
 
-    python_iteration = 0
-    prev_python_iteration = 0
+        python_iteration = int(resumed["python_iteration"])
+        saved_results = int(resumed["saved_results"])
 
-    saved_results = 0
+        # Checkpoints from before the field was added restart the window schedule
+        resumed_sorting_seconds = (
+            float(resumed["sorting_seconds"])
+            if "sorting_seconds" in resumed.dtype.names
+            else 0
+        )
 
-    print("Creating normal_to_opaque_index_lut...")
-    normal_to_opaque_index_lut = get_normal_to_opaque_index_lut(pixels)
-    normal_to_opaque_index_lut_buf = cl.Buffer(
-        ctx,
-        cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
-        hostbuf=normal_to_opaque_index_lut,
-    )
+        print(
+            f"Resuming from iteration {python_iteration}, frame {saved_results} and {resumed_sorting_seconds:.2f} seconds of sorting"
+        )
+    else:
+        rand1 = np.uint32(42424242)
+        rand2 = np.uint32(69696969)
+
+        python_iteration = 0
+        saved_results = 0
+        resumed_sorting_seconds = 0
+
+    prev_python_iteration = python_iteration
 
     output_npy_path = get_output_npy_path(
         args.output_npy_path,
@@ -328,15 +2364,142 @@ def main():
         saved_results,
     )
 
-    opencl_sort = prg.sort
+    def get_sorting_seconds():
+        """
+        Returns how long this run and the ones it was resumed from have been sorting,
+        which is what the --proposals window schedule goes by
+        """
+        return resumed_sorting_seconds + time.time() - sorting_start_time
+
+    def save_checkpoint():
+        print("Saving checkpoint...")
+        with profiler.step("save_checkpoint"):
+            checkpoint.save_checkpoint(
+                args.checkpoint,
+                sorter,
+                kernel_radius,
+                rand1,
+                rand2,
+                python_iteration,
+                saved_results,
+                get_sorting_seconds(),
+            )
+
+    accepted_swaps = 0
+    total_score_difference = 0
+    stop_reason = None
+
+    stats_file = open(args.stats_path, "w") if args.stats_path else None
+    write_stats(stats_file, type="start", seconds=time.time() - start_time)
+
+    def check_pixels():
+        """
+        Returns whether the pixels still have the checksum they started with,
+        which is far cheaper than reading them back to compare their colors
+        """
+        pixels_checksum = sorter.checksum()
+        if pixels_checksum == expected_checksum:
+            return True
+
+        print(
+            f"The checksum of the pixels changed from {expected_checksum} to {pixels_checksum}, so pixels got duplicated or lost!"
+        )
+        write_stats(
+            stats_file,
+            type="checksum_mismatch",
+            seconds=time.time() - start_time,
+            python_iteration=python_iteration,
+        )
+        return False
+
+    def save_result():
+        """
+        Saves the pixels, unless their checksum shows that pixels got duplicated or lost,
+        in which case --checksum-mismatch decides what happens.
+        Returns whether the sorting has to stop.
+        """
+        nonlocal saved_results
+
+        if not check_pixels():
+            if args.checksum_mismatch == "stop":
+                print("Stopping, without saving the corrupted pixels...")
+                return True
+
+            if args.checksum_mismatch == "rollback":
+                print("Rolling back to the pixels of the last save...")
+                sorter.roll_back()
+
+        sorter.save(output_npy_path)
+        saved_results += 1
+
+        if args.preview_path:
+            sorter.save_preview(args.preview_path, args.preview_downsample)
+
+        if args.checksum_mismatch == "rollback":
+            sorter.keep_last_good()
+
+        return False
 
     last_printed_time = time.time()
+    last_checkpoint_time = time.time()
+
+    if stopping is None:
+        stopping = threading.Event()
+
+        def stop_sorting(signum, frame):
+            print(
+                "Stopping once the launched sort calls are done; press Ctrl+C again to quit immediately..."
+            )
+            sig.signal(sig.SIGINT, sig.default_int_handler)
+            stopping.set()
+
+        # Rather than having Ctrl+C raise a KeyboardInterrupt wherever the program happens to be,
+        # the loop gets to finish its iteration, so the launched calls can be drained cleanly
+        sig.signal(sig.SIGINT, stop_sorting)
+
+    sink = frame_sink.create_frame_sink(args, width, height, saved_results)
+
+    swap_log_writer = None
+    if args.swap_log_path:
+        print(f"Logging the accepted swaps to {args.swap_log_path}")
+        swap_log_writer = swap_log.SwapLogWriter(args.swap_log_path, pixels)
+        sorter.start_swap_log(swap_log_writer, args.swap_log_buffer_mib * 1024**2)
+
+    # The snapshot writer's thread hands the snapshots to the frame sink instead of saving an npy per snapshot.
+    # This is set even without a frame sink, since a sorter of batch.py's pool can still have an earlier job's.
+    sorter.snapshot_writer.write = profiler.timed(
+        "write snapshot", np.save if sink is None else sink.write
+    )
 
-    print("Running sort.cl...")
+    print(f"Running sort with the {args.backend} backend...")
+    sorting_start_time = time.time()
     try:
-        while True:
+        if not check_pixels():
+            raise RuntimeError(
+                "The pixels already had the wrong checksum before sorting started"
+            )
+
+        if args.checksum_mismatch == "rollback":
+            sorter.keep_last_good()
+
+        while stop_reason is None:
+            if stopping.is_set():
+                stop_reason = "stopped"
+                break
+
             python_iteration += 1
 
+            # Numpy does unsigned wraparound for us
+            rand1 = np.uint32(rand1 + 1)
+
+            if args.proposals == "tiles":
+                sorter.sort_in_tiles(rand1, rand2, tile_side)
+            elif args.proposals == "window":
+                window_side = get_window_side(args, get_sorting_seconds())
+                sorter.sort(rand1, rand2, window_side)
+            else:
+                sorter.sort(rand1, rand2)
+
             if time.time() > last_printed_time + args.seconds_between_saves:
                 output_npy_path = get_output_npy_path(
                     args.output_npy_path,
@@ -345,8 +2508,12 @@ def main():
                     saved_results,
                 )
 
-                save_result(pixels, queue, pixels_buf, width, height, output_npy_path)
-                saved_results += 1
+                if save_result():
+                    stop_reason = "checksum_mismatch"
+
+                accepted_swaps_difference, score_difference = sorter.read_counters()
+                accepted_swaps += accepted_swaps_difference
+                total_score_difference += score_difference
 
                 print_status(
                     saved_results,
@@ -354,38 +2521,74 @@ def main():
                     python_iteration,
                     args.iterations_in_kernel_per_call,
                     start_time,
+                    last_printed_time,
                     pair_count,
+                    accepted_swaps,
+                    accepted_swaps_difference,
+                    score_difference,
                 )
 
+                write_stats(
+                    stats_file,
+                    type="status",
+                    seconds=time.time() - start_time,
+                    frame=saved_results,
+                    python_iteration=python_iteration,
+                    attempted_swaps=get_attempted_swaps(
+                        python_iteration,
+                        args.iterations_in_kernel_per_call,
+                        pair_count,
+                    ),
+                    accepted_swaps=accepted_swaps,
+                    score_difference=score_difference,
+                )
+
+                attempted_swaps_difference = get_attempted_swaps(
+                    python_iteration, args.iterations_in_kernel_per_call, pair_count
+                ) - get_attempted_swaps(
+                    prev_python_iteration,
+                    args.iterations_in_kernel_per_call,
+                    pair_count,
+                )
+                accept_rate = accepted_swaps_difference / max(
+                    attempted_swaps_difference, 1
+                )
+
+                if (
+                    args.stop_when_accept_rate_below is not None
+                    and accept_rate < args.stop_when_accept_rate_below
+                ):
+                    print(
+                        f"Stopping, since the accept rate dropped below {args.stop_when_accept_rate_below:.3%}..."
+                    )
+                    stop_reason = "accept_rate"
+
                 last_printed_time = time.time()
                 prev_python_iteration = python_iteration
 
-            # Numpy does unsigned wraparound for us
-            rand1 = np.uint32(rand1 + 1)
+            if (
+                args.checkpoint
+                and time.time()
+                > last_checkpoint_time + args.seconds_between_checkpoints
+            ):
+                save_checkpoint()
+                last_checkpoint_time = time.time()
 
-            # The .wait() at the end of this line is crucial!
-            # The reason being that the OpenCL kernel call is async,
-            # so without it you end up being unable to use Ctrl+C
-            # to stop the program!
-            #
-            # Here's the documentation of the function arguments:
-            # https://documen.tician.de/pyopencl/runtime_program.html#pyopencl.Kernel.__call__
-            opencl_sort(
-                queue,
-                global_size,
-                local_size,
-                pixels_buf,
-                neighbor_totals_buf,
-                updated_buf,
-                kernel_buf,
-                normal_to_opaque_index_lut_buf,
-                rand1,
-                rand2,
-            ).wait()
+            if (
+                args.max_seconds is not None
+                and time.time() > start_time + pyramid_seconds + args.max_seconds
+            ):
+                print(f"Stopping, since {args.max_seconds} seconds have passed...")
+                stop_reason = "max_seconds"
 
-    except KeyboardInterrupt:
-        save_result(pixels, queue, pixels_buf, width, height, output_npy_path)
-        saved_results += 1
+        sorter.finish()
+
+        if stop_reason != "checksum_mismatch" and save_result():
+            stop_reason = "checksum_mismatch"
+
+        accepted_swaps_difference, score_difference = sorter.read_counters()
+        accepted_swaps += accepted_swaps_difference
+        total_score_difference += score_difference
 
         print_status(
             saved_results,
@@ -393,9 +2596,84 @@ def main():
             python_iteration,
             args.iterations_in_kernel_per_call,
             start_time,
+            last_printed_time,
             pair_count,
+            accepted_swaps,
+            accepted_swaps_difference,
+            score_difference,
         )
 
+        write_stats(
+            stats_file,
+            type="status",
+            seconds=time.time() - start_time,
+            frame=saved_results,
+            python_iteration=python_iteration,
+            attempted_swaps=get_attempted_swaps(
+                python_iteration, args.iterations_in_kernel_per_call, pair_count
+            ),
+            accepted_swaps=accepted_swaps,
+            score_difference=score_difference,
+        )
+
+        # A checkpoint of the corrupted pixels would only get resumed from by accident
+        if args.checkpoint and stop_reason != "checksum_mismatch":
+            save_checkpoint()
+
+    finally:
+        if swap_log_writer is not None:
+            sorter.stop_swap_log()
+            swap_log_writer.close()
+
+        print("Waiting for the last snapshots to be written...")
+        if sorter_pool is not None:
+            sorter_pool.release(sorter)
+        else:
+            sorter.close()
+
+        if sink is not None:
+            sink.close()
+
+        if stats_file is not None:
+            stats_file.close()
+
+        if args.profile:
+            profiler.write(args.profile)
+            profiler.print_summary()
+
+    attempted_swaps = get_attempted_swaps(
+        python_iteration, args.iterations_in_kernel_per_call, pair_count
+    )
+
+    return {
+        "stop_reason": stop_reason,
+        "startup_seconds": sorting_start_time - start_time,
+        "seconds": time.time() - start_time,
+        "sorting_seconds": time.time() - sorting_start_time,
+        "frames": saved_results,
+        "python_iteration": python_iteration,
+        "attempted_swaps": attempted_swaps,
+        "accepted_swaps": accepted_swaps,
+        "score_difference": total_score_difference,
+    }
+
+
+def main():
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_parser_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        check_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sort_image(args, start_time)
+
 
 if __name__ == "__main__":
     main()
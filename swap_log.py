@@ -0,0 +1,144 @@
+import hashlib
+import time
+from pathlib import Path
+
+import numpy as np
+
+# A swap log starts with this header, and is followed by blocks,
+# which each consist of a BLOCK_DTYPE followed by record_count RECORD_DTYPEs
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", "S8"),
+        ("width", "<u4"),
+        ("height", "<u4"),
+        ("pixels_sha256", "S32"),
+    ]
+)
+MAGIC = b"PXSWAPS1"
+
+# The seconds are since the log was started, and get written when the block is flushed
+BLOCK_DTYPE = np.dtype([("record_count", "<u8"), ("seconds", "<f8")])
+
+# The flat y * width + x indices of the two pixels that got swapped
+RECORD_DTYPE = np.dtype([("index1", "<u4"), ("index2", "<u4")])
+
+# Records are applied this many at a time at first, see apply_swaps()
+MIN_SWAP_BATCH = 1024
+
+
+def get_pixels_sha256(pixels):
+    """
+    Hashes the uint16 LAB pixels, so a replay can tell whether it was given the pixels the log started from
+    """
+    return hashlib.sha256(np.ascontiguousarray(pixels, dtype=np.uint16)).digest()
+
+
+class SwapLogWriter:
+    """
+    Appends the blocks of accepted swaps that OpenCLSorter flushes from the device to a swap log,
+    which replay.py can turn back into frames
+    """
+
+    def __init__(self, path, pixels):
+        self.path = Path(path)
+        self.start_time = time.time()
+
+        header = np.zeros((), dtype=HEADER_DTYPE)
+        header["magic"] = MAGIC
+        header["height"], header["width"] = pixels.shape[:2]
+        header["pixels_sha256"] = get_pixels_sha256(pixels)
+
+        self.f = open(self.path, "wb")
+        self.f.write(header.tobytes())
+
+    def write(self, records):
+        block = np.zeros((), dtype=BLOCK_DTYPE)
+        block["record_count"] = len(records)
+        block["seconds"] = time.time() - self.start_time
+
+        self.f.write(block.tobytes())
+        self.f.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+
+    def tell(self):
+        return self.f.tell()
+
+    def truncate(self, offset):
+        """
+        Forgets every block after offset, which tell() returned earlier
+        """
+        self.f.seek(offset)
+        self.f.truncate()
+
+    def close(self):
+        self.f.close()
+
+
+def read_header(f):
+    header = np.frombuffer(f.read(HEADER_DTYPE.itemsize), dtype=HEADER_DTYPE)
+
+    if len(header) == 0 or header[0]["magic"] != MAGIC:
+        raise ValueError(f"{f.name} isn't a swap log")
+
+    return header[0]
+
+
+def read_blocks(f):
+    """
+    Yields the seconds and records of every block after the header,
+    where a block that got cut off by the run getting killed is skipped
+    """
+    while True:
+        block = np.frombuffer(f.read(BLOCK_DTYPE.itemsize), dtype=BLOCK_DTYPE)
+        if len(block) == 0:
+            return
+
+        record_count = int(block[0]["record_count"])
+        records = np.frombuffer(
+            f.read(record_count * RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE
+        )
+        if len(records) < record_count:
+            return
+
+        yield float(block[0]["seconds"]), records
+
+
+def apply_swaps(flat_pixels, records):
+    """
+    Swaps the (height * width, 4) pixels in the order of the records.
+
+    Swaps that don't share a pixel can be applied at the same time,
+    so every batch is the longest run of records in which no pixel appears twice.
+    A call of sort.cl usually swaps every pixel at most once, so batches tend to be as long as a call.
+    """
+    start = 0
+    batch_size = MIN_SWAP_BATCH
+
+    while start < len(records):
+        batch = records[start : start + batch_size]
+        indices = np.stack((batch["index1"], batch["index2"]), axis=1).ravel()
+
+        # Every occurrence of an index after its first one is a repeat
+        order = np.argsort(indices, kind="stable")
+        sorted_indices = indices[order]
+        repeated = np.zeros(len(indices), dtype=bool)
+        repeated[order[1:][sorted_indices[1:] == sorted_indices[:-1]]] = True
+
+        repeated_records = repeated.reshape(-1, 2).any(axis=1)
+        batch_end = (
+            int(np.argmax(repeated_records)) if repeated_records.any() else len(batch)
+        )
+
+        # A record that swaps a pixel with itself repeats its own index
+        batch_end = max(batch_end, 1)
+
+        index1 = batch["index1"][:batch_end]
+        index2 = batch["index2"][:batch_end]
+        flat_pixels[index1], flat_pixels[index2] = (
+            flat_pixels[index2],
+            flat_pixels[index1],
+        )
+
+        start += batch_end
+
+        # Looking a bit past the last batch finds where the next one ends without sorting too much
+        batch_size = max(batch_end * 2, MIN_SWAP_BATCH)
@@ -4,31 +4,117 @@ from pathlib import Path
 import numpy as np
 from PIL import Image
 
+import color_cache
+import rgb2lab
+
+# Large images get counted this many pixels at a time, which bounds the memory
+DEFAULT_CHUNK_PIXELS = 1 << 20
+
+
+def _read_chunks(filepath, chunk_pixels, as_lab):
+    """
+    Yields the (rows, width, 4) pixels of the image or npy a few rows at a time,
+    where npys are the uint16 LAB pixels of rgb2lab.py and sort.py,
+    and images are RGBA pixels, unless as_lab converts them to LAB like rgb2lab.py does
+    """
+    if filepath.suffix == ".npy":
+        pixels = np.load(filepath, mmap_mode="r")
+        height, width = pixels.shape[:2]
+        rows = max(1, chunk_pixels // width)
+
+        for y in range(0, height, rows):
+            chunk = np.array(pixels[y : y + rows])
+
+            # The numpy backend of sort.py saves float32 pixels, which still have to be whole uint16 values
+            lab_chunk = chunk.astype(np.uint16)
+            assert np.array_equal(
+                chunk, lab_chunk
+            ), f"❌ {filepath} has pixels that aren't uint16 LAB values!"
+
+            yield lab_chunk
+        return
+
+    with Image.open(filepath) as img:
+        img.load()
+        width, height = img.size
+        rows = max(1, chunk_pixels // width)
+
+        for y in range(0, height, rows):
+            chunk = np.array(
+                img.crop((0, y, width, min(y + rows, height))).convert("RGBA")
+            )
+
+            yield rgb2lab.rgb_to_lab(chunk) if as_lab else chunk
+
+
+def _merge_histograms(histograms):
+    """
+    Merges (colors, counts) pairs with sorted unique colors into a single one
+    """
+    # The colors are sorted runs, which the stable sort merges in about linear time
+    colors = np.sort(
+        np.concatenate([colors for colors, _ in histograms]), kind="stable"
+    )
+    colors = colors[np.concatenate(([True], colors[1:] != colors[:-1]))]
+
+    counts = np.zeros(len(colors), dtype=np.int64)
+    for histogram_colors, histogram_counts in histograms:
+        counts[np.searchsorted(colors, histogram_colors)] += histogram_counts
 
-def _get_colors_and_counts(filepath):
-    img = Image.open(filepath).convert("RGBA")
+    return colors, counts
 
-    arr = np.array(img)
 
-    # Set the RGB values of pixels with an alpha of 0 all to 0
-    arr[arr[:, :, 3] == 0] = 0
+def _get_colors_and_counts(filepath, chunk_pixels, as_lab):
+    """
+    Returns the sorted packed colors of the image or npy, and how often each occurs
+    """
+    histogram = None
 
-    # Arrange all pixels into a tall column of 4 RGBA values and find unique rows (colors)
-    colors, counts = np.unique(arr.reshape(-1, 4), axis=0, return_counts=1)
+    # The histograms of chunks only get merged once they have as many colors as the merged one,
+    # so that images where almost every pixel has its own color don't re-sort all colors after every chunk
+    chunk_histograms = []
+    chunk_histogram_colors = 0
 
-    return colors, counts
+    for chunk in _read_chunks(filepath, chunk_pixels, as_lab):
+        # Set the other values of pixels with an alpha of 0 all to 0
+        chunk[chunk[:, :, 3] == 0] = 0
+
+        chunk_histogram = np.unique(color_cache.pack_colors(chunk), return_counts=True)
+
+        if histogram is None:
+            histogram = chunk_histogram
+            continue
+
+        chunk_histograms.append(chunk_histogram)
+        chunk_histogram_colors += len(chunk_histogram[0])
 
+        if chunk_histogram_colors >= len(histogram[0]):
+            histogram = _merge_histograms([histogram, *chunk_histograms])
+            chunk_histograms = []
+            chunk_histogram_colors = 0
 
-def verify(input_image_path, output_image_path):
+    return _merge_histograms([histogram, *chunk_histograms])
+
+
+def verify(input_image_path, output_image_path, chunk_pixels=DEFAULT_CHUNK_PIXELS):
     print("Verifying...")
 
-    input_colors, input_counts = _get_colors_and_counts(input_image_path)
-    output_colors, output_counts = _get_colors_and_counts(output_image_path)
+    # An image can only be compared against an npy once it is converted to LAB
+    as_lab = ".npy" in (input_image_path.suffix, output_image_path.suffix)
+
+    input_colors, input_counts = _get_colors_and_counts(
+        input_image_path, chunk_pixels, as_lab
+    )
+    output_colors, output_counts = _get_colors_and_counts(
+        output_image_path, chunk_pixels, as_lab
+    )
 
     colors_equal = np.array_equal(input_colors, output_colors)
-    counts_equal = np.array_equal(input_counts, output_counts)
+    counts_equal = colors_equal and np.array_equal(input_counts, output_counts)
 
-    assert colors_equal, "❌ The set of colors of the input and output aren't identical!"
+    assert (
+        colors_equal
+    ), "❌ The set of colors of the input and output aren't identical!"
 
     assert counts_equal, "❌ The color counts of the input and output aren't identical!"
 
@@ -39,12 +125,18 @@ def add_parser_arguments(parser):
     parser.add_argument(
         "input_image_path",
         type=Path,
-        help="Path to the input image",
+        help="Path to the input image, or the LAB npy of rgb2lab.py",
     )
     parser.add_argument(
         "output_image_path",
         type=Path,
-        help="Path to the output image",
+        help="Path to the output image, or the LAB npy of sort.py",
+    )
+    parser.add_argument(
+        "--chunk-pixels",
+        type=int,
+        default=DEFAULT_CHUNK_PIXELS,
+        help="How many pixels are counted at a time, which bounds the memory used on large images",
     )
 
 
@@ -55,7 +147,7 @@ def main():
     add_parser_arguments(parser)
     args = parser.parse_args()
 
-    verify(args.input_image_path, args.output_image_path)
+    verify(args.input_image_path, args.output_image_path, args.chunk_pixels)
 
 
 if __name__ == "__main__":